@@ -0,0 +1,6 @@
+"""WAM2layers atmospheric moisture tracking model.
+
+The subpackages can be imported without side effects; experiments are run
+through the ``wam2layers`` command line interface (see wam2layers.cli).
+"""
+__version__ = "3.0.0-beta.2"
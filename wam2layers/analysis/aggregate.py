@@ -0,0 +1,183 @@
+"""Aggregate the daily output of a tracking run over (multi-day) windows.
+
+The daily output files are read one by one, with a few files read ahead in
+background threads, and accumulated into sums and means per window. For
+per-cell percentiles, all days of a window are needed at once; these are
+spilled to a temporary file on disk and the percentiles are computed for a
+block of grid cells at a time. Memory use is therefore independent of the
+number of days.
+
+Example:
+
+    wam2layers aggregate cases/era5_2021.yaml --window 20210701 20210715 --percentiles 50 90
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.tracking.backtrack import output_path, tracked_dates
+
+# Maximum size of the block of days x cells for which percentiles are computed
+block_size = 2**23
+
+
+def output_variables(path):
+    """Return the dimensions of the variables in a daily output file.
+
+    The restart fields are left out. With two layers, s_track_upper and
+    s_track_lower are (lat, lon) fields; with stacked layers, s_track has a
+    layer axis and is aggregated per layer.
+    """
+    with xr.open_dataset(path) as ds:
+        return {
+            name: list(da.dims)
+            for name, da in ds.data_vars.items()
+            if not name.endswith("_restart")
+        }
+
+
+def read_day(path, variables):
+    """Read the variables of one daily output file."""
+    with xr.open_dataset(path) as ds:
+        return {name: ds[name].values for name in variables}
+
+
+def read_days(paths, variables, workers=4):
+    """Yield the variables of each file in turn, reading up to `workers` ahead."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(read_day, path, variables))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def aggregate_window(paths, variables, percentiles=(), workers=4):
+    """Return sums, means and percentiles over the days of one window.
+
+    Returns a dictionary with for each variable a tuple of the sum, the mean
+    and (if percentiles are requested) an array with the percentiles on the
+    first axis.
+    """
+    ndays = len(paths)
+    sums = {}
+    with TemporaryDirectory() as tmpdir:
+        spill = {}
+        for i, day in enumerate(read_days(paths, variables, workers)):
+            for name, values in day.items():
+                if name not in sums:
+                    sums[name] = np.zeros(values.shape)
+                    if len(percentiles):
+                        spill[name] = np.lib.format.open_memmap(
+                            Path(tmpdir) / f"{name}.npy",
+                            mode="w+",
+                            shape=(ndays, values.size),
+                        )
+                sums[name] += values
+                if name in spill:
+                    spill[name][i] = values.ravel()
+
+        results = {}
+        for name, total in sums.items():
+            result = None
+            if name in spill:
+                days = spill[name]
+                result = np.empty((len(percentiles), days.shape[1]))
+                step = max(1, block_size // ndays)
+                for start in range(0, days.shape[1], step):
+                    block = days[:, start : start + step]
+                    result[:, start : start + step] = np.percentile(
+                        block, percentiles, axis=0
+                    )
+                result = result.reshape(len(percentiles), *total.shape)
+            results[name] = (total, total / ndays, result)
+    return results
+
+
+def aggregate(
+    paths_per_window, windows, variables=None, percentiles=(), workers=4, coords=None
+):
+    """Aggregate daily output over windows into a single dataset.
+
+    Paths_per_window is a list with the daily output files of each window,
+    windows a list of (first, last) dates. Variables defaults to all variables
+    of the daily output (see output_variables). Coords optionally gives the
+    latitude and longitude of the output grid.
+    """
+    percentiles = list(percentiles)
+    dims = output_variables(paths_per_window[0][0])
+    variables = variables or list(dims)
+
+    windows_results = [
+        aggregate_window(paths, variables, percentiles, workers)
+        for paths in paths_per_window
+    ]
+
+    ds = xr.Dataset(
+        coords={
+            "window_start": ("window", [pd.Timestamp(first) for first, _ in windows]),
+            "window_end": ("window", [pd.Timestamp(last) for _, last in windows]),
+            "days": ("window", [len(paths) for paths in paths_per_window]),
+        }
+    )
+    if percentiles:
+        ds.coords["percentile"] = percentiles
+    if coords is not None:
+        ds.coords["lat"], ds.coords["lon"] = coords
+
+    for name in variables:
+        total, mean, result = zip(*(results[name] for results in windows_results))
+        ds[f"{name}_sum"] = (["window"] + dims[name], np.stack(total))
+        ds[f"{name}_mean"] = (["window"] + dims[name], np.stack(mean))
+        if percentiles:
+            ds[f"{name}_percentile"] = (
+                ["window", "percentile"] + dims[name],
+                np.stack(result),
+            )
+    return ds
+
+
+def run_aggregation(config_file, windows=None, percentiles=(), output=None, workers=4):
+    """Aggregate the output of the run described by a config file.
+
+    Windows is a list of (first, last) dates (inclusive), by default the
+    period for which the run has written output. The result is written to
+    `output`, by default aggregate.nc in the output folder of the run.
+    """
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    screening = config.get("screening")
+    output_dir = Path(config["output_folder"]).expanduser() / (
+        "screening" if screening else "backtrack"
+    )
+    if not windows:
+        dates = tracked_dates(config, output_dir)
+        windows = [(dates[0], dates[-1])]
+
+    paths_per_window = []
+    for first, last in windows:
+        paths = [output_path(date, output_dir) for date in pd.date_range(first, last)]
+        missing = [str(path) for path in paths if not Path(path).exists()]
+        if missing:
+            raise FileNotFoundError(f"Missing output files: {', '.join(missing)}")
+        paths_per_window.append(paths)
+
+    # Take the coordinates from the output, which is on the (coarse) tracking grid
+    with xr.open_dataset(paths_per_window[0][0]) as grid:
+        coords = (grid.lat.values, grid.lon.values)
+
+    ds = aggregate(
+        paths_per_window, windows, percentiles=percentiles, workers=workers, coords=coords
+    )
+    output = output or output_dir / "aggregate.nc"
+    ds.to_netcdf(output)
+    return ds
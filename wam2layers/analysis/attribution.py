@@ -0,0 +1,105 @@
+"""Attribute tracked moisture to labelled areas, e.g. countries or basins.
+
+The labels are an integer raster on the tracking grid. Cells without a label
+are NaN or negative. The daily output is reduced to totals per label with
+np.bincount, using an index that is computed only once, which makes it
+cheap to process many years of output.
+
+Example:
+
+    wam2layers attribute cases/era5_2021.yaml countries.nc --labels-variable country
+
+If the labels variable has CF `flag_values` and `flag_meanings` attributes,
+the names of the labels are included in the output.
+"""
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+import yaml
+
+from wam2layers.analysis.aggregate import read_days
+from wam2layers.tracking.backtrack import output_path, tracked_dates
+
+
+class Attribution:
+    """Reduce fields on the tracking grid to totals per label."""
+
+    def __init__(self, labels):
+        labels = np.asarray(labels, dtype="float64")
+        self.shape = labels.shape
+        labels = labels.ravel()
+        self.valid = np.flatnonzero(np.isfinite(labels) & (labels >= 0))
+        self.labels, self.index = np.unique(
+            labels[self.valid].astype("int64"), return_inverse=True
+        )
+
+    def __call__(self, field):
+        """Return the total of a (lat, lon) field for each label."""
+        field = np.asarray(field)
+        if field.shape != self.shape:
+            raise ValueError(
+                f"The field has shape {field.shape}, the labels {self.shape}"
+            )
+        values = field.ravel()[self.valid]
+        return np.bincount(self.index, weights=values, minlength=self.labels.size)
+
+
+def attribute(paths, times, labels, variables=("e_track",), workers=4):
+    """Return a (time, label) table of the totals per label of each file.
+
+    Fields with stacked layers, such as s_track (layer, lat, lon), are summed
+    over the layers.
+    """
+    reduce = Attribution(labels)
+    table = {name: np.zeros((len(paths), reduce.labels.size)) for name in variables}
+    for i, day in enumerate(read_days(paths, variables, workers)):
+        for name, values in day.items():
+            if values.ndim == 3:
+                values = values.sum(axis=0)
+            table[name][i] = reduce(values)
+
+    return xr.Dataset(
+        {name: (["time", "label"], values) for name, values in table.items()},
+        coords={"time": times, "label": reduce.labels},
+    )
+
+
+def run_attribution(
+    config_file, labels_file, labels_variable="labels", variables=("e_track",),
+    output=None, workers=4,
+):
+    """Attribute the output of the run described by a config file.
+
+    The labels are read from `labels_variable` in `labels_file`, which may
+    cover a larger domain than the tracking grid. The result is written to
+    `output`, by default attribution.nc in the output folder of the run.
+    """
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    output_dir = Path(config["output_folder"]).expanduser() / (
+        "screening" if config.get("screening") else "backtrack"
+    )
+    dates = tracked_dates(config, output_dir)
+    paths = [output_path(date, output_dir) for date in dates]
+
+    # Select the labels on the tracking grid of the output; the cells of the
+    # coarse grid of screening runs take the label nearest to their centre
+    labels = xr.open_dataset(labels_file)[labels_variable]
+    method = "nearest" if config.get("screening") else None
+    with xr.open_dataset(paths[-1]) as grid:
+        labels = labels.sel(latitude=grid.lat.values, longitude=grid.lon.values, method=method)
+
+    ds = attribute(paths, dates, labels.values, variables, workers)
+
+    # Add the names of the labels, if available
+    flag_values = labels.attrs.get("flag_values")
+    flag_meanings = labels.attrs.get("flag_meanings")
+    if flag_values is not None and flag_meanings is not None:
+        names = dict(zip(np.atleast_1d(flag_values).tolist(), flag_meanings.split()))
+        ds.coords["label_name"] = ("label", [names.get(label, "") for label in ds.label.values])
+
+    output = output or output_dir / "attribution.nc"
+    ds.to_netcdf(output)
+    return ds
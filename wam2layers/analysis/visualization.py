@@ -1,3 +1,5 @@
+import multiprocessing
+import queue
 from pathlib import Path
 
 import cartopy
@@ -7,127 +9,218 @@ import numpy as np
 import xarray as xr
 from cartopy.mpl.ticker import LatitudeFormatter, LongitudeFormatter
 
-from preprocessing import get_grid_info
-
-
-def make_diagnostic_figures(
-    date,
-    region,
-    fx_upper,
-    fy_upper,
-    fx_lower,
-    fy_lower,
-    precip,
-    s_track_upper_mean,
-    s_track_lower_mean,
-    e_track,
-):
-    """Visualize fields during the simulation."""
-    # import IPython; IPython.embed(); quit()
-    output_dir = Path("../figures")
-    output_dir.mkdir(exist_ok=True)
-
-    # Load data
-    u = xr.open_dataset("/data/volume_2/era5_2021/FloodCase_202107_u.nc")
-
-    # Get grid info
-    lat = u.latitude.values
-    lon = u.longitude.values
-    a_gridcell, l_ew_gridcell, l_mid_gridcell = get_grid_info(u)
-
-    # TODO: improve this
-    a_gridcell = a_gridcell[:, None]
-
-    my_projection = ccrs.PlateCarree(central_longitude=0)
-
-    def polish(ax):
-        ax.add_feature(cartopy.feature.COASTLINE, linewidth=0.8)
-        ax.add_feature(cartopy.feature.BORDERS, linestyle="-", linewidth=0.2)
-
-        ax.set_xticks(np.arange(-180, 181, 20), crs=my_projection)
-        ax.set_yticks(np.arange(-90, 91, 20), crs=my_projection)
-        lon_formatter = LongitudeFormatter(zero_direction_label=True)
-        lat_formatter = LatitudeFormatter()
-        ax.xaxis.set_major_formatter(lon_formatter)
-        ax.yaxis.set_major_formatter(lat_formatter)
-        ax.contour(lon, lat, region)
-        ax.set_xlim(-50, 30)
-        ax.set_ylim(30, 60)
-
-    precip_track = np.arange(0.0, 50.0, 5)
-    S_track = np.arange(0.0, 5, 0.5)
-    E_track = np.arange(0.0, 1.0, 0.1)
-
-    fig1 = plt.figure(figsize=(14, 8))
-
-    ax1 = plt.subplot(221, projection=my_projection)
-    cb1 = ax1.contourf(
-        lon,
-        lat,
-        (precip.sum(axis=0) * region / a_gridcell) * 1000,
-        precip_track,
-        cmap=plt.cm.Blues,
-        extend="max",
-    )  # We plot a colormesh using the gist_ncar colormap.
-    polish(ax1)
-    ax1.set_title("Tracked precipitation" + date.strftime("%Y%m%d"))
-
-    ax2 = plt.subplot(222, projection=my_projection)
-    cb2 = ax2.contourf(
-        lon, lat, (e_track / a_gridcell) * 1000, E_track, cmap=plt.cm.GnBu, extend="max"
-    )  # We plot a colormesh using the gist_ncar colormap.
-    polish(ax2)
-    ax2.set_title("Moisture source")
-
-    ax3 = plt.subplot(223, projection=my_projection)
-    cb3 = ax3.contourf(
-        lon,
-        lat,
-        (s_track_upper_mean / a_gridcell) * 1000,
-        S_track,
-        cmap=plt.cm.YlOrRd,
-        extend="max",
-    )  # We plot a colormesh using the gist_ncar colormap.
-    ax3.quiver(
-        lon[::5],
-        lat[::5],
-        fx_upper.mean(axis=0)[::5, ::5],
-        fy_upper.mean(axis=0)[::5, ::5],
-        color="black",
-        width=0.003,
-        alpha=0.5,
-    )
-    polish(ax3)
-    ax3.set_title("S track upper layer")
-
-    ax4 = plt.subplot(224, projection=my_projection)
-    cb3 = ax4.contourf(
-        lon,
-        lat,
-        (s_track_lower_mean / a_gridcell) * 1000,
-        S_track,
-        cmap=plt.cm.YlOrRd,
-        extend="max",
-    )  # We plot a colormesh using the gist_ncar colormap.
-    ax4.quiver(
-        lon[::5],
-        lat[::5],
-        fx_lower.mean(axis=0)[::5, ::5],
-        fy_lower.mean(axis=0)[::5, ::5],
-        color="black",
-        width=0.003,
-        alpha=0.5,
-    )
-    polish(ax4)
-    ax4.set_title("S track lower layer")
-
-    new_axis = fig1.add_axes([0.55, 0.50, 0.35, 0.015])  # left, bottom, width, height
-    fig1.colorbar(cb2, cax=new_axis, orientation="horizontal")
-
-    new_axis2 = fig1.add_axes([0.15, 0.50, 0.35, 0.015])
-    fig1.colorbar(cb1, cax=new_axis2, orientation="horizontal")
-
-    new_axis3 = fig1.add_axes([0.30, 0.08, 0.35, 0.015])
-    fig1.colorbar(cb3, cax=new_axis3, orientation="horizontal")
-    plt.savefig(output_dir / f"tracking_{date.strftime('%Y%m%d')}.png")
-    plt.close()
+from wam2layers.preprocessing.preprocessing import get_grid_info
+
+
+precip_track = np.arange(0.0, 50.0, 5)
+S_track = np.arange(0.0, 5, 0.5)
+E_track = np.arange(0.0, 1.0, 0.1)
+
+
+class DiagnosticFigure:
+    """Visualize fields during the simulation.
+
+    The figure, map features and grid info are set up once; for each day only
+    the data layers are replaced before saving the figure.
+    """
+
+    def __init__(self, latitude, longitude, region, output_dir="../figures"):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+
+        self.lat = latitude
+        self.lon = longitude
+        self.region = region
+
+        # Get grid info
+        ds = xr.Dataset(coords={"latitude": latitude, "longitude": longitude})
+        a_gridcell, l_ew_gridcell, l_mid_gridcell = get_grid_info(ds)
+
+        # TODO: improve this
+        self.a_gridcell = a_gridcell[:, None]
+
+        my_projection = ccrs.PlateCarree(central_longitude=0)
+
+        def polish(ax):
+            ax.add_feature(cartopy.feature.COASTLINE, linewidth=0.8)
+            ax.add_feature(cartopy.feature.BORDERS, linestyle="-", linewidth=0.2)
+
+            ax.set_xticks(np.arange(-180, 181, 20), crs=my_projection)
+            ax.set_yticks(np.arange(-90, 91, 20), crs=my_projection)
+            lon_formatter = LongitudeFormatter(zero_direction_label=True)
+            lat_formatter = LatitudeFormatter()
+            ax.xaxis.set_major_formatter(lon_formatter)
+            ax.yaxis.set_major_formatter(lat_formatter)
+            ax.contour(longitude, latitude, region)
+            ax.set_xlim(-50, 30)
+            ax.set_ylim(30, 60)
+
+        self.fig = plt.figure(figsize=(14, 8))
+        self.axes = [
+            self.fig.add_subplot(221 + i, projection=my_projection) for i in range(4)
+        ]
+        for ax in self.axes:
+            polish(ax)
+        self.axes[1].set_title("Moisture source")
+        self.axes[2].set_title("S track upper layer")
+        self.axes[3].set_title("S track lower layer")
+
+        self.colorbar_axes = [
+            self.fig.add_axes([0.15, 0.50, 0.35, 0.015]),  # left, bottom, width, height
+            self.fig.add_axes([0.55, 0.50, 0.35, 0.015]),
+            self.fig.add_axes([0.30, 0.08, 0.35, 0.015]),
+        ]
+        self.colorbars = None
+        self.artists = []
+
+    def update(
+        self,
+        date,
+        precip,
+        e_track,
+        s_track_upper_mean,
+        s_track_lower_mean,
+        fx_upper,
+        fy_upper,
+        fx_lower,
+        fy_lower,
+    ):
+        """Draw the fields of a single day and save the figure.
+
+        Precipitation should be summed over the day, fluxes averaged over the day.
+        """
+        # Remove the data of the previous day
+        for artist in self.artists:
+            artist.remove()
+
+        lon, lat, a_gridcell = self.lon, self.lat, self.a_gridcell
+        ax1, ax2, ax3, ax4 = self.axes
+
+        cb1 = ax1.contourf(
+            lon,
+            lat,
+            (precip * self.region / a_gridcell) * 1000,
+            precip_track,
+            cmap=plt.cm.Blues,
+            extend="max",
+        )
+        ax1.set_title("Tracked precipitation" + date.strftime("%Y%m%d"))
+
+        cb2 = ax2.contourf(
+            lon, lat, (e_track / a_gridcell) * 1000, E_track, cmap=plt.cm.GnBu, extend="max"
+        )
+
+        cb3 = ax3.contourf(
+            lon,
+            lat,
+            (s_track_upper_mean / a_gridcell) * 1000,
+            S_track,
+            cmap=plt.cm.YlOrRd,
+            extend="max",
+        )
+        q3 = ax3.quiver(
+            lon[::5],
+            lat[::5],
+            fx_upper[::5, ::5],
+            fy_upper[::5, ::5],
+            color="black",
+            width=0.003,
+            alpha=0.5,
+        )
+
+        cb4 = ax4.contourf(
+            lon,
+            lat,
+            (s_track_lower_mean / a_gridcell) * 1000,
+            S_track,
+            cmap=plt.cm.YlOrRd,
+            extend="max",
+        )
+        q4 = ax4.quiver(
+            lon[::5],
+            lat[::5],
+            fx_lower[::5, ::5],
+            fy_lower[::5, ::5],
+            color="black",
+            width=0.003,
+            alpha=0.5,
+        )
+        self.artists = [cb1, cb2, cb3, q3, cb4, q4]
+
+        # Levels are fixed, so the colorbars only need to be drawn once
+        if self.colorbars is None:
+            self.colorbars = [
+                self.fig.colorbar(cb, cax=cax, orientation="horizontal")
+                for cb, cax in zip([cb1, cb2, cb3], self.colorbar_axes)
+            ]
+
+        self.fig.savefig(self.output_dir / f"tracking_{date.strftime('%Y%m%d')}.png")
+
+
+def _render_figures(queue, latitude, longitude, region, output_dir):
+    """Render the figures that come in through the queue, until None arrives."""
+    plt.switch_backend("Agg")
+    figure = DiagnosticFigure(latitude, longitude, region, output_dir)
+    for fields in iter(queue.get, None):
+        figure.update(**fields)
+    plt.close(figure.fig)
+
+
+class FigureWorker:
+    """Make diagnostic figures in a separate process.
+
+    The tracking only has to put the (2d) fields of a day on a queue; the
+    rendering happens in the background. The queue is bounded, so only a few
+    days are held in memory if the rendering is slower than the tracking.
+
+    The process is spawned rather than forked: threads that read the input
+    ahead may already be running, and forking a process with threads can
+    deadlock.
+    """
+
+    def __init__(self, latitude, longitude, region, output_dir="../figures", max_queued=2):
+        context = multiprocessing.get_context("spawn")
+        self.queue = context.Queue(maxsize=max_queued)
+        self.process = context.Process(
+            target=_render_figures,
+            args=(self.queue, latitude, longitude, region, output_dir),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, date, fluxes, output):
+        """Queue the figure for one day, given the tracking input and output."""
+        fields = {
+            "date": date,
+            "precip": fluxes["precip"].values.sum(axis=0),
+            "e_track": output["e_track"].values,
+            "s_track_upper_mean": output["s_track_upper"].values,
+            "s_track_lower_mean": output["s_track_lower"].values,
+            "fx_upper": fluxes["fx_upper"].values.mean(axis=0),
+            "fy_upper": fluxes["fy_upper"].values.mean(axis=0),
+            "fx_lower": fluxes["fx_lower"].values.mean(axis=0),
+            "fy_lower": fluxes["fy_lower"].values.mean(axis=0),
+        }
+        self._put(fields)
+
+    def _put(self, item):
+        """Put an item on the queue, without waiting forever for a dead worker."""
+        while True:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                self._check_alive()
+
+    def _check_alive(self):
+        if self.process.exitcode:
+            raise RuntimeError(
+                f"Figure worker stopped unexpectedly (exit code {self.process.exitcode})"
+            )
+
+    def close(self):
+        """Wait until all queued figures are finished."""
+        self._check_alive()
+        self._put(None)
+        self.process.join()
+        self._check_alive()
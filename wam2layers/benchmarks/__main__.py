@@ -0,0 +1,77 @@
+"""Run the WAM2layers benchmark suite.
+
+Examples:
+
+    python -m wam2layers.benchmarks
+    python -m wam2layers.benchmarks --grid regional-0.25 --only tracking_kernel
+    python -m wam2layers.benchmarks --save before.json
+    python -m wam2layers.benchmarks --compare before.json --check
+"""
+import argparse
+import json
+import sys
+
+from wam2layers.benchmarks.suite import BENCHMARKS, ENGINES, check_engines, run_benchmark
+from wam2layers.benchmarks.synthetic import GRIDS
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the WAM2layers benchmarks.")
+    parser.add_argument(
+        "--grid", nargs="+", default=["regional-1"], choices=list(GRIDS),
+        help="grid(s) to run the benchmarks on",
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip measuring peak memory use"
+    )
+    parser.add_argument("--save", help="save the results to this json file")
+    parser.add_argument("--compare", help="compare with results in this json file")
+    parser.add_argument(
+        "--check", action="store_true",
+        help="check the output of all engines against the numpy reference",
+    )
+    args = parser.parse_args(argv)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = {}
+    for grid in args.grid:
+        print(f"\n{grid}")
+        print(f"{'benchmark':<20}{'best [s]':>12}{'median [s]':>12}{'peak [MB]':>12}")
+        results[grid] = {}
+        for name in args.only or BENCHMARKS:
+            result = run_benchmark(name, grid, args.repeat, memory=not args.no_memory)
+            results[grid][name] = result
+
+            peak = result.get("peak_memory", float("nan")) / 1e6
+            line = f"{name:<20}{result['best']:>12.4f}{result['median']:>12.4f}{peak:>12.1f}"
+            if name in previous.get(grid, {}):
+                speedup = previous[grid][name]["best"] / result["best"]
+                line += f"  ({speedup:.2f}x vs. {args.compare})"
+            print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.check:
+        print(f"\nChecking engines against numpy reference: {', '.join(ENGINES)}")
+        failed = False
+        for grid in args.grid:
+            for name, result in check_engines(grid).items():
+                status = "ok" if result["ok"] else "FAILED"
+                print(f"{grid:<16}{name:<20}max rel. error {result['error']:.2e} {status}")
+                failed = failed or not result["ok"]
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
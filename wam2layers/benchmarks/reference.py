@@ -0,0 +1,341 @@
+"""Reference implementation of the flux preparation and tracking kernel.
+
+These are the original xarray-based functions of backtrack.py, one layer at
+a time, with the original helpers they use. They are superseded by
+prepare_fluxes and backtrack_layers, and are only kept as the independent
+"numpy" reference engine of the benchmark suite.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from wam2layers.preprocessing.preprocessing import get_grid_info
+
+
+def to_edges_zonal(fx, periodic_boundary=False):
+    """Define the horizontal fluxes over the east/west boundaries."""
+    fe = np.zeros_like(fx)
+    fe[:, :-1] = 0.5 * (fx[:, :-1] + fx[:, 1:])
+    if periodic_boundary:
+        fe[:, -1] = 0.5 * (fx[:, -1] + fx[:, 0])
+
+    # find out where the positive and negative fluxes are
+    f_pos = np.ones_like(fx)
+    f_pos[fe < 0] = 0
+    f_neg = f_pos - 1
+
+    # separate directions west-east (all positive numbers)
+    fe_we = fe * f_pos
+    fe_ew = fe * f_neg
+
+    # fluxes over the western boundary
+    fw_we = look_west(fe_we)
+    fw_ew = look_west(fe_ew)
+
+    return fe_we, fe_ew, fw_we, fw_ew
+
+
+def to_edges_meridional(fy):
+    """Define the horizontal fluxes over the north/south boundaries."""
+    fn = np.zeros_like(fy)
+    fn[1:, :] = 0.5 * (fy[:-1, :] + fy[1:, :])
+
+    # find out where the positive and negative fluxes are
+    fn_pos = np.ones_like(fn)
+    fn_pos[fn < 0] = 0  # invalid value encountered in less
+    fn_neg = fn_pos - 1
+
+    # separate directions south-north (all positive numbers)
+    fn_sn = fn * fn_pos
+    fn_ns = fn * fn_neg
+
+    # fluxes over the southern boundary
+    fs_sn = look_south(fn_sn)
+    fs_ns = look_south(fn_ns)
+
+    return fn_sn, fn_ns, fs_sn, fs_ns
+
+
+def look_north(array):
+    # Note: edges are reinserted at other end; but they're not used anyway
+    return np.roll(array, 1, axis=-2)
+
+
+def look_south(array):
+    # Note: edges are reinserted at other end; but they're not used anyway
+    return np.roll(array, -1, axis=-2)
+
+
+def look_east(array):
+    # Note: edges are reinserted at other end; but they're not used anyway
+    return np.roll(array, -1, axis=-1)
+
+
+def look_west(array):
+    # Note: edges are reinserted at other end; but they're not used anyway
+    return np.roll(array, 1, axis=-1)
+
+
+def split_vertical_flux(Kvf, fv):
+    f_downward = np.zeros_like(fv)
+    f_upward = np.zeros_like(fv)
+    f_downward[fv >= 0] = fv[fv >= 0]
+    f_upward[fv <= 0] = fv[fv <= 0]
+    f_upward = np.abs(f_upward)
+
+    # include the vertical dispersion
+    if Kvf != 0:
+        f_upward = (1.0 + Kvf) * f_upward
+        f_upward[fv >= 0] = fv[fv >= 0] * Kvf
+        f_downward = (1.0 + Kvf) * f_downward
+        f_downward[fv <= 0] = np.abs(fv[fv <= 0]) * Kvf
+
+    return f_downward, f_upward
+
+
+def convergence(fx, fy):
+    # Note: latitude decreasing, hence positive fy gradient is convergence
+    return np.gradient(fy, axis=-2) - np.gradient(fx, axis=-1)
+
+
+def change_units(fluxes, target_freq):
+    """Change units to m3.
+    Multiply by edge length to get flux in m3
+    Multiply by time to get accumulation instead of flux
+    Divide by density of water to go from kg to m3
+    """
+    density = 1000  # [kg/m3]
+    a, ly, lx = get_grid_info(fluxes)
+
+    total_seconds = pd.Timedelta(target_freq).total_seconds()
+    fluxes["fx_upper"] *= total_seconds / density * ly
+    fluxes["fx_lower"] *= total_seconds / density * ly
+    fluxes["fy_upper"] *= total_seconds / density * lx[None, :, None]
+    fluxes["fy_lower"] *= total_seconds / density * lx[None, :, None]
+    fluxes["evap"] *= a[None, :, None]
+    fluxes["precip"] *= a[None, :, None]
+
+    for variable in fluxes.data_vars:
+        fluxes[variable] = fluxes[variable].assign_attrs(units="m**3")
+
+
+def stabilize_fluxes(fluxes, states):
+    """Stabilize the outfluxes / influxes.
+
+    During the reduced timestep the water cannot move further than 1/x * the
+    gridcell, In other words at least x * the reduced timestep is needed to
+    cross a gridcell.
+    """
+    for level in ["upper", "lower"]:
+        fx = fluxes["fx_" + level]
+        fy = fluxes["fy_" + level]
+        s = states["s_" + level]
+
+        fx_abs = np.abs(fx)
+        fy_abs = np.abs(fy)
+        ft_abs = fx_abs + fy_abs
+
+        fx_corrected = 1/2 * fx_abs / ft_abs * s[:-1, :, :].values
+        fx_stable = np.minimum(fx_abs, fx_corrected)
+
+        fy_corrected = 1/2 * fy_abs / ft_abs * s[:-1, :, :].values
+        fy_stable = np.minimum(fy_abs, fy_corrected)
+
+        # Get rid of any nan values
+        fx_stable.fillna(0)
+        fy_stable.fillna(0)
+
+        # Re-instate the sign
+        fluxes["fx_"+ level] = np.sign(fx) * fx_stable
+        fluxes["fy_"+ level] = np.sign(fy) * fy_stable
+
+
+def calculate_fv(fluxes, states, kvf, periodic):
+    """Calculate the vertical fluxes.
+
+    Note: fluxes are given at temporal midpoints between states.
+    """
+    s_total = states.s_upper + states.s_lower
+    s_rel_upper = (states.s_upper / s_total).interp(time=fluxes.time)
+    s_rel_lower = (states.s_lower / s_total).interp(time=fluxes.time)
+
+    tendency_upper = convergence(fluxes.fx_upper, fluxes.fy_upper) - fluxes.precip.values * s_rel_upper
+    tendency_lower = convergence(fluxes.fx_lower, fluxes.fy_lower) - fluxes.precip.values * s_rel_lower + fluxes.evap
+
+    residual_upper = states.s_upper.diff("time").values - tendency_upper
+    residual_lower = states.s_lower.diff("time").values - tendency_lower
+
+    # compute the resulting vertical moisture flux; the vertical velocity so
+    # that the new residual_lower/s_lower = residual_upper/s_upper (positive downward)
+    fv = s_rel_lower * (residual_upper + residual_lower) - residual_lower
+
+    # stabilize the outfluxes / influxes; during the reduced timestep the
+    # vertical flux can maximally empty/fill 1/x of the top or down storage
+    stab = 1.0 / (kvf + 1.0)
+    flux_limit = np.minimum(states.s_upper, states.s_lower).interp(time=fluxes.time)
+    fv_stable = np.minimum(np.abs(fv), stab * flux_limit)
+
+    # Reinstate the sign
+    return np.sign(fv) * fv_stable
+
+
+def backtrack_two_layers(
+    timesteps,
+    ntime,
+    s_track_upper,
+    s_track_lower,
+    region,
+    kvf,
+    subdaily=None,
+):
+    """Track moisture backward in time over one day, one layer at a time.
+
+    Timesteps yields (t, Timestep) backward in time, for t in range(ntime).
+    If subdaily is given (see wam2layers.tracking.io.SubdailyOutput), it is
+    updated after every time step, so it can write sub-daily output.
+    """
+    # Allocate arrays for daily accumulations
+    nlat, nlon = s_track_upper.shape
+
+    s_track_upper_mean = np.zeros((nlat, nlon))
+    s_track_lower_mean = np.zeros((nlat, nlon))
+    e_track = np.zeros((nlat, nlon))
+
+    north_loss = np.zeros(nlon)
+    south_loss = np.zeros(nlon)
+    east_loss = np.zeros(nlat)
+    west_loss = np.zeros(nlat)
+
+    # Sa calculation backward in time
+    for t, step in timesteps:
+        P_region = region * step.precip
+        s_total = step.s_upper_next + step.s_lower_next
+
+        # separate the direction of the vertical flux and make it absolute
+        f_downward, f_upward = split_vertical_flux(kvf, step.f_vert)
+
+        # Determine horizontal fluxes over the grid-cell boundaries
+        f_e_lower_we, f_e_lower_ew, f_w_lower_we, f_w_lower_ew = to_edges_zonal(
+            step.fx_lower
+        )
+        f_e_upper_we, f_e_upper_ew, f_w_upper_we, f_w_upper_ew = to_edges_zonal(
+            step.fx_upper
+        )
+
+        (
+            fy_n_lower_sn,
+            fy_n_lower_ns,
+            fy_s_lower_sn,
+            fy_s_lower_ns,
+        ) = to_edges_meridional(step.fy_lower)
+        (
+            fy_n_upper_sn,
+            fy_n_upper_ns,
+            fy_s_upper_sn,
+            fy_s_upper_ns,
+        ) = to_edges_meridional(step.fy_upper)
+
+        # Short name for often used expressions
+        s_track_relative_lower = (
+            s_track_lower / step.s_lower_next
+        )  # fraction of tracked relative to total moisture
+        s_track_relative_upper = s_track_upper / step.s_upper_next
+        inner = np.s_[1:-1, 1:-1]
+
+        # Actual tracking (note: backtracking, all terms have been negated)
+        s_track_lower[inner] += (
+            + f_e_lower_we * look_east(s_track_relative_lower)
+            + f_w_lower_ew * look_west(s_track_relative_lower)
+            + fy_n_lower_sn * look_north(s_track_relative_lower)
+            + fy_s_lower_ns * look_south(s_track_relative_lower)
+            + f_upward * s_track_relative_upper
+            - f_downward * s_track_relative_lower
+            - fy_s_lower_sn * s_track_relative_lower
+            - fy_n_lower_ns * s_track_relative_lower
+            - f_e_lower_ew * s_track_relative_lower
+            - f_w_lower_we * s_track_relative_lower
+            + P_region * (step.s_lower_next / s_total)
+            - step.evap * s_track_relative_lower
+        )[inner]
+
+        s_track_upper[inner] += (
+            + f_e_upper_we * look_east(s_track_relative_upper)
+            + f_w_upper_ew * look_west(s_track_relative_upper)
+            + fy_n_upper_sn * look_north(s_track_relative_upper)
+            + fy_s_upper_ns * look_south(s_track_relative_upper)
+            + f_downward * s_track_relative_lower
+            - f_upward * s_track_relative_upper
+            - fy_s_upper_sn * s_track_relative_upper
+            - fy_n_upper_ns * s_track_relative_upper
+            - f_w_upper_we * s_track_relative_upper
+            - f_e_upper_ew * s_track_relative_upper
+            + P_region * (step.s_upper_next / s_total)
+        )[inner]
+
+        # down and top: redistribute unaccounted water that is otherwise lost from the sytem
+        lower_to_upper = np.maximum(0, s_track_lower - step.s_lower)
+        upper_to_lower = np.maximum(0, s_track_upper - step.s_upper)
+        s_track_lower[inner] = (s_track_lower - lower_to_upper + upper_to_lower)[inner]
+        s_track_upper[inner] = (s_track_upper - upper_to_lower + lower_to_upper)[inner]
+
+        # compute tracked evaporation
+        e_step = step.evap * (s_track_lower / step.s_lower_next)
+        e_track += e_step
+
+        # losses to the north and south
+        north_step = (
+            fy_n_upper_ns * s_track_relative_upper
+            + fy_n_lower_ns * s_track_relative_lower
+        )[1, :]
+        north_loss += north_step
+
+        south_step = (
+            fy_s_upper_sn * s_track_relative_upper
+            + fy_s_lower_sn * s_track_relative_lower
+        )[-2, :]
+        south_loss += south_step
+
+        east_step = (
+            f_e_upper_ew * s_track_relative_upper
+            + f_e_lower_ew * s_track_relative_lower
+        )[:, -2]
+        east_loss += east_step
+
+        west_step = (
+            f_w_upper_we * s_track_relative_upper
+            + f_w_lower_we * s_track_relative_lower
+        )[:, 1]
+        west_loss += west_step
+
+        # Aggregate daily accumulations for calculating the daily means
+        s_track_lower_mean += s_track_lower / ntime
+        s_track_upper_mean += s_track_upper / ntime
+
+        if subdaily is not None:
+            subdaily.update(
+                t,
+                s_track_upper,
+                s_track_lower,
+                e_step,
+                north_step,
+                south_step,
+                east_step,
+                west_step,
+            )
+
+    # Pack processed data into new dataset
+    ds = xr.Dataset(
+        {
+            # Keep last state for a restart
+            "s_track_upper_restart": (["lat", "lon"],s_track_upper),
+            "s_track_lower_restart": (["lat", "lon"], s_track_lower),
+            "s_track_upper": (["lat", "lon"], s_track_upper_mean),
+            "s_track_lower": (["lat", "lon"], s_track_lower_mean),
+            "e_track": (["lat", "lon"], e_track),
+            "north_loss": (["lon"], north_loss),
+            "south_loss": (["lon"], south_loss),
+            "east_loss": (["lat"], east_loss),
+            "west_loss": (["lat"],west_loss),
+        }
+    )
+    return (s_track_upper, s_track_lower, ds)
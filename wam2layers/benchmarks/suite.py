@@ -0,0 +1,279 @@
+"""Benchmarks for the most expensive parts of WAM2layers.
+
+Each benchmark is a pair of functions: `prepare(grid)` builds the input data
+(not timed) and `run(*args)` does the work that is timed. Benchmarks are
+registered in the BENCHMARKS dictionary.
+
+Engines are complete implementations of one tracking day (flux preparation +
+backtracking). They are registered in ENGINES and their output is checked
+against the "numpy" reference engine by `check_engines`.
+"""
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from wam2layers.benchmarks.synthetic import (
+    make_grid,
+    synthetic_era5_modellevels,
+    synthetic_fluxes_storages,
+    synthetic_region,
+)
+from wam2layers.benchmarks.reference import (
+    backtrack_two_layers,
+    calculate_fv,
+    change_units,
+    stabilize_fluxes,
+)
+from wam2layers.preprocessing import preprocess_era5_modellevels
+from wam2layers.preprocessing.preprocessing import interpolate, sortby_ndarray
+from wam2layers.tracking.backtrack import (
+    backtrack,
+    backtrack_timesteps,
+    backtrack_timesteps_implicit,
+    prepare_fluxes,
+    resample,
+    timesteps,
+)
+
+ENGINES = {}
+
+target_frequency = "15min"
+kvf = 3
+
+
+def engine(name):
+    """Register an engine that tracks one day of preprocessed data."""
+
+    def register(func):
+        ENGINES[name] = func
+        return func
+
+    return register
+
+
+def prepared_fluxes(grid):
+    """Return synthetic fluxes and states, ready for the tracking kernel."""
+    ds = synthetic_fluxes_storages(grid=grid)
+    fluxes, states = resample(ds, target_frequency)
+    prepare_fluxes(fluxes, states, target_frequency, kvf)
+    return fluxes, states
+
+
+def _prepare_resample(grid):
+    return synthetic_fluxes_storages(grid=grid), target_frequency
+
+
+def _prepare_resampled(grid):
+    ds = synthetic_fluxes_storages(grid=grid)
+    return resample(ds, target_frequency)
+
+
+def _prepare_fluxes(grid):
+    ds = synthetic_fluxes_storages(grid=grid)
+    fluxes, states = resample(ds, target_frequency)
+    change_units(fluxes, target_frequency)
+    return fluxes, states
+
+
+def _prepare_calculate_fv(grid):
+    fluxes, states = _prepare_fluxes(grid)
+    stabilize_fluxes(fluxes, states)
+    return fluxes, states
+
+
+def _prepare_tracking(grid):
+    fluxes, states = prepared_fluxes(grid)
+    nlat, nlon = fluxes["fx_upper"].shape[1:]
+    return (
+        fluxes,
+        states,
+        np.zeros((nlat, nlon)),
+        np.zeros((nlat, nlon)),
+        synthetic_region(grid),
+        kvf,
+    )
+
+
+def _prepare_tracking_implicit(grid):
+    ds = synthetic_fluxes_storages(grid=grid)
+    fluxes, states = resample(ds, "1h")
+    prepare_fluxes(fluxes, states, "1h", kvf, stabilize=False)
+    region = synthetic_region(grid)
+    return (
+        timesteps(fluxes, states),
+        fluxes.time.size,
+        np.zeros_like(region),
+        np.zeros_like(region),
+        region,
+        kvf,
+    )
+
+
+def _prepare_levels(grid):
+    """Return 4d pressure and another 4d field, plus a 3d target pressure."""
+    latitude, longitude = make_grid(grid)
+    rng = np.random.default_rng(0)
+    shape = (25, 20, latitude.size, longitude.size)
+    pressure = np.sort(rng.uniform(0, 100000, size=shape), axis=1)
+    field = rng.uniform(0, 0.02, size=shape)
+    target = 0.5 * (pressure[:, 5] + pressure[:, 15])
+    return pressure, field, target
+
+
+_era5_input = {}
+
+
+def _prepare_preprocess(grid):
+    """Write synthetic ERA5 input once per grid, for the duration of the run."""
+    if grid not in _era5_input:
+        directory = tempfile.TemporaryDirectory()
+        config = synthetic_era5_modellevels(Path(directory.name), grid=grid)
+        _era5_input[grid] = (directory, config)
+    _, config = _era5_input[grid]
+    return pd.Timestamp("2021-07-14"), config
+
+
+BENCHMARKS = {
+    "resample": (_prepare_resample, resample),
+    "change_units": (
+        _prepare_fluxes,
+        lambda fluxes, states: change_units(fluxes, target_frequency),
+    ),
+    "stabilize_fluxes": (_prepare_fluxes, stabilize_fluxes),
+    "calculate_fv": (
+        _prepare_calculate_fv,
+        lambda fluxes, states: calculate_fv(fluxes, states, kvf=kvf, periodic=False),
+    ),
+    "prepare_fluxes": (
+        _prepare_resampled,
+        lambda fluxes, states: prepare_fluxes(fluxes, states, target_frequency, kvf),
+    ),
+    "tracking_kernel": (_prepare_tracking, backtrack),
+    "tracking_implicit_1h": (_prepare_tracking_implicit, backtrack_timesteps_implicit),
+    "interpolate": (
+        _prepare_levels,
+        lambda pressure, field, target: interpolate(target, pressure, field),
+    ),
+    "interpolate_sampled": (
+        _prepare_levels,
+        lambda pressure, field, target: interpolate(
+            target, pressure, field, validation="sampled"
+        ),
+    ),
+    "sortby_ndarray": (
+        _prepare_levels,
+        lambda pressure, field, target: sortby_ndarray(field, pressure, axis=1),
+    ),
+    "preprocess_day": (_prepare_preprocess, preprocess_era5_modellevels.preprocess_day),
+}
+
+
+def run_benchmark(name, grid, repeat=3, memory=True):
+    """Time a benchmark and optionally measure its peak memory use.
+
+    Returns a dictionary with the best and median wall time in seconds and the
+    peak memory allocated during a single run in bytes.
+    """
+    prepare, run = BENCHMARKS[name]
+    timings = []
+    for _ in range(repeat):
+        args = prepare(grid)
+        tic = time.perf_counter()
+        run(*args)
+        timings.append(time.perf_counter() - tic)
+
+    result = {"best": min(timings), "median": float(np.median(timings))}
+
+    if memory:
+        args = prepare(grid)
+        tracemalloc.start()
+        run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_memory"] = peak
+    return result
+
+
+@engine("numpy")
+def track_day_numpy(ds, region, s_track_upper, s_track_lower):
+    """Reference engine: the original implementation (see reference.py)."""
+    fluxes, states = resample(ds, target_frequency)
+    change_units(fluxes, target_frequency)
+    stabilize_fluxes(fluxes, states)
+    fluxes["f_vert"] = calculate_fv(fluxes, states, kvf=kvf, periodic=False)
+    _, _, output = backtrack_two_layers(
+        timesteps(fluxes, states),
+        fluxes.time.size,
+        s_track_upper,
+        s_track_lower,
+        region,
+        kvf,
+    )
+    return output
+
+
+@engine("fused")
+def track_day_fused(ds, region, s_track_upper, s_track_lower):
+    """Flux preparation with prepare_fluxes instead of the xarray functions."""
+    fluxes, states = resample(ds, target_frequency)
+    prepare_fluxes(fluxes, states, target_frequency, kvf)
+    _, _, output = backtrack(fluxes, states, s_track_upper, s_track_lower, region, kvf)
+    return output
+
+
+@engine("streaming")
+def track_day_streaming(ds, region, s_track_upper, s_track_lower):
+    """Read the input just in time from disk with TimestepStream."""
+    from wam2layers.tracking.streaming import TimestepStream
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "fluxes_storages.nc"
+        ds.to_netcdf(path)
+        stream = TimestepStream(path, target_frequency, kvf)
+        _, _, output = backtrack_timesteps(
+            stream, stream.ntime, s_track_upper, s_track_lower, region, kvf
+        )
+        stream.close()
+    return output
+
+
+def check_engines(grid="regional-1", days=2, rtol=1e-6, engines=None):
+    """Compare the output of all engines with the numpy reference engine.
+
+    Tracks a few synthetic days backward in time with every engine. Returns a
+    dictionary with, for each engine, the maximum difference relative to the
+    largest absolute value of each output variable and whether this is within
+    `rtol`.
+    """
+    region = synthetic_region(grid)
+    days = [synthetic_fluxes_storages(grid=grid, seed=i) for i in range(days)]
+
+    def track(func):
+        s_track_upper = np.zeros_like(region)
+        s_track_lower = np.zeros_like(region)
+        outputs = []
+        for ds in reversed(days):
+            output = func(ds, region, s_track_upper, s_track_lower)
+            s_track_upper = output["s_track_upper_restart"].values.copy()
+            s_track_lower = output["s_track_lower_restart"].values.copy()
+            outputs.append(output)
+        return outputs
+
+    reference = track(ENGINES["numpy"])
+
+    results = {}
+    for name in engines or ENGINES:
+        if name == "numpy":
+            continue
+        error = 0.0
+        for expected, actual in zip(reference, track(ENGINES[name])):
+            for variable in expected.data_vars:
+                scale = np.abs(expected[variable].values).max() or 1.0
+                diff = np.abs(actual[variable].values - expected[variable].values)
+                error = max(error, diff.max() / scale)
+        results[name] = {"error": error, "ok": error <= rtol}
+    return results
@@ -0,0 +1,260 @@
+"""Synthetic input data for benchmarking and testing WAM2layers.
+
+The generators in this module produce data that looks like the real thing
+(ERA5 input files and one day of ``*_fluxes_storages.nc``), but can be made
+offline, for any grid size and in a reproducible way.
+
+The flow field is a zonal jet with a vortex that drifts eastward during the
+day, so that fluxes change sign and direction in space and time. Storages are
+always positive; precipitation is concentrated around the vortex and
+evaporation is small and smooth.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from wam2layers.preprocessing.preprocessing import get_grid_info
+
+density_water = 1000  # [kg/m3]
+
+# Predefined grids: resolution in degrees and (south, north, west, east) bounds
+GRIDS = {
+    "regional-1": (1.0, (30, 60, -50, 30)),  # 31 x 81
+    "regional-0.25": (0.25, (30, 60, -50, 30)),  # 121 x 321, like the flood case
+    "global-1": (1.0, (-90, 90, -180, 179)),  # 181 x 360
+    "global-0.25": (0.25, (-90, 90, -180, 179.75)),  # 721 x 1440
+}
+
+# Pressure levels in hPa
+PRESSURELEVELS = [200, 300, 400, 500, 600, 700, 750, 800, 850, 900, 925, 950, 1000]
+
+# Subset of ERA5 model levels, as used in cases/era5_2021.yaml
+MODELLEVELS = [
+    20, 40, 60, 80, 90, 95, 100, 105, 110, 115, 120,
+    123, 125, 128, 130, 131, 132, 133, 134, 135, 136, 137,
+]
+
+
+def make_grid(grid="regional-1"):
+    """Return latitude (decreasing, like ERA5) and longitude for a grid.
+
+    Grid can be the name of one of the predefined GRIDS, or a tuple of
+    (resolution, (south, north, west, east)).
+    """
+    resolution, (south, north, west, east) = GRIDS.get(grid, grid)
+    latitude = np.arange(north, south - resolution / 2, -resolution)
+    longitude = np.arange(west, east + resolution / 2, resolution)
+    return latitude, longitude
+
+
+def _flow(latitude, longitude, time, seed):
+    """Return wind components, column water and precipitation on the grid.
+
+    All output has dimensions (time, lat, lon); column water in kg/m2, wind in
+    m/s and precipitation in m (hourly accumulation).
+    """
+    rng = np.random.default_rng(seed)
+    lat = latitude[None, :, None]
+    lon = longitude[None, None, :]
+    hours = np.asarray(time - time[0], dtype="timedelta64[s]").astype(float) / 3600
+    hours = hours[:, None, None]
+
+    # Vortex center drifting eastward; random offset per realisation
+    lat0 = latitude.mean() + rng.uniform(-2, 2)
+    lon0 = longitude.mean() + rng.uniform(-5, 5) + 0.5 * hours
+    radius = 0.15 * (longitude.max() - longitude.min()) + 1
+    r2 = ((lat - lat0) ** 2 + ((lon - lon0) * np.cos(np.deg2rad(lat))) ** 2) / radius**2
+    vortex = np.exp(-r2)
+
+    # Solid-body-like rotation inside the vortex plus a zonal jet
+    speed = 15 * vortex
+    u = 8 * np.cos(np.deg2rad(lat)) - speed * (lat - lat0) / radius
+    v = speed * (lon - lon0) / radius * np.cos(np.deg2rad(lat))
+
+    # Column water: moist tropics, dry poles, moist vortex core, small noise
+    noise = rng.uniform(0.95, 1.05, size=(1, latitude.size, longitude.size))
+    cw = (5 + 35 * np.cos(np.deg2rad(lat)) ** 2 + 10 * vortex) * noise
+    cw = cw * (1 + 0.05 * np.sin(2 * np.pi * hours / 24))
+
+    precip = 2e-3 * vortex**2 * (1 + 0.5 * np.sin(np.pi * hours / 12) ** 2)
+    return u, v, cw, precip
+
+
+def synthetic_fluxes_storages(date="2021-07-14", grid="regional-1", seed=0):
+    """Generate one day of preprocessed data, like ``*_fluxes_storages.nc``.
+
+    The output has hourly data from midnight to midnight of the next day (25
+    time steps), with fluxes in kg m-1 s-1, states in m3, and precipitation
+    and evaporation in m (hourly accumulations), just like the output of
+    preprocess_era5_modellevels.py.
+    """
+    latitude, longitude = make_grid(grid)
+    time = pd.date_range(date, periods=25, freq="h")
+    u, v, cw, precip = _flow(latitude, longitude, time.values, seed)
+
+    coords = {"time": time, "latitude": latitude, "longitude": longitude}
+    dims = ["time", "latitude", "longitude"]
+    ds = xr.Dataset(coords=coords)
+    a_gridcell, _, _ = get_grid_info(ds)
+
+    # Lower layer holds most moisture, upper layer has stronger winds
+    frac_lower = 0.7 + 0.05 * np.cos(np.deg2rad(latitude))[None, :, None]
+    cw_lower = cw * frac_lower
+    cw_upper = cw * (1 - frac_lower)
+    area = a_gridcell[None, :, None]
+
+    evap = 1e-4 * (0.5 + np.cos(np.deg2rad(latitude)) ** 2)[None, :, None]
+    evap = np.broadcast_to(evap, precip.shape)
+
+    variables = {
+        "fx_upper": 1.5 * u * cw_upper,
+        "fy_upper": 1.5 * v * cw_upper,
+        "fx_lower": u * cw_lower,
+        "fy_lower": v * cw_lower,
+        "s_upper": cw_upper * area / density_water,
+        "s_lower": cw_lower * area / density_water,
+        "evap": evap,
+        "precip": precip,
+    }
+    for name, values in variables.items():
+        ds[name] = (dims, np.array(values, dtype="float64"))
+    return ds
+
+
+def synthetic_case(directory, start="2021-07-13", end="2021-07-16", grid="regional-1"):
+    """Write synthetic preprocessed data for a range of days to `directory`.
+
+    Each day gets its own seed, so the flow differs from day to day. A region
+    file is written alongside the preprocessed data. Returns a
+    config dictionary with the settings that the tracking needs to run on it.
+    """
+    dates = pd.date_range(start, end, freq="d", inclusive="left")
+    for i, date in enumerate(dates):
+        ds = synthetic_fluxes_storages(date, grid, seed=i)
+        ds.to_netcdf(directory / f"{date.strftime('%Y-%m-%d')}_fluxes_storages.nc")
+
+    latitude, longitude = make_grid(grid)
+    region = xr.DataArray(
+        synthetic_region(grid),
+        coords={"latitude": latitude, "longitude": longitude},
+        dims=["latitude", "longitude"],
+    )
+    region.to_dataset(name="region_flood").to_netcdf(directory / "region.nc")
+
+    return {
+        "preprocessed_data_folder": str(directory),
+        "region": str(directory / "region.nc"),
+        "track_start_date": dates[0].strftime("%Y%m%d"),
+        "track_end_date": (dates[-1] + pd.Timedelta(days=1)).strftime("%Y%m%d"),
+        "event_start_date": dates[-1].strftime("%Y%m%d"),
+        "event_end_date": dates[-1].strftime("%Y%m%d"),
+        "target_frequency": "15min",
+        "periodic_boundary": False,
+        "kvf": 3,
+        "restart": False,
+    }
+
+
+def synthetic_region(grid="regional-1"):
+    """Return a region mask (1 inside, 0 outside) around the domain center."""
+    latitude, longitude = make_grid(grid)
+    lat = latitude[:, None]
+    lon = longitude[None, :]
+    nlat, nlon = latitude.size, longitude.size
+    lat_c, lon_c = latitude[nlat // 2], longitude[nlon // 2]
+    half_width = max(3 * abs(latitude[0] - latitude[1]), 2.0)
+    region = (abs(lat - lat_c) <= half_width) & (abs(lon - lon_c) <= 2 * half_width)
+    return region.astype(float)
+
+
+def _write_fields(directory, template, fields, coords):
+    """Write each field to its own file, named like the ERA5 input files."""
+    for variable, values in fields.items():
+        da = xr.DataArray(values.astype("float32"), coords=coords, dims=list(coords))
+        da.to_dataset(name=variable).to_netcdf(directory / template.format(variable))
+
+
+def _surface_fields(latitude, cw, precip):
+    """Return ERA5-like surface fields, with ERA5 units and sign conventions."""
+    sp = 101325.0 - 2000 * (cw - cw.mean()) / cw.std()
+    return {
+        "sp": sp,
+        "cp": 0.4 * precip,
+        "lsp": 0.6 * precip,
+        # ERA5 convention: evaporation negative, condensation positive
+        "e": np.broadcast_to(
+            -1e-4 * (0.5 + np.cos(np.deg2rad(latitude)) ** 2)[None, :, None], sp.shape
+        ),
+        "tcw": 1.02 * cw,
+    }
+
+
+def synthetic_era5_modellevels(
+    directory, date="2021-07-14", grid="regional-1", seed=0, modellevels=MODELLEVELS
+):
+    """Write ERA5-like model level and surface input files for one day.
+
+    The files are named like the ones read by preprocess_era5_modellevels.py
+    and written to `directory`. Returns a config dictionary that can be used to
+    preprocess the synthetic data.
+    """
+    latitude, longitude = make_grid(grid)
+    time = pd.date_range(date, periods=25, freq="h")
+    u, v, cw, precip = _flow(latitude, longitude, time.values, seed)
+
+    # Distribute column water over the levels: q increases towards the surface
+    levels = np.array(modellevels)
+    shape = (1, len(levels), 1, 1)
+    weight = np.exp((levels - 137) / 15).reshape(shape)
+    q = 1e-2 * weight * (cw / cw.max())[:, None]
+
+    # Wind increases with height
+    shear = (1 + 2 * (137 - levels) / 137).reshape(shape)
+
+    coords = {"time": time, "lev": levels, "latitude": latitude, "longitude": longitude}
+    fields = {"u": u[:, None] * shear, "v": v[:, None] * shear, "q": q}
+    _write_fields(directory, "FloodCase_202107_ml_{}.nc", fields, coords)
+
+    coords = {"time": time, "latitude": latitude, "longitude": longitude}
+    fields = _surface_fields(latitude, cw, precip)
+    _write_fields(directory, "FloodCase_202107_{}.nc", fields, coords)
+
+    return {
+        "input_folder": str(directory),
+        "modellevels": list(modellevels),
+        "vertical_integral_available": True,
+    }
+
+
+def synthetic_era5_pressurelevels(
+    directory, date="2013-05-31", grid="regional-1", seed=0, levels=PRESSURELEVELS
+):
+    """Write ERA5-like pressure level and surface input files for one day.
+
+    The files are named like the ones read by preprocess_era5.py and written
+    to `directory`. Returns a config dictionary that can be used to preprocess
+    the synthetic data.
+    """
+    latitude, longitude = make_grid(grid)
+    time = pd.date_range(date, periods=25, freq="h")
+    u, v, cw, precip = _flow(latitude, longitude, time.values, seed)
+
+    # Distribute column water over the levels (in hPa, like ERA5)
+    levels = np.array(levels)
+    shape = (1, len(levels), 1, 1)
+    weight = np.exp((levels - 1000) / 150).reshape(shape)
+    q = 1.5e-2 * weight * (cw / cw.max())[:, None]
+    shear = (1 + 2 * (1000 - levels) / 1000).reshape(shape)
+
+    coords = {"time": time, "level": levels, "latitude": latitude, "longitude": longitude}
+    fields = {"u": u[:, None] * shear, "v": v[:, None] * shear, "q": q}
+    _write_fields(directory, "FloodCase_201305_{}.nc", fields, coords)
+
+    coords = {"time": time, "latitude": latitude, "longitude": longitude}
+    fields = _surface_fields(latitude, cw, precip)
+    fields["d2m"] = 275 + 15 * cw / cw.max()
+    fields["u10"] = 0.5 * u
+    fields["v10"] = 0.5 * v
+    _write_fields(directory, "FloodCase_201305_{}.nc", fields, coords)
+
+    return {"input_folder": str(directory)}
@@ -0,0 +1,187 @@
+"""Command line interface for WAM2layers.
+
+Examples:
+
+    wam2layers backtrack cases/era5_2021.yaml
+    wam2layers ensemble cases/era5_2021.yaml
+    wam2layers bidirectional cases/era5_2021.yaml
+    wam2layers regions cases/era5_2021.yaml regions.nc --variable region
+    wam2layers backtrack-parallel cases/era5_2021.yaml
+    wam2layers preprocess era5-modellevels cases/era5_2021.yaml
+    wam2layers aggregate cases/era5_2021.yaml --window 20210713 20210715
+    wam2layers attribute cases/era5_2021.yaml countries.nc --labels-variable country
+    wam2layers plan cases/era5_2021.yaml --memory 16
+"""
+import argparse
+
+from wam2layers.preprocessing import PREPROCESSORS
+
+
+def backtrack(args):
+    from wam2layers.tracking.backtrack import run_experiment
+
+    run_experiment(args.config_file)
+
+
+def ensemble(args):
+    from wam2layers.tracking.ensemble import run_ensemble
+
+    run_ensemble(args.config_file)
+
+
+def bidirectional(args):
+    from wam2layers.tracking.bidirectional import run_bidirectional
+
+    run_bidirectional(args.config_file)
+
+
+def regions(args):
+    from wam2layers.tracking.operators import run_regions
+
+    run_regions(args.config_file, args.regions_file, variable=args.variable)
+
+
+def backtrack_parallel(args):
+    from wam2layers.tracking.timeparallel import run_time_parallel
+
+    run_time_parallel(args.config_file)
+
+
+def preprocess(args):
+    from importlib import import_module
+
+    import_module(PREPROCESSORS[args.source]).run_preprocessing(args.config_file)
+
+
+def aggregate(args):
+    from wam2layers.analysis.aggregate import run_aggregation
+
+    run_aggregation(
+        args.config_file,
+        windows=args.window,
+        percentiles=args.percentiles,
+        output=args.output,
+        workers=args.workers,
+    )
+
+
+def attribute(args):
+    from wam2layers.analysis.attribution import run_attribution
+
+    run_attribution(
+        args.config_file,
+        args.labels_file,
+        labels_variable=args.labels_variable,
+        variables=args.variables,
+        output=args.output,
+        workers=args.workers,
+    )
+
+
+def plan(args):
+    from wam2layers.plan import run_plan
+
+    run_plan(args.config_file, memory=args.memory, cpus=args.cpus, source=args.source)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="wam2layers", description="WAM2layers atmospheric moisture tracking."
+    )
+    subparsers = parser.add_subparsers(required=True, metavar="command")
+
+    parser_backtrack = subparsers.add_parser(
+        "backtrack", help="run a backtracking experiment"
+    )
+    parser_backtrack.add_argument("config_file", help="path to the case configuration")
+    parser_backtrack.set_defaults(func=backtrack)
+
+    parser_ensemble = subparsers.add_parser(
+        "ensemble", help="backtrack all events listed in the configuration together"
+    )
+    parser_ensemble.add_argument("config_file", help="path to the case configuration")
+    parser_ensemble.set_defaults(func=ensemble)
+
+    parser_bidirectional = subparsers.add_parser(
+        "bidirectional", help="track forward and backward in time, reading each day once"
+    )
+    parser_bidirectional.add_argument("config_file", help="path to the case configuration")
+    parser_bidirectional.set_defaults(func=bidirectional)
+
+    parser_regions = subparsers.add_parser(
+        "regions", help="backtrack many regions at once, with saved transport operators"
+    )
+    parser_regions.add_argument("config_file", help="path to the case configuration")
+    parser_regions.add_argument("regions_file", help="netcdf file with the region masks")
+    parser_regions.add_argument(
+        "--variable", default="region",
+        help="name of the masks in the file, with dimensions (region, latitude, longitude)",
+    )
+    parser_regions.set_defaults(func=regions)
+
+    parser_parallel = subparsers.add_parser(
+        "backtrack-parallel", help="backtrack the segments of the tracking period in parallel"
+    )
+    parser_parallel.add_argument("config_file", help="path to the case configuration")
+    parser_parallel.set_defaults(func=backtrack_parallel)
+
+    parser_preprocess = subparsers.add_parser(
+        "preprocess", help="preprocess input data for the tracking"
+    )
+    parser_preprocess.add_argument("source", choices=list(PREPROCESSORS))
+    parser_preprocess.add_argument("config_file", help="path to the case configuration")
+    parser_preprocess.set_defaults(func=preprocess)
+
+    parser_aggregate = subparsers.add_parser(
+        "aggregate", help="aggregate the daily output of a run over date windows"
+    )
+    parser_aggregate.add_argument("config_file", help="path to the case configuration")
+    parser_aggregate.add_argument(
+        "--window", nargs=2, action="append", metavar=("FIRST", "LAST"),
+        help="first and last date (YYYYMMDD) of a window; can be repeated "
+        "(default: the whole tracking period)",
+    )
+    parser_aggregate.add_argument(
+        "--percentiles", nargs="+", type=float, default=[],
+        help="per-cell percentiles to compute",
+    )
+    parser_aggregate.add_argument("--output", help="output file (default: aggregate.nc in the output folder)")
+    parser_aggregate.add_argument("--workers", type=int, default=4, help="number of files to read in parallel")
+    parser_aggregate.set_defaults(func=aggregate)
+
+    parser_attribute = subparsers.add_parser(
+        "attribute", help="total tracked moisture per labelled area for each day"
+    )
+    parser_attribute.add_argument("config_file", help="path to the case configuration")
+    parser_attribute.add_argument("labels_file", help="netcdf file with an integer label raster")
+    parser_attribute.add_argument(
+        "--labels-variable", default="labels", help="name of the labels in the file"
+    )
+    parser_attribute.add_argument(
+        "--variables", nargs="+", default=["e_track"],
+        help="output variables to attribute (default: e_track)",
+    )
+    parser_attribute.add_argument("--output", help="output file (default: attribution.nc in the output folder)")
+    parser_attribute.add_argument("--workers", type=int, default=4, help="number of files to read in parallel")
+    parser_attribute.set_defaults(func=attribute)
+
+    parser_plan = subparsers.add_parser(
+        "plan", help="estimate memory use and run time and recommend settings (dry run)"
+    )
+    parser_plan.add_argument("config_file", help="path to the case configuration")
+    parser_plan.add_argument(
+        "--memory", type=float, help="memory available in GB (default: all of this machine)"
+    )
+    parser_plan.add_argument("--cpus", type=int, help="number of cpus (default: all of this machine)")
+    parser_plan.add_argument(
+        "--source", choices=list(PREPROCESSORS),
+        help="estimate the preprocessing of this input as well",
+    )
+    parser_plan.set_defaults(func=plan)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
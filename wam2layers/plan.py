@@ -0,0 +1,294 @@
+"""Estimate the memory use and run time of a case before running it.
+
+The planner only reads the case configuration and the metadata (dimensions
+and data types) of the preprocessed data, or of the input data if the days
+still have to be preprocessed. From these, it computes the size of the arrays
+that each stage holds for a day:
+
+- preprocess: the 4d input fields and the cumulative integrals
+- read: one day of preprocessed data
+- prepare: the resampled fluxes and states (resample + prepare_fluxes)
+- track: the 2d temporaries of the tracking kernel
+- stream: the time slices held when streaming (see `read_ahead`)
+
+It also reports the memory of the day cache of a bidirectional run, which
+holds the prepared days of the whole period.
+
+The run time of each stage is estimated from seconds per unit of work (grid
+cell x time step x level or layer), calibrated by running a few of the
+benchmarks (see wam2layers.benchmarks) on a small synthetic grid on the
+current machine. Both are estimates: the memory use excludes the Python and
+library overhead, and the calibration assumes that the run time grows
+linearly with the size of the data.
+
+Finally, the planner recommends the settings for the parallel and streaming
+modes that fit in the available memory.
+
+Example:
+
+    wam2layers plan cases/era5_2021.yaml --memory 16
+"""
+import os
+from importlib import import_module
+from pathlib import Path
+
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.preprocessing import PREPROCESSORS
+from wam2layers.preprocessing.preprocessing import get_bounding_box, select_bounding_box
+from wam2layers.tracking.backtrack import input_path
+
+# Grid on which the coefficients are calibrated
+calibration_grid = "regional-1"
+
+# Number of 4d fields that a preprocessor holds at the same time
+PREPROCESS_FIELDS = {"era5": 10, "era5-modellevels": 3}
+
+# Number of 2d fields per layer that the tracking kernel holds at the same time
+KERNEL_FIELDS = 30
+
+# Fraction of the memory that a run may use
+MEMORY_FRACTION = 0.8
+
+
+def calibrate(grid=calibration_grid, repeat=2):
+    """Return seconds per unit of work of each stage, measured on this machine.
+
+    The units are grid cells x native time steps x levels for the
+    preprocessing, and grid cells x target time steps x layers for the
+    preparation and tracking.
+    """
+    from wam2layers.benchmarks import suite
+    from wam2layers.benchmarks.synthetic import MODELLEVELS, make_grid
+
+    latitude, longitude = make_grid(grid)
+    ncells = latitude.size * longitude.size
+    steps = 24 * 4  # synthetic days have 25 hourly times, resampled to 15 minutes
+
+    def seconds(name):
+        return suite.run_benchmark(name, grid, repeat, memory=False)["best"]
+
+    return {
+        "preprocess": seconds("preprocess_day") / (ncells * 25 * len(MODELLEVELS)),
+        "prepare": (seconds("resample") + seconds("prepare_fluxes")) / (ncells * steps * 2),
+        "track": seconds("tracking_kernel") / (ncells * steps * 2),
+    }
+
+
+def day_shape(config, date, source=None):
+    """Return the dimensions of a day, from the metadata of its data.
+
+    Returns a dictionary with the number of native time steps, (input) levels,
+    layers, latitudes and longitudes, and the size in bytes of an input value.
+    The preprocessed data is used if it exists and the days are not
+    preprocessed on the fly; otherwise the input of preprocessor `source`.
+    """
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    path = Path(input_path(date, input_dir))
+    source = source or config.get("preprocess")
+    if path.exists() and not config.get("preprocess"):
+        with xr.open_dataset(path) as ds:
+            return {
+                "time": ds.time.size,
+                "level": 0,
+                "layer": ds.layer.size if "layer" in ds.dims else 2,
+                "latitude": ds.latitude.size,
+                "longitude": ds.longitude.size,
+                "itemsize": 8,
+            }
+    if source is None:
+        raise ValueError(
+            f"{path} does not exist; give the preprocessor to estimate the preprocessing"
+        )
+
+    # The first input file holds a 4d field
+    preprocessor = import_module(PREPROCESSORS[source])
+    with xr.open_dataset(preprocessor.input_files(date, config)[0]) as ds:
+        da = ds[list(ds.data_vars)[0]]
+        da = da.sel(time=slice(date, date + pd.Timedelta(days=1)))
+        if "lev" in da.dims and config.get("modellevels"):
+            da = da.sel(lev=config["modellevels"])
+        da = select_bounding_box(da, get_bounding_box(config))
+        (level,) = set(da.dims) - {"time", "latitude", "longitude"}
+        boundaries = config.get("layer_boundaries")
+        return {
+            "time": da.time.size,
+            "level": da[level].size,
+            "layer": len(boundaries) + 1 if boundaries else 2,
+            "latitude": da.latitude.size,
+            "longitude": da.longitude.size,
+            "itemsize": da.dtype.itemsize,
+        }
+
+
+def estimate(shape, config, coefficients=None, source=None):
+    """Return the memory use (bytes) and run time (seconds) of each stage for a day."""
+    ncells = shape["latitude"] * shape["longitude"]
+    nlayer, ntime_native = shape["layer"], shape["time"]
+    ntime = int(pd.Timedelta(days=1) / pd.Timedelta(config["target_frequency"]))
+    field = ncells * 8
+
+    # Fluxes (fx, fy), evaporation and precipitation, vertical fluxes; states
+    flux_fields = 2 * nlayer + 2
+    memory = {
+        "read": ntime_native * (flux_fields + nlayer) * field,
+        "prepare": (ntime * (flux_fields + nlayer - 1) + (ntime + 1) * nlayer) * field,
+        "track": KERNEL_FIELDS * nlayer * field,
+        "stream": (config.get("read_ahead", 2) + 2) * (flux_fields + nlayer) * field,
+    }
+    source = source or config.get("preprocess")
+    if shape["level"]:
+        nbreak = nlayer if source == "era5-modellevels" else 2
+        memory["preprocess"] = (
+            PREPROCESS_FIELDS[source] * ntime_native * shape["level"] * ncells * shape["itemsize"]
+            + 3 * ntime_native * nbreak * field
+            + memory["read"]
+        )
+
+    runtime = {}
+    if coefficients is not None:
+        runtime["prepare"] = coefficients["prepare"] * ncells * ntime * nlayer
+        runtime["track"] = coefficients["track"] * ncells * ntime * nlayer
+        if shape["level"]:
+            runtime["preprocess"] = (
+                coefficients["preprocess"] * ncells * ntime_native * shape["level"]
+            )
+    return memory, runtime
+
+
+def available_memory():
+    """Return the physical memory of this machine in bytes."""
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def recommend(memory, runtime, shape, config, budget, cpus):
+    """Recommend settings that fit the memory budget (bytes) and cpus.
+
+    Returns the recommended settings, with the peak memory of a day for the
+    resulting mode, and notes that explain them.
+    """
+    budget = MEMORY_FRACTION * budget
+    notes = []
+    settings = {}
+
+    # A day in memory: the preprocessed data, resampled (interp briefly holds
+    # a second copy) and prepared, plus the kernel
+    in_memory = memory["read"] + 2 * memory["prepare"] + memory["track"]
+    on_the_fly = "preprocess" in memory and config.get("preprocess")
+    streaming_possible = not (
+        on_the_fly
+        or config.get("screening")
+        or config.get("layer_boundary") is not None
+        or shape["layer"] != 2
+    )
+    if on_the_fly:
+        in_memory += memory["preprocess"]
+
+    if in_memory <= budget or not streaming_possible:
+        settings["streaming"] = False
+        peak = in_memory
+        if in_memory > budget:
+            notes.append(
+                "a day does not fit in memory and can't be streamed; use a smaller "
+                "bounding_box or a longer target_frequency"
+            )
+    else:
+        settings["streaming"] = True
+        slice_size = memory["stream"] / (config.get("read_ahead", 2) + 2)
+        fit = int((budget - memory["track"]) // slice_size) - 2
+        settings["read_ahead"] = max(1, min(4, fit))
+        peak = memory["track"] + (settings["read_ahead"] + 2) * slice_size
+        notes.append("a day does not fit in memory: stream it one time step at a time")
+
+    if on_the_fly:
+        # Each day in the queue is held in memory; a longer queue only helps if
+        # the preprocessing is faster than the tracking, to absorb variations
+        fit = int((budget - peak) // memory["read"])
+        faster = runtime and runtime["preprocess"] < runtime["prepare"] + runtime["track"]
+        settings["preprocess_ahead"] = max(1, min(2 if faster else 1, fit))
+        peak += settings["preprocess_ahead"] * memory["read"]
+
+    if config.get("events"):
+        # Two prepared days are shared by all events, each event tracks in its own thread
+        shared = 2 * (memory["read"] + memory["prepare"])
+        fit = int((budget - shared) // memory["track"])
+        settings["ensemble_workers"] = max(1, min(cpus, len(config["events"]), fit))
+
+    # The bidirectional mode keeps all prepared days between its two sweeps
+    cache = memory["day_cache"]
+    settings["day_cache_spill"] = cache + in_memory > budget
+    if settings["day_cache_spill"]:
+        notes.append(
+            f"the day cache of a bidirectional run needs {cache / 1e9:.1f} GB: spill it to disk"
+        )
+
+    # Aggregate and attribute read one day of output (means, restarts and
+    # e_track) per worker
+    output_day = (2 * shape["layer"] + 1) * shape["latitude"] * shape["longitude"] * 8
+    settings["workers"] = max(1, min(cpus, 4, int(budget // output_day)))
+    return settings, peak, notes
+
+
+def plan(config, memory_budget=None, cpus=None, coefficients=None, source=None):
+    """Estimate and print the resources of a case and recommend settings.
+
+    Memory_budget is in bytes (default: the physical memory of this machine).
+    If coefficients is None, they are calibrated first (see calibrate).
+    Returns a dictionary with the estimates and the recommended settings.
+    """
+    dates = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+    if coefficients is None:
+        coefficients = calibrate()
+    memory_budget = memory_budget or available_memory()
+    cpus = cpus or os.cpu_count()
+
+    shape = day_shape(config, dates[-1], source)
+    memory, runtime = estimate(shape, config, coefficients, source)
+    memory["day_cache"] = len(dates) * memory["prepare"]
+    settings, peak, notes = recommend(memory, runtime, shape, config, memory_budget, cpus)
+
+    day = runtime["prepare"] + runtime["track"]
+    if "preprocess" in runtime and config.get("preprocess"):
+        # Preprocessing on the fly runs in the background, alongside the tracking
+        day = max(day, runtime["preprocess"])
+
+    print(
+        f"grid: {shape['latitude']} x {shape['longitude']}, {shape['layer']} layers, "
+        f"{shape['time']} input times per day, {len(dates)} days"
+    )
+    print(f"{'stage':<12}{'memory [MB]':>14}{'time [s]':>12}")
+    for stage in ["preprocess", "read", "prepare", "track", "stream"]:
+        if stage in memory:
+            seconds = f"{runtime[stage]:.2f}" if stage in runtime else "-"
+            print(f"{stage:<12}{memory[stage] / 1e6:>14.1f}{seconds:>12}")
+    print(f"peak memory per day: {peak / 1e6:.1f} MB of {memory_budget / 1e6:.0f} MB")
+    print(f"day cache of a bidirectional run: {memory['day_cache'] / 1e6:.1f} MB")
+    print(f"run time: {day:.1f} s per day, {day * len(dates) / 3600:.2f} h in total")
+    print("recommended settings:")
+    for key, value in settings.items():
+        print(f"  {key}: {value}")
+    for note in notes:
+        print(f"note: {note}")
+
+    return {
+        "shape": shape,
+        "memory": memory,
+        "runtime": runtime,
+        "peak_memory": peak,
+        "runtime_total": day * len(dates),
+        "settings": settings,
+    }
+
+
+def run_plan(config_file, memory=None, cpus=None, source=None):
+    """Plan the run described by a config file; memory is in GB."""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    return plan(config, memory and memory * 1e9, cpus, source=source)
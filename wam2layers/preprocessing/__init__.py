@@ -0,0 +1,7 @@
+"""Preprocessing of the input data for the tracking."""
+
+# Preprocessing modules by name of the input data; imported on demand
+PREPROCESSORS = {
+    "era5": "wam2layers.preprocessing.preprocess_era5",
+    "era5-modellevels": "wam2layers.preprocessing.preprocess_era5_modellevels",
+}
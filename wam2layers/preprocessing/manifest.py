@@ -0,0 +1,110 @@
+"""Keep track of which days have been preprocessed, and from what.
+
+The manifest (manifest.json in the preprocessed data folder) records for each
+day the input files that were read, the config settings that affect the
+preprocessed data and the version of the code. On a rerun, a day is only
+preprocessed again if its output is missing or if any of these changed.
+
+Input files are compared by size and modification time, or by a hash of
+their content if `manifest_hash` is set in the config. Note that the input
+files usually hold a whole month: updating such a file makes all of its days
+stale.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import wam2layers
+
+# Config settings that affect the preprocessed data
+CONFIG_KEYS = [
+    "modellevels",
+    "vertical_integral_available",
+    "bounding_box",
+    "region_buffer",
+    "cumulative_integrals",
+    "cumulative_levels",
+    "layer_boundaries",
+]
+
+
+def file_hash(path, blocksize=2**20):
+    """Return the sha256 hash of the content of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def code_version(*paths):
+    """Return the package version plus a short hash of the given source files."""
+    sha = hashlib.sha256()
+    for path in paths:
+        sha.update(Path(path).read_bytes())
+    return f"{wam2layers.__version__}+{sha.hexdigest()[:12]}"
+
+
+class Manifest:
+    """Records of the preprocessed days in a preprocessed data folder.
+
+    Settings are extra values that affect the preprocessed data but are not
+    in the config, e.g. the layer boundary of the preprocessor.
+    """
+
+    def __init__(self, output_dir, config, code, settings=None):
+        self.path = Path(output_dir) / "manifest.json"
+        self.days = {}
+        if self.path.exists():
+            self.days = json.loads(self.path.read_text())
+
+        self.settings = {key: config.get(key) for key in CONFIG_KEYS}
+        self.settings.update(settings or {})
+        self.code = code
+        self.content_hash = config.get("manifest_hash", False)
+        self.hashes = {}
+
+        # The extent of the region determines the domain to preprocess
+        self.extra_inputs = []
+        if config.get("bounding_box") is None and config.get("region_buffer") is not None:
+            self.extra_inputs.append(config["region"])
+
+    def fingerprint(self, path):
+        """Return the size and modification time, or the hash, of a file."""
+        if not self.content_hash:
+            stat = os.stat(path)
+            return [stat.st_size, stat.st_mtime_ns]
+        # The same (monthly) file is read for many days
+        path = str(path)
+        if path not in self.hashes:
+            self.hashes[path] = file_hash(path)
+        return self.hashes[path]
+
+    def record(self, inputs):
+        """Return the record of a day that is preprocessed from inputs."""
+        record = {
+            "inputs": {
+                str(path): self.fingerprint(path)
+                for path in list(inputs) + self.extra_inputs
+            },
+            "settings": self.settings,
+            "code": self.code,
+        }
+        # Compare records as they are stored
+        return json.loads(json.dumps(record))
+
+    def is_current(self, date, inputs, outputs):
+        """Whether all outputs of a day exist and are made from the same inputs."""
+        if not all(Path(path).exists() for path in outputs):
+            return False
+        return self.days.get(date.strftime("%Y-%m-%d")) == self.record(inputs)
+
+    def update(self, date, inputs):
+        """Record that a day has been preprocessed and save the manifest."""
+        self.days[date.strftime("%Y-%m-%d")] = self.record(inputs)
+
+        # Replace the file at once, so that it is intact if a run is interrupted
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.days, indent=1, sort_keys=True))
+        os.replace(tmp, self.path)
@@ -10,11 +10,13 @@ from preprocessing import (
     resample,
     get_stable_fluxes,
     get_vertical_transport,
+    get_bounding_box,
     get_grid_info,
     join_levels,
     repeat_upper_level,
     get_new_target_levels,
     interpolate,
+    select_bounding_box,
 )
 
 
@@ -34,17 +36,19 @@ divt = config["divt"]
 count_time = config["count_time"]
 latnrs = np.arange(config["latnrs"])
 lonnrs = np.arange(config["lonnrs"])
+bbox = get_bounding_box(config)
 
 
 def _get_input_data(variable, date, latnrs, lonnrs):
     """Get input data for variable."""
     filename = f"{name_of_run}{variable}_{date.year}{date.month:02d}_NH.nc"
     filepath = os.path.join(config["input_folder"], filename)
-    return (
-        xr.open_dataset(filepath)
-        .sel(time=date.strftime("%Y%m%d"))
-        .isel(lat=latnrs, lon=lonnrs)
-    )
+    ds = xr.open_dataset(filepath).sel(time=date.strftime("%Y%m%d"))
+
+    # Select the domain before anything is read from disk
+    if bbox is not None:
+        return select_bounding_box(ds, bbox)
+    return ds.isel(lat=latnrs, lon=lonnrs)
 
 
 def get_input_data(variable, date, latnrs, lonnrs):
@@ -53,9 +57,9 @@ def get_input_data(variable, date, latnrs, lonnrs):
     day2 = _get_input_data(variable, date + dt.timedelta(days=1), latnrs, lonnrs)
     days = xr.concat([day1, day2], dim="time")
     if len(days.time) < 9:
-        return days.isel(time=slice(0, 5)).isel(lat=latnrs, lon=lonnrs)
+        return days.isel(time=slice(0, 5))
     else:
-        return days.isel(time=slice(0, 10)).isel(lat=latnrs, lon=lonnrs)
+        return days.isel(time=slice(0, 10))
 
 
 datelist = pd.date_range(
@@ -112,6 +116,8 @@ for date in datelist:
     dummy = xr.open_dataset(config["land_sea_mask"])
     lat = dummy.LAT.values[444:711][::-1]  # [degrees north]
     lon = dummy.XAS.values[934:1378][::-1]  # [degrees east]
+    if bbox is not None:
+        lat, lon = q.lat.values, q.lon.values
     a_gridcell, l_ew_gridcell, l_mid_gridcell = get_grid_info(lat, lon)
 
     # Reverse engineered ~ model level 47 which corresponds with about ~800 hPa
@@ -1,3 +1,4 @@
+import sys
 from pathlib import Path
 
 import numpy as np
@@ -5,61 +6,77 @@ import pandas as pd
 import xarray as xr
 import yaml
 
-from preprocessing import (get_grid_info, insert_level, interpolate,
-                           sortby_ndarray)
+from wam2layers.preprocessing import preprocessing
+from wam2layers.preprocessing.manifest import Manifest, code_version
+from wam2layers.preprocessing.preprocessing import (
+    calculate_humidity,
+    get_bounding_box,
+    get_grid_info,
+    insert_level,
+    interpolate,
+    load_variables,
+    resolve_bounding_box,
+    select_bounding_box,
+    sortby_ndarray,
+    validation_index,
+)
 
 # Set constants
 g = 9.80665  # [m/s2]
 density_water = 1000  # [kg/m3]
 
-# Read case configuration
-with open("cases/era5_2013.yaml") as f:
-    config = yaml.safe_load(f)
-
-# Create the preprocessed data folder if it does not exist yet
-output_dir = Path(config["preprocessed_data_folder"]).expanduser()
-output_dir.mkdir(exist_ok=True, parents=True)
+# Input variables that are used to preprocess a day (not tcw)
+variables = ["q", "u", "v", "e", "cp", "lsp", "sp", "d2m", "u10", "v10"]
 
 
-def load_data(variable, date):
+def load_data(variable, date, config):
     """Load data for given variable and date."""
     filepath = Path(config["input_folder"]) / f"FloodCase_201305_{variable}.nc"
     da = xr.open_dataset(filepath)[variable]
 
     # Include midnight of the next day (if available)
     extra = date + pd.Timedelta(days=1)
-    return da.sel(time=slice(date, extra))
+    da = da.sel(time=slice(date, extra))
 
+    # Only read the part of the domain that is needed
+    return select_bounding_box(da, get_bounding_box(config))
 
-datelist = pd.date_range(
-    start=config["preprocess_start_date"],
-    end=config["preprocess_end_date"],
-    freq="d",
-    inclusive="left",
-)
 
-for date in datelist[:]:
-    print(date)
+def input_files(date, config):
+    """Return the input files that are read to preprocess a day."""
+    folder = Path(config["input_folder"])
+    return [folder / f"FloodCase_201305_{variable}.nc" for variable in variables]
+
+
+def preprocess_day(date, config):
+    """Compute the two-layer fluxes and states for a single day.
+
+    The consistency checks run on all columns and times, on a random sample of
+    them or not at all, depending on `validation` in the config (full,
+    sampled or off). The sample depends on the date and `validation_seed`.
+    """
+    validation = config.get("validation", "full")
+    seed = (config.get("validation_seed", 0), int(date.strftime("%Y%m%d")))
+
+    # Read all variables at the same time (see `read_workers`)
+    data = load_variables(load_data, variables, date, config)
 
     # 4d fields
-    q = load_data("q", date)  # in kg kg-1
-    u = load_data("u", date)  # in m/s
-    v = load_data("v", date)  # in m/s
+    q = data["q"]  # in kg kg-1
+    u = data["u"]  # in m/s
+    v = data["v"]  # in m/s
 
     # Precipitation and evaporation
-    evap = load_data("e", date)  # in m (accumulated hourly)
-    cp = load_data("cp", date)  # convective precipitation in m (accumulated hourly)
-    lsp = load_data("lsp", date)  # large scale precipitation in m (accumulated hourly)
+    evap = data["e"]  # in m (accumulated hourly)
+    cp = data["cp"]  # convective precipitation in m (accumulated hourly)
+    lsp = data["lsp"]  # large scale precipitation in m (accumulated hourly)
     precip = cp + lsp
 
-    # TODO: not used
-    tcw = load_data("tcw", date)  # kg/m2
-
-    p_surf = load_data("sp", date)  # in Pa
-    d_surf = load_data("d2m", date)  # Dew point in K
-    u_surf = load_data("u10", date)  # in m/s
-    v_surf = load_data("v10", date)  # in m/s
-    q_surf = calculate_humidity(d2m, p_surf)  # kg kg-1
+    p_surf = data["sp"]  # in Pa
+    d_surf = data["d2m"]  # Dew point in K
+    u_surf = data["u10"]  # in m/s
+    v_surf = data["v10"]  # in m/s
+    q_surf = calculate_humidity(d_surf, p_surf)  # kg kg-1
 
     # Get grid info
     time = u.time.values
@@ -78,7 +95,7 @@ for date in datelist[:]:
     evap = np.abs(np.minimum(evap, 0))
 
     # Create pressure array with the same dimensions as u, q, and v
-    p = u.level.broadcast_like(u)
+    p = u.level.broadcast_like(u) * 100  # Pa
 
     # Insert top of atmosphere values
     u = insert_level(u, u.isel(level=0), 0)
@@ -100,9 +117,15 @@ for date in datelist[:]:
 
     # Insert boundary level values (at a ridiculous dummy pressure value)
     p_boundary = 0.72878581 * np.array(p_surf) + 7438.803223
-    u = insert_level(u, interpolate(p_boundary, p, u), 150000)
-    v = insert_level(v, interpolate(p_boundary, p, v), 150000)
-    q = insert_level(q, interpolate(p_boundary, p, q), 150000)
+    u = insert_level(
+        u, interpolate(p_boundary, p, u, validation=validation, seed=seed), 150000
+    )
+    v = insert_level(
+        v, interpolate(p_boundary, p, v, validation=validation, seed=seed), 150000
+    )
+    q = insert_level(
+        q, interpolate(p_boundary, p, q, validation=validation, seed=seed), 150000
+    )
     p = insert_level(p, p_boundary, 150000)
 
     # Sort arrays by pressure once more (ascending)
@@ -120,7 +143,12 @@ for date in datelist[:]:
 
     # Calculate pressure jump
     dp = p.diff("level")
-    assert np.all(dp > 0), "Pressure levels should increase monotonically"
+
+    # Columns (time, latitude, longitude) to check
+    index = validation_index(p_boundary.shape, validation, seed=seed)
+    if index is not None:
+        dp_checked = np.moveaxis(dp.values, 1, -1)[index]
+        assert np.all(dp_checked > 0), "Pressure levels should increase monotonically"
 
     # Interpolate to midpoints
     midpoints = 0.5 * (u.level.values[1:] + u.level.values[:-1])
@@ -128,7 +156,7 @@ for date in datelist[:]:
     v = v.interp(level=midpoints)
     q = q.interp(level=midpoints)
     p = p.interp(level=midpoints)
-    dp.assign_coords(level=midpoints)
+    dp = dp.assign_coords(level=midpoints)
 
     # Determine the fluxes and states
     fx = u * q * dp / g  # eastward atmospheric moisture flux (kg*m-1*s-1)
@@ -148,17 +176,14 @@ for date in datelist[:]:
     s_upper = cwv.where(upper_layer).sum(dim="level")  # m3
 
     # Check column water vapor conservation
-    np.testing.assert_array_almost_equal(
-        cwv.sum(dim="level"),
-        s_upper + s_lower,
-        err_msg="Column water vapor should be approximately 0"
-    )
-
-    # Save preprocessed data
-    filename = f"{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"
-    output_path = output_dir / filename
-
-    xr.Dataset(
+    if index is not None:
+        np.testing.assert_array_almost_equal(
+            np.moveaxis(cwv.values, 1, -1)[index].sum(axis=-1),
+            s_upper.values[index] + s_lower.values[index],
+            err_msg="Column water vapor should be approximately 0"
+        )
+
+    return xr.Dataset(
         {  # TODO: would be nice to add coordinates and units as well
             "fx_upper": fx_upper,
             "fy_upper": fy_upper,
@@ -169,4 +194,47 @@ for date in datelist[:]:
             "evap": evap,
             "precip": precip,
         }
-    ).to_netcdf(output_path)
+    )
+
+
+def run_preprocessing(config_file):
+    """Preprocess all days in the period given in the config file."""
+    # Read case configuration
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    # Create the preprocessed data folder if it does not exist yet
+    output_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    datelist = pd.date_range(
+        start=config["preprocess_start_date"],
+        end=config["preprocess_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+
+    # Only preprocess days that are missing or out of date
+    incremental = config.get("incremental", True)
+    manifest = Manifest(
+        output_dir, config, code_version(__file__, preprocessing.__file__)
+    )
+
+    # Find the domain once, instead of for every variable of every day
+    config = resolve_bounding_box(config)
+
+    for date in datelist[:]:
+        inputs = input_files(date, config)
+        output = output_dir / f"{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"
+        if incremental and manifest.is_current(date, inputs, [output]):
+            print(date, "up to date")
+            continue
+        print(date)
+
+        # Save preprocessed data
+        preprocess_day(date, config).to_netcdf(output)
+        manifest.update(date, inputs)
+
+
+if __name__ == "__main__":
+    run_preprocessing(sys.argv[1])
@@ -1,84 +1,121 @@
-import os
+import sys
+from pathlib import Path
 
 import pandas as pd
 import xarray as xr
 import yaml
 import numpy as np
-from pathlib import Path
-
-from preprocessing import get_grid_info
-
 
-# Read case configuration
-with open("cases/era5_2021.yaml") as f:
-    config = yaml.safe_load(f)
+from wam2layers.preprocessing import preprocessing
+from wam2layers.preprocessing.manifest import Manifest, code_version
+from wam2layers.preprocessing.preprocessing import (
+    derive_layers,
+    derive_stacked_layers,
+    get_bounding_box,
+    get_grid_info,
+    load_variables,
+    resolve_bounding_box,
+    select_bounding_box,
+)
 
-# Create the preprocessed data folder if it does not exist yet
-output_dir = Path(config["preprocessed_data_folder"]).expanduser()
-output_dir.mkdir(exist_ok=True, parents=True)
 
 # Set constants
 g = 9.80665  # [m/s2]
 density_water = 1000  # [kg/m3]
 
-# Preselection of model levels
-modellevels = config["modellevels"]
-print("Number of model levels:", len(modellevels))
+# Split in 2 layers
+# To do: Check if this is a reasonable choice
+boundary = 111  # set boundary model level 111
+
 
-# Load a and b coefficients
-df = pd.read_csv("tableERA5model_to_pressure.csv")
-a = df["a [Pa]"].to_xarray().rename(index="lev")  # .sel(lev=modellevels)
-b = df["b"].to_xarray().rename(index="lev")  # .sel(lev=modellevels)
+def get_edges(modellevels):
+    """Get the a and b coefficients at the edges of the selected model levels.
 
-# Calculate a and b at mid levels (model levels)
-a_full = ((a[1:] + a[:-1].values) / 2.0).sel(lev=modellevels)
-b_full = ((b[1:] + b[:-1].values) / 2.0).sel(lev=modellevels)
+    Returns two arrays with len(modellevels) + 1 values, from the top of the
+    atmosphere to the surface.
+    """
+    # Load a and b coefficients
+    df = pd.read_csv(Path(__file__).parent / "tableERA5model_to_pressure.csv")
+    a = df["a [Pa]"].values
+    b = df["b"].values
 
-# Construct a and b at edges for selected levels
-a_edge = xr.concat([a[0], (a_full[1:].values + a_full[:-1]) / 2.0, a[-1]], dim="lev")
-b_edge = xr.concat([b[0], (b_full[1:].values + b_full[:-1]) / 2.0, b[-1]], dim="lev")
+    # Calculate a and b at mid levels (model levels)
+    a_full = ((a[1:] + a[:-1]) / 2.0)[np.asarray(modellevels) - 1]
+    b_full = ((b[1:] + b[:-1]) / 2.0)[np.asarray(modellevels) - 1]
 
+    # Construct a and b at edges for selected levels
+    a_edge = np.concatenate([a[:1], (a_full[1:] + a_full[:-1]) / 2.0, a[-1:]])
+    b_edge = np.concatenate([b[:1], (b_full[1:] + b_full[:-1]) / 2.0, b[-1:]])
+    return a_edge, b_edge
 
-def load_surface_data(variable, date):
+
+def load_surface_data(variable, date, config):
     """Load data for given variable and date."""
     filename = f"FloodCase_202107_{variable}.nc"
-    filepath = os.path.join(config["input_folder"], filename)
+    filepath = Path(config["input_folder"]) / filename
     da = xr.open_dataset(filepath)[variable]
 
     # Include midnight of the next day (if available)
     extra = date + pd.Timedelta(days=1)
-    return da.sel(time=slice(date, extra))
+    da = da.sel(time=slice(date, extra))
+
+    # Only read the part of the domain that is needed
+    return select_bounding_box(da, get_bounding_box(config))
 
 
-def load_modellevel_data(variable, date):
+def load_modellevel_data(variable, date, config):
     """Load model level data for given variable and date."""
     filename = f"FloodCase_202107_ml_{variable}.nc"
-    filepath = os.path.join(config["input_folder"], filename)
+    filepath = Path(config["input_folder"]) / filename
     da = xr.open_dataset(filepath)[variable]
 
     # Include midnight of the next day (if available)
     extra = date + pd.Timedelta(days=1)
-    return da.sel(time=slice(date, extra)).sel(lev=modellevels)
+    da = da.sel(time=slice(date, extra)).sel(lev=config["modellevels"])
 
+    # Only read the part of the domain that is needed
+    return select_bounding_box(da, get_bounding_box(config))
 
-datelist = pd.date_range(
-    start=config["preprocess_start_date"],
-    end=config["preprocess_end_date"],
-    freq="d",
-    inclusive="left",
-)
 
-for date in datelist[:]:
-    print(date)
+def input_files(date, config):
+    """Return the input files that are read to preprocess a day."""
+    variables = ["sp", "e", "cp", "lsp"]
+    if config["vertical_integral_available"] == True:
+        variables.append("tcw")
+    folder = Path(config["input_folder"])
+    return [folder / f"FloodCase_202107_ml_{variable}.nc" for variable in ["u", "v", "q"]] + [
+        folder / f"FloodCase_202107_{variable}.nc" for variable in variables
+    ]
+
+
+def cumulative_integrals(date, config, breakpoints=None):
+    """Compute vertically cumulative moisture and fluxes for a single day.
+
+    The storage (s_cum, m3) and fluxes (fx_cum, fy_cum, kg m-1 s-1) are
+    integrated from the top of the atmosphere down to and including each of
+    the breakpoints (model levels, by default all selected model levels). The
+    lowest selected model level is always included, so that the total column
+    is available as well. See derive_layers for how to get two layers.
+    """
+    modellevels = config["modellevels"]
+    a_edge, b_edge = get_edges(modellevels)
+    breakpoints = sorted(set(breakpoints or modellevels) | {modellevels[-1]})
 
     # Load data
-    u = load_modellevel_data("u", date)
-    v = load_modellevel_data("v", date)
-    q = load_modellevel_data("q", date)
-    sp = load_surface_data("sp", date)  # in Pa
-    evap = load_surface_data("e", date)
-    cp = load_surface_data("cp", date)
-    lsp = load_surface_data("lsp", date)
+    u = load_modellevel_data("u", date, config)
+    v = load_modellevel_data("v", date, config)
+    q = load_modellevel_data("q", date, config)
+
+    # Read the surface fields at the same time (see `read_workers`); the
+    # model level data is read one level at a time below
+    surface = ["sp", "e", "cp", "lsp"]
+    if config["vertical_integral_available"] == True:
+        surface.append("tcw")
+    data = load_variables(load_surface_data, surface, date, config)
+    sp = data["sp"]  # in Pa
+    evap = data["e"]
+    cp = data["cp"]
+    lsp = data["lsp"]
     precip = cp + lsp
 
     # Get grid info
@@ -89,66 +126,128 @@ for date in datelist[:]:
     # Change sign convention to all positive,
     evap = np.abs(np.minimum(evap, 0))
 
-    # Convert model levels to pressure values
-    sp_modellevels2 = sp.expand_dims({"lev": modellevels}, axis=1)
-    p_modellevels = a_edge + b_edge * sp_modellevels2  # in Pa
-
-    # calculate the difference between the pressure levels
-    dp_modellevels = p_modellevels.diff(dim="lev")  # in Pa
-
-    # Split in 2 layers
-    # To do: Check if this is a reasonable choice
-    boundary = 111  # set boundary model level 111
-
-    # Integrate fluxes and states to upper and lower layer
-    lower_layer = dp_modellevels.lev > boundary
-    upper_layer = ~lower_layer
-
-    cwv = q * dp_modellevels / g  #  # column water vapor (kg/m2)
+    # Pressure thickness of each level is da + db * sp (in Pa)
+    da = np.diff(a_edge)
+    db = np.diff(b_edge)
+
+    # Number of (top to bottom sorted) model levels above each breakpoint
+    nlevels = np.searchsorted(modellevels, breakpoints, side="right")
+
+    # Vertically integrate column water vapour (kg/m2) and fluxes (kg m-1 s-1)
+    # one level at a time, so that only a few 3d fields are in memory
+    surface_pressure = sp.values
+    cwv = np.zeros(surface_pressure.shape)
+    fx = np.zeros(surface_pressure.shape)
+    fy = np.zeros(surface_pressure.shape)
+    cumulative = {n: (cwv.copy(), fx.copy(), fy.copy()) for n in nlevels if n == 0}
+    for k in range(len(modellevels)):
+        dp = da[k] + db[k] * surface_pressure
+        cwv_level = q.isel(lev=k).values * dp / g
+        cwv += cwv_level
+        fx += u.isel(lev=k).values * cwv_level
+        fy += v.isel(lev=k).values * cwv_level
+        if k + 1 in nlevels:
+            cumulative[k + 1] = cwv.copy(), fx.copy(), fy.copy()
 
     if config["vertical_integral_available"] == True:
         # calculate column water instead of column water vapour
-        tcw = load_surface_data("tcw", date)  # kg/m2
-        cw = (tcw / cwv.sum(dim="lev")) * cwv  # column water (kg/m2)
+        tcw = data["tcw"].values  # kg/m2
+        cw_ratio = tcw / cwv
     else:
         # calculate the fluxes based on the column water vapour
-        cw = cwv
-
-    # Vertically integrate state over two layers
-    s_lower = (
-        cw.where(lower_layer).sum(dim="lev")
-        * a_gridcell[None, :, None]
-        / density_water
-    )  # m3
-    s_upper = (
-        cw.where(upper_layer).sum(dim="lev")
-        * a_gridcell[None, :, None]
-        / density_water
-    )  # m3
-
-    # Determine the fluxes
-    fx = u * cw  # eastward atmospheric moisture flux (kg m-1 s-1)
-    fy = v * cw  # northward atmospheric moisture flux (kg m-1 s-1)
-
-    # Vertically integrate fluxes over two layers
-    fx_lower = fx.where(lower_layer).sum(dim="lev")  # kg m-1 s-1
-    fy_lower = fy.where(lower_layer).sum(dim="lev")  # kg m-1 s-1
-
-    fx_upper = fx.where(upper_layer).sum(dim="lev")  # kg m-1 s-1
-    fy_upper = fy.where(upper_layer).sum(dim="lev")  # kg m-1 s-1
-
-    # Save preprocessed data
-    filename = f"{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"
-    output_path = os.path.join(config["preprocessed_data_folder"], filename)
-    xr.Dataset(
-        {  # TODO: would be nice to add coordinates and units as well
-            "fx_upper": fx_upper,
-            "fy_upper": fy_upper,
-            "fx_lower": fx_lower,
-            "fy_lower": fy_lower,
-            "s_upper": s_upper,
-            "s_lower": s_lower,
+        cw_ratio = 1
+
+    dims = ["time", "level", "latitude", "longitude"]
+    area = a_gridcell[None, :, None]
+    s_cum, fx_cum, fy_cum = (
+        np.stack([cw_ratio * cumulative[n][i] for n in nlevels], axis=1)
+        for i in range(3)
+    )
+    return xr.Dataset(
+        {
+            "s_cum": (dims, s_cum * area[:, None] / density_water),  # m3
+            "fx_cum": (dims, fx_cum),  # kg m-1 s-1
+            "fy_cum": (dims, fy_cum),  # kg m-1 s-1
             "evap": evap,
             "precip": precip,
-        }
-    ).to_netcdf(output_path)
+        },
+        coords={"level": breakpoints},
+        attrs={"modellevels": list(modellevels)},
+    )
+
+
+def preprocess_day(date, config):
+    """Compute the two-layer fluxes and states for a single day.
+
+    With `layer_boundaries` in the config, there are more layers, stacked on a
+    layer axis (see derive_stacked_layers).
+    """
+    boundaries = config.get("layer_boundaries")
+    if boundaries:
+        return derive_stacked_layers(cumulative_integrals(date, config, boundaries), boundaries)
+    return derive_layers(cumulative_integrals(date, config, [boundary]), boundary)
+
+
+def run_preprocessing(config_file):
+    """Preprocess all days in the period given in the config file."""
+    # Read case configuration
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    # Create the preprocessed data folder if it does not exist yet
+    output_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    # Preselection of model levels
+    print("Number of model levels:", len(config["modellevels"]))
+
+    datelist = pd.date_range(
+        start=config["preprocess_start_date"],
+        end=config["preprocess_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+
+    # Only preprocess days that are missing or out of date
+    incremental = config.get("incremental", True)
+    manifest = Manifest(
+        output_dir,
+        config,
+        code_version(__file__, preprocessing.__file__),
+        {"boundary": boundary},
+    )
+
+    # Find the domain once, instead of for every variable of every day
+    config = resolve_bounding_box(config)
+
+    for date in datelist[:]:
+        inputs = input_files(date, config)
+        outputs = [output_dir / f"{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"]
+        if config.get("cumulative_integrals", False):
+            outputs.append(output_dir / f"{date.strftime('%Y-%m-%d')}_cumulative.nc")
+        if incremental and manifest.is_current(date, inputs, outputs):
+            print(date, "up to date")
+            continue
+        print(date)
+
+        # Optionally keep the cumulative integrals, so that the layers can be
+        # derived for another boundary later on
+        if config.get("cumulative_integrals", False):
+            cumulative = cumulative_integrals(
+                date, config, config.get("cumulative_levels")
+            )
+            cumulative.to_netcdf(outputs[1])
+            if config.get("layer_boundaries"):
+                ds = derive_stacked_layers(cumulative, config["layer_boundaries"])
+            else:
+                ds = derive_layers(cumulative, boundary)
+        else:
+            ds = preprocess_day(date, config)
+
+        # Save preprocessed data
+        ds.to_netcdf(outputs[0])
+        manifest.update(date, inputs)
+
+
+if __name__ == "__main__":
+    run_preprocessing(sys.argv[1])
@@ -1,7 +1,10 @@
 """Generic functions useful for preprocessing various input datasets."""
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import numpy as np
-from scipy.interpolate import interp1d
 import xarray as xr
 
 
@@ -61,6 +64,231 @@ def get_grid_info(ds):
     return a, ly, lx
 
 
+def get_bounding_box(config):
+    """Return the (south, north, west, east) extent to preprocess, or None.
+
+    The extent is either the `bounding_box` in the config, or the extent of
+    the `region` (all cells > 0) plus `region_buffer` degrees on each side.
+    Returns None if neither is set, i.e. preprocess the whole input.
+
+    The extent of a region that crosses the dateline (or the Greenwich
+    meridian, for longitudes from 0 to 360) has west in [-180, 180) and
+    east > 180.
+    """
+    if config.get("bounding_box") is not None:
+        return tuple(config["bounding_box"])
+    if config.get("region_buffer") is None:
+        return None
+
+    with xr.open_dataset(config["region"]) as ds:
+        region = ds.region_flood.load()
+    inside = (region > 0).values
+    latitude = region.latitude.values[inside.any(axis=1)]
+    longitude = np.unique(region.longitude.values[inside.any(axis=0)] % 360)
+
+    # The region spans all longitudes except the largest gap between them
+    gaps = np.diff(longitude, append=longitude[0] + 360)
+    largest = gaps.argmax()
+    west = (longitude[(largest + 1) % longitude.size] + 180) % 360 - 180
+    east = west + 360 - gaps[largest]
+
+    buffer = config["region_buffer"]
+    return (
+        max(-90, latitude.min() - buffer),
+        min(90, latitude.max() + buffer),
+        west - buffer,
+        east + buffer,
+    )
+
+
+def resolve_bounding_box(config):
+    """Return a copy of the config with the bounding box resolved.
+
+    The loaders of the preprocessors find the domain with get_bounding_box
+    for every variable of every day; with the bounding box resolved, the
+    region file is only read once.
+    """
+    return {**config, "bounding_box": get_bounding_box(config), "region_buffer": None}
+
+
+def select_bounding_box(da, bbox):
+    """Select the part of (lazily loaded) data within a bounding box.
+
+    Bbox is (south, north, west, east) or None (no selection). The longitudes
+    of the box may be given from -180 to 180 or from 0 to 360, whatever those
+    of the data; if west > east, or east > 180 for data from -180 to 180, the
+    box crosses the edge of the longitude range (e.g. the dateline).
+    """
+    if bbox is None:
+        return da
+    south, north, west, east = bbox
+    lat = "latitude" if "latitude" in da.dims else "lat"
+    lon = "longitude" if "longitude" in da.dims else "lon"
+
+    # ERA5 latitude is decreasing
+    if da[lat].values[0] > da[lat].values[-1]:
+        da = da.sel({lat: slice(north, south)})
+    else:
+        da = da.sel({lat: slice(south, north)})
+
+    # Longitudes of the box in the range of those of the data
+    start = da[lon].values.min()
+    if east - west < 360:
+        west = (west - start) % 360 + start
+        east = (east - start) % 360 + start
+        if west <= east:
+            da = da.sel({lon: slice(west, east)})
+        else:
+            da = xr.concat(
+                [da.sel({lon: slice(west, None)}), da.sel({lon: slice(None, east)})],
+                dim=lon,
+            )
+
+    if da[lat].size == 0 or da[lon].size == 0:
+        raise ValueError(f"The bounding box {bbox} does not overlap with the input data")
+    return da
+
+
+def cumulative_level(cumulative, boundary, above=None):
+    """Return the stored level of the cumulative integrals down to boundary.
+
+    The integral down to the boundary equals that down to the last stored
+    level above it, if there are no model levels in between. Raises a
+    ValueError if the layer above the boundary (down from the boundary
+    `above`, if given) or the layer below it would hold no model levels:
+    its storage would be zero.
+    """
+    levels = cumulative.level.values
+    modellevels = np.atleast_1d(cumulative.attrs["modellevels"])
+    layer = modellevels <= boundary
+    if above is not None:
+        layer &= modellevels > above
+    if not layer.any() or np.all(modellevels <= boundary):
+        raise ValueError(
+            f"A layer boundary at model level {boundary} gives a layer without "
+            f"model levels (model levels: {modellevels.tolist()})"
+        )
+
+    stored = levels[levels <= boundary]
+    if stored.size == 0 or np.any((modellevels > stored[-1]) & (modellevels <= boundary)):
+        raise ValueError(
+            f"Cumulative integrals are not available for boundary {boundary}, "
+            f"only for levels {levels.tolist()}"
+        )
+    return stored[-1]
+
+
+def derive_layers(cumulative, boundary):
+    """Derive the two-layer fluxes and states from cumulative integrals.
+
+    Cumulative holds s_cum, fx_cum and fy_cum, integrated from the top of the
+    atmosphere down to each `level`; the last level is the total column. The
+    upper layer holds the levels down to and including `boundary`, the lower
+    layer the levels below it.
+    """
+    upper = cumulative.sel(level=cumulative_level(cumulative, boundary), drop=True)
+    total = cumulative.isel(level=-1, drop=True)
+
+    return xr.Dataset(
+        {
+            "fx_upper": upper.fx_cum,
+            "fy_upper": upper.fy_cum,
+            "fx_lower": total.fx_cum - upper.fx_cum,
+            "fy_lower": total.fy_cum - upper.fy_cum,
+            "s_upper": upper.s_cum,
+            "s_lower": total.s_cum - upper.s_cum,
+            "evap": cumulative.evap,
+            "precip": cumulative.precip,
+        }
+    )
+
+
+def derive_stacked_layers(cumulative, boundaries):
+    """Derive fluxes and states for any number of layers from cumulative integrals.
+
+    The layers are separated by the model levels in `boundaries`, so there is
+    one layer more than there are boundaries. The fluxes (fx, fy) and states
+    (s) of the layers are stacked on a `layer` axis, from the top down.
+    """
+    boundaries = sorted(boundaries)
+    levels = [
+        cumulative_level(cumulative, boundary, above)
+        for above, boundary in zip([None] + boundaries[:-1], boundaries)
+    ]
+    cumulative_layers = cumulative.sel(level=levels + [cumulative.level.values[-1]])
+
+    ds = xr.Dataset(
+        {"evap": cumulative.evap, "precip": cumulative.precip},
+        coords={"layer": np.arange(len(levels) + 1)},
+        attrs={"boundaries": boundaries},
+    )
+    dims = ["time", "layer", "latitude", "longitude"]
+    for name in ["fx", "fy", "s"]:
+        values = cumulative_layers[f"{name}_cum"].values
+        ds[name] = (dims, np.diff(values, axis=1, prepend=0))
+    return ds
+
+
+def _preprocess_and_spill(preprocess_day, date, config, spill_dir, lock):
+    with lock:
+        ds = preprocess_day(date, config).load()
+        if spill_dir is not None:
+            ds.to_netcdf(f"{spill_dir}/{date.strftime('%Y-%m-%d')}_fluxes_storages.nc")
+    return ds
+
+
+def preprocessed_days(
+    preprocess_day, dates, config, read_ahead=1, spill_dir=None, lock=None
+):
+    """Yield the preprocessed data of each date, in the order of dates.
+
+    The days are preprocessed in memory by preprocess_day(date, config), up to
+    `read_ahead` days ahead in a background thread, so that only a few days
+    are held in memory at a time. Since every day is preprocessed on its own,
+    the dates can be in any order, e.g. backward for the backtracking.
+    If spill_dir is given, each day is also written to a file there, like
+    the preprocessing does, so it can be reused.
+
+    HDF5 is not thread-safe: if the caller uses files while the days are
+    preprocessed, it should hold `lock`, which is held while a day is
+    preprocessed and spilled.
+    """
+    lock = nullcontext() if lock is None else lock
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = deque()
+        for date in dates:
+            pending.append(
+                pool.submit(
+                    _preprocess_and_spill, preprocess_day, date, config, spill_dir, lock
+                )
+            )
+            if len(pending) > read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_variables(load, variables, date, config):
+    """Read several variables of a day at the same time.
+
+    Load(variable, date, config) returns a lazily loaded DataArray. The data
+    of the variables is read in up to `read_workers` (config, default 4)
+    threads. HDF5 is not thread-safe, so the files are opened one at a time,
+    and xarray reads from one file at a time as well; what overlaps is the
+    decoding of the data (scale, offset and missing values). Returns a
+    dictionary with the loaded DataArrays.
+    """
+    lock = threading.Lock()
+
+    def read(variable):
+        with lock:
+            da = load(variable, date, config)
+        return da.load()
+
+    with ThreadPoolExecutor(max_workers=config.get("read_workers", 4)) as pool:
+        return dict(zip(variables, pool.map(read, variables)))
+
+
 def join_levels(pressure_level_data, surface_level_data):
     """Combine 3d pressure level and 2d surface level data.
 
@@ -127,6 +355,8 @@ def get_new_target_levels(surface_pressure, p_boundary, n_levels=40):
 
 def interpolate_old(old_var, old_pressure_levels, new_pressure_levels, type="linear"):
     """Interpolate old_var to new_pressure_levels."""
+    from scipy.interpolate import interp1d
+
     new_var = np.zeros_like(new_pressure_levels)
 
     ntime, _, nlat, nlon = old_var.shape
@@ -147,13 +377,34 @@ def interpolate_old(old_var, old_pressure_levels, new_pressure_levels, type="lin
     return new_var
 
 
-def interpolate(x, xp, fp, axis=1, descending=False):
+def validation_index(shape, validation="full", samples=100, seed=0):
+    """Return an index to the points of an array on which to run checks.
+
+    Validation is "off" (returns None: no checks), "sampled" (an index to
+    `samples` random points, e.g. columns and times) or "full" (all points).
+    The random points only depend on the seed (see numpy.random.default_rng),
+    so a failed check can be reproduced.
+    """
+    if validation == "off":
+        return None
+    if validation == "full":
+        return (...,)
+    if validation == "sampled":
+        size = int(np.prod(shape))
+        flat = np.random.default_rng(seed).choice(size, min(samples, size), replace=False)
+        return np.unravel_index(flat, shape)
+    raise ValueError(f"Unknown validation {validation}, use off, sampled or full")
+
+
+def interpolate(x, xp, fp, axis=1, descending=False, validation="full", seed=0):
     """Linearly interpolate along an axis of an N-dimensional array.
 
     This function interpolates one slice at a time, i.e. if xp and fp are 4d
     arrays, x should be a 3d array and the function will return a 3d array.
 
-    It is assumed that the input array is monotonic along the axis.
+    It is assumed that the input array is monotonic along the axis. This, and
+    whether x is within the range of xp, is checked for all slices, a random
+    sample of them or not at all (see validation_index).
     """
     # Cast input to numpy arrays
     x = np.asarray(x)
@@ -168,15 +419,21 @@ def interpolate(x, xp, fp, axis=1, descending=False):
     if descending:
         xp = np.flip(xp, axis=0)
         fp = np.flip(fp, axis=0)
-        assert np.diff(xp, axis=0).min() >= 0, "with descending=False, xp must be monotonically decreasing"
-    else:
-        assert np.diff(xp, axis=0).min() >= 0, "with desciending=True, xp must be monotonically increasing"
 
-    # Check for out of bounds values
-    if np.any(x[None, ...] < xp[0, ...]):
-        raise ValueError("one or more x are below the lowest value of xp")
-    if np.any(x[None, ...] > xp[-1, ...]):
-        raise ValueError("one or more x are above the highest value of xp")
+    index = validation_index(x.shape, validation, seed=seed)
+    if index is not None:
+        xp_checked = xp[(slice(None), *index)]
+        x_checked = x[index]
+        if descending:
+            assert np.diff(xp_checked, axis=0).min() >= 0, "with descending=False, xp must be monotonically decreasing"
+        else:
+            assert np.diff(xp_checked, axis=0).min() >= 0, "with desciending=True, xp must be monotonically increasing"
+
+        # Check for out of bounds values
+        if np.any(x_checked[None, ...] < xp_checked[0, ...]):
+            raise ValueError("one or more x are below the lowest value of xp")
+        if np.any(x_checked[None, ...] > xp_checked[-1, ...]):
+            raise ValueError("one or more x are above the highest value of xp")
 
     # Find indices such that xp[lower] < x < xp[upper]
     upper = np.sum(x > xp, axis=0)
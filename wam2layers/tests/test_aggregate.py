@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+import yaml
+
+from wam2layers.benchmarks.synthetic import synthetic_case
+from wam2layers.cli import main
+
+
+def test_aggregate(tmp_path):
+    config = synthetic_case(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    config["output_folder"] = str(tmp_path / "output")
+    config_file = tmp_path / "case.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+    main(["backtrack", str(config_file)])
+
+    output = tmp_path / "aggregate.nc"
+    main([
+        "aggregate", str(config_file), "--window", "20210713", "20210715",
+        "--window", "20210714", "20210715", "--percentiles", "50", "100",
+        "--output", str(output), "--workers", "2",
+    ])
+
+    result = xr.open_dataset(output)
+    daily = xr.concat(
+        [
+            xr.open_dataset(tmp_path / "output" / "backtrack" / f"2021-07-{day}_s_track.nc")
+            for day in [13, 14, 15]
+        ],
+        dim="day",
+    )
+    assert result.days.values.tolist() == [3, 2]
+    np.testing.assert_array_equal(result.lat, daily.lat)
+    np.testing.assert_allclose(result.e_track_sum[0], daily.e_track.sum("day"))
+    np.testing.assert_allclose(result.north_loss_mean[1], daily.north_loss[1:].mean("day"))
+    np.testing.assert_allclose(
+        result.e_track_percentile.sel(window=0, percentile=50), daily.e_track.median("day")
+    )
+    np.testing.assert_allclose(
+        result.s_track_upper_percentile.sel(window=1, percentile=100),
+        daily.s_track_upper[1:].max("day"),
+    )
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+
+from wam2layers.analysis.attribution import Attribution
+from wam2layers.benchmarks.synthetic import synthetic_case
+from wam2layers.cli import main
+
+
+def test_attribution():
+    labels = np.array([[0, 0, 5], [np.nan, 5, -1]])
+    field = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    reduce = Attribution(labels)
+    assert reduce.labels.tolist() == [0, 5]
+    assert reduce(field).tolist() == [3.0, 8.0]
+    with pytest.raises(ValueError):
+        reduce(np.stack([field, field]))
+
+
+def test_run_attribution(tmp_path):
+    config = synthetic_case(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    config["output_folder"] = str(tmp_path / "output")
+    config_file = tmp_path / "case.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+    main(["backtrack", str(config_file)])
+
+    # Three zonal bands, on a larger grid than the tracking domain
+    latitude = np.arange(70, 29, -2.0)
+    longitude = np.arange(-20, 31, 2.0)
+    bands = np.digitize(latitude, [45, 55])[:, None] * np.ones(longitude.size)
+    labels = xr.DataArray(
+        bands.astype("int32"),
+        coords={"latitude": latitude, "longitude": longitude},
+        dims=["latitude", "longitude"],
+        attrs={"flag_values": [0, 1, 2], "flag_meanings": "south middle north"},
+    )
+    labels.to_dataset(name="band").to_netcdf(tmp_path / "labels.nc")
+
+    output = tmp_path / "attribution.nc"
+    main([
+        "attribute", str(config_file), str(tmp_path / "labels.nc"),
+        "--labels-variable", "band", "--variables", "e_track", "s_track_lower",
+        "--output", str(output),
+    ])
+
+    result = xr.open_dataset(output)
+    assert result.e_track.shape == (3, 3)
+    assert result.label_name.values.tolist() == ["south", "middle", "north"]
+
+    daily = xr.open_dataset(tmp_path / "output" / "backtrack" / "2021-07-14_s_track.nc")
+    band = labels.sel(latitude=np.arange(60, 39, -2.0), longitude=np.arange(-10, 21, 2.0))
+    for label in range(3):
+        expected = daily.e_track.values[band.values == label].sum()
+        np.testing.assert_allclose(result.e_track.sel(label=label)[1], expected)
+    np.testing.assert_allclose(result.s_track_lower[1].sum(), daily.s_track_lower.sum())
+
+    # Screening runs are attributed on their coarse grid
+    config["screening"] = 2
+    config_file.write_text(yaml.safe_dump(config))
+    main(["backtrack", str(config_file)])
+    main(["attribute", str(config_file), str(tmp_path / "labels.nc"), "--labels-variable", "band"])
+
+    result = xr.load_dataset(tmp_path / "output" / "screening" / "attribution.nc")
+    daily = xr.load_dataset(tmp_path / "output" / "screening" / "2021-07-14_s_track.nc")
+    assert daily.lat.size == 5
+    assert (result.e_track[1] > 0).sum() >= 2
+    np.testing.assert_allclose(result.e_track[1].sum(), daily.e_track.sum())
@@ -0,0 +1,432 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+
+from wam2layers.benchmarks.suite import prepared_fluxes
+from wam2layers.benchmarks.synthetic import (
+    synthetic_case,
+    synthetic_era5_modellevels,
+    synthetic_fluxes_storages,
+    synthetic_region,
+)
+from wam2layers.cli import main
+from wam2layers.tracking import screening
+from wam2layers.tracking.backtrack import (
+    SCHEMES,
+    backtrack,
+    figures_due,
+    prepare_fluxes,
+    resample,
+    timesteps,
+)
+from wam2layers.tracking.io import SubdailyOutput, probe_index
+
+# Small grid to keep the tests fast: resolution, (south, north, west, east)
+grid = (2.0, (40, 60, -10, 20))
+
+
+def make_case(tmp_path, grid=grid, **settings):
+    """Write a synthetic case (2021-07-13 to 2021-07-15) and return its config.
+
+    The output goes to tmp_path/output, unless settings say otherwise.
+    """
+    config = synthetic_case(tmp_path, grid=grid)
+    config["output_folder"] = str(tmp_path / "output")
+    config.update(settings)
+    return config
+
+
+def make_modellevel_case(tmp_path, **settings):
+    """Return the config of a case (2021-07-14) that preprocesses model level input on the fly."""
+    (tmp_path / "case").mkdir()
+    (tmp_path / "input").mkdir()
+    config = synthetic_case(tmp_path / "case", "2021-07-14", "2021-07-15", grid)
+    config.update(synthetic_era5_modellevels(tmp_path / "input", grid=grid))
+    config.update(
+        preprocess="era5-modellevels",
+        preprocessed_data_folder=str(tmp_path / "preprocessed"),
+        output_folder=str(tmp_path / "output"),
+    )
+    config.update(settings)
+    return config
+
+
+def run_case(config, command, *args, **overrides):
+    """Run a command on a case, with some settings overridden.
+
+    The config file is written next to the output folder. Returns the config
+    of the run.
+    """
+    config = {**config, **overrides}
+    config_file = Path(config["output_folder"]).with_suffix(".yaml")
+    config_file.write_text(yaml.safe_dump(config))
+    main([command, str(config_file), *args])
+    return config
+
+
+def output_dir(config, directory="backtrack"):
+    return Path(config["output_folder"]) / directory
+
+
+def assert_same_output(actual, expected, summary=True):
+    """Assert that two output folders hold the same daily output and summary."""
+    paths = sorted(expected.glob("*_s_track.nc"))
+    assert paths
+    for path in paths:
+        xr.testing.assert_allclose(xr.load_dataset(actual / path.name), xr.load_dataset(path))
+    if summary:
+        xr.testing.assert_allclose(
+            xr.load_dataset(actual / "summary.nc"), xr.load_dataset(expected / "summary.nc")
+        )
+
+
+def test_figures_due():
+    ndays = 10
+    assert not any(figures_due(False, i, ndays) for i in range(ndays))
+    assert [figures_due("end", i, ndays) for i in range(ndays)] == [False] * 9 + [True]
+    assert [i for i in range(ndays) if figures_due(3, i, ndays)] == [0, 3, 6, 9]
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_run_experiment(tmp_path, streaming):
+    config = run_case(make_case(tmp_path), "backtrack", streaming=streaming)
+
+    output = xr.open_dataset(output_dir(config) / "2021-07-13_s_track.nc")
+    assert output.e_track.sum() > 0
+
+
+def test_subdaily_output(tmp_path):
+    fluxes, states = prepared_fluxes(grid)
+    region = synthetic_region(grid)
+    s_track = np.zeros_like(region)
+
+    subdaily = SubdailyOutput(
+        tmp_path / "subdaily.nc", states.time.values, region.shape, "3h"
+    )
+    _, _, daily = backtrack(
+        fluxes, states, s_track.copy(), s_track.copy(), region, 3, subdaily
+    )
+    subdaily.close()
+
+    output = xr.open_dataset(tmp_path / "subdaily.nc").sortby("time")
+    assert output.time.size == 8
+    assert output.time[0] == states.time[0]
+    np.testing.assert_allclose(output.e_track.sum("time"), daily.e_track)
+    np.testing.assert_allclose(output.north_loss.sum("time"), daily.north_loss)
+    np.testing.assert_allclose(output.s_track_upper.mean("time"), daily.s_track_upper)
+
+
+def test_screening(tmp_path):
+    config = make_case(tmp_path, grid=(1.0, (40, 60, -10, 20)))
+
+    # Aggregation conserves volumes (on the part of the grid that is kept)
+    ds = xr.open_dataset(tmp_path / "2021-07-15_fluxes_storages.nc")
+    coarse = screening.coarsen(ds, 4)
+    assert coarse.s_upper.shape[1:] == (5, 7)
+    np.testing.assert_allclose(
+        coarse.s_lower.sum(["latitude", "longitude"]),
+        ds.s_lower[:, :20, :28].sum(["latitude", "longitude"]),
+    )
+
+    config = run_case(config, "backtrack", screening=4, screening_refine=True)
+
+    output = xr.open_dataset(output_dir(config, "screening") / "2021-07-13_s_track.nc")
+    assert output.e_track.sum() > 0
+    assert output.e_track_fine.shape == (21, 31)
+    np.testing.assert_allclose(output.e_track_fine.sum(), output.e_track.sum())
+
+
+def test_ensemble(tmp_path):
+    # The events write their sub-daily output from several threads at once
+    config = make_case(tmp_path, output_frequency="3h", ensemble_workers=2)
+
+    # A second event with a smaller region and a shorter tracking period
+    region = xr.open_dataset(tmp_path / "region.nc")
+    region["region_flood"][:, :8] = 0
+    region.to_netcdf(tmp_path / "region_west.nc")
+    events = [
+        {"name": "first", "event_start_date": "20210715", "event_end_date": "20210715",
+         "region": config["region"]},
+        {"name": "second", "event_start_date": "20210714", "event_end_date": "20210715",
+         "region": str(tmp_path / "region_west.nc"), "track_start_date": "20210714"},
+    ]
+    run_case(config, "ensemble", events=events)
+
+    # Same result as separate runs
+    for event in events:
+        single = {key: value for key, value in event.items() if key != "name"}
+        single = run_case(
+            config, "backtrack", output_folder=str(tmp_path / event["name"]), **single
+        )
+        expected = output_dir(single)
+        assert len(list(expected.glob("*_s_track.nc"))) == (3 if event["name"] == "first" else 2)
+        actual = output_dir(config, f"{event['name']}/backtrack")
+        assert_same_output(actual, expected)
+        subdaily = sorted(expected.glob("*_s_track_subdaily.nc"))
+        assert len(subdaily) == len(list(expected.glob("*_s_track.nc")))
+        for path in subdaily:
+            xr.testing.assert_allclose(xr.load_dataset(actual / path.name), xr.load_dataset(path))
+    assert not (output_dir(config, "second/backtrack") / "2021-07-13_s_track.nc").exists()
+
+
+def test_implicit_scheme():
+    grid = (1.0, (40, 60, -10, 20))
+    ds = synthetic_fluxes_storages(grid=grid)
+    region = synthetic_region(grid)
+
+    def track(scheme, frequency):
+        fluxes, states = resample(ds, frequency)
+        prepare_fluxes(fluxes, states, frequency, 3, stabilize=scheme == "explicit")
+        tracked = float((fluxes.precip * region).sum())
+        s_track_upper, s_track_lower, output = SCHEMES[scheme](
+            timesteps(fluxes, states), fluxes.time.size,
+            np.zeros_like(region), np.zeros_like(region), region, 3,
+        )
+        return tracked, s_track_upper + s_track_lower, output
+
+    _, _, reference = track("explicit", "15min")
+    tracked, remaining, output = track("implicit", "3h")
+
+    # Tracked moisture is conserved and stays positive
+    losses = sum(output[f"{side}_loss"].sum() for side in ["north", "south", "east", "west"])
+    budget = output.e_track.sum() + remaining.sum() + losses
+    np.testing.assert_allclose(budget, tracked, rtol=1e-3)
+    assert remaining.min() >= 0
+
+    # Close to the explicit scheme at short time steps
+    correlation = np.corrcoef(output.e_track.values.ravel(), reference.e_track.values.ravel())
+    assert correlation[0, 1] > 0.99
+
+
+def test_stop_threshold(tmp_path):
+    config = run_case(make_case(tmp_path), "backtrack")
+    summary = xr.load_dataset(output_dir(config) / "summary.nc")
+    assert summary.days == 3 and not summary.stopped_early
+    assert summary.first_date == "2021-07-13"
+    assert 0 < summary.remaining < summary.tracked_moisture
+
+    # Stop after the event day, as soon as the threshold is met
+    for path in output_dir(config).glob("*.nc"):
+        path.unlink()
+    config = run_case(config, "backtrack", stop_threshold=100)
+    summary = xr.load_dataset(output_dir(config) / "summary.nc")
+    assert summary.days == 1 and summary.stopped_early
+    assert summary.first_date == summary.last_date == "2021-07-15"
+    assert not (output_dir(config) / "2021-07-14_s_track.nc").exists()
+
+    # Only the days with output are aggregated
+    run_case(config, "aggregate")
+    assert xr.open_dataset(output_dir(config) / "aggregate.nc").days.values.tolist() == [1]
+
+
+def test_preprocess_on_the_fly(tmp_path):
+    config = make_modellevel_case(tmp_path, preprocessed_data_folder=str(tmp_path / "spilled"))
+    memory = run_case(config, "backtrack", spill=True, output_folder=str(tmp_path / "memory"))
+    assert xr.open_dataset(output_dir(memory) / "2021-07-14_s_track.nc").e_track.sum() > 0
+
+    # Tracking the spilled files gives the same result
+    files = run_case(config, "backtrack", preprocess=None, output_folder=str(tmp_path / "files"))
+    assert_same_output(output_dir(memory), output_dir(files))
+
+    # Ensemble runs can preprocess on the fly as well
+    event = {key: config[key] for key in ["event_start_date", "event_end_date", "region"]}
+    ensemble = run_case(config, "ensemble", events=[{"name": "event", **event}])
+    assert_same_output(output_dir(ensemble, "event/backtrack"), output_dir(memory))
+
+
+def test_stacked_layers(tmp_path):
+    config = make_modellevel_case(tmp_path)
+
+    runs = {}
+    layer_boundaries = [
+        ("two", None), ("stacked", [111]), ("three", [105, 120]), ("four", [100, 111, 128])
+    ]
+    for name, boundaries in layer_boundaries:
+        runs[name] = run_case(
+            config, "backtrack", layer_boundaries=boundaries, output_folder=str(tmp_path / name)
+        )
+    summaries = {name: xr.load_dataset(output_dir(run) / "summary.nc") for name, run in runs.items()}
+
+    # The boundary of the two-layer data, stacked, gives the same result
+    two = xr.load_dataset(output_dir(runs["two"]) / "2021-07-14_s_track.nc")
+    stacked = xr.load_dataset(output_dir(runs["stacked"]) / "2021-07-14_s_track.nc")
+    for i, layer in enumerate(["upper", "lower"]):
+        np.testing.assert_allclose(stacked.s_track[i], two[f"s_track_{layer}"], rtol=1e-10)
+        np.testing.assert_allclose(
+            stacked.s_track_restart[i], two[f"s_track_{layer}_restart"], rtol=1e-10
+        )
+    for name in ["e_track", "north_loss", "south_loss", "east_loss", "west_loss"]:
+        np.testing.assert_allclose(stacked[name], two[name], rtol=1e-10)
+    xr.testing.assert_allclose(summaries["stacked"], summaries["two"])
+
+    output = xr.load_dataset(output_dir(runs["four"]) / "2021-07-14_s_track.nc")
+    assert output.s_track.sizes["layer"] == 4
+    assert (output.s_track.sum(["lat", "lon"]) > 0).all()
+
+    # The same precipitation is tracked, in more layers
+    two, four = summaries["two"], summaries["four"]
+    np.testing.assert_allclose(four.tracked_moisture, two.tracked_moisture, rtol=1e-3)
+    np.testing.assert_allclose(four.e_track, two.e_track, rtol=0.2)
+
+    # The implicit scheme tracks stacked layers as well
+    implicit = run_case(
+        runs["three"], "backtrack", tracking_scheme="implicit", output_folder=str(tmp_path / "implicit")
+    )
+    three = summaries["three"]
+    implicit = xr.load_dataset(output_dir(implicit) / "summary.nc")
+    np.testing.assert_allclose(implicit.tracked_moisture, three.tracked_moisture, rtol=1e-3)
+    np.testing.assert_allclose(implicit.e_track, three.e_track, rtol=0.2)
+
+    # Ensemble runs and aggregation also handle stacked layers; the preprocessed
+    # data is not written, so the aggregation takes its grid from the output
+    events = [{"name": "event", "event_start_date": config["event_start_date"],
+               "event_end_date": config["event_end_date"], "region": config["region"]}]
+    ensemble = run_case(runs["four"], "ensemble", events=events, output_folder=str(tmp_path / "ensemble"))
+    assert_same_output(output_dir(ensemble, "event/backtrack"), output_dir(runs["four"]))
+
+    main(["aggregate", str(tmp_path / "four.yaml")])
+    result = xr.load_dataset(output_dir(runs["four"]) / "aggregate.nc")
+    np.testing.assert_allclose(result.s_track_sum[0], output.s_track)
+
+    # Attribution sums the tracked moisture over the layers
+    output = xr.load_dataset(output_dir(runs["three"]) / "2021-07-14_s_track.nc")
+    labels = (output.lat > 50).astype("int32").broadcast_like(output.e_track)
+    labels = labels.rename(lat="latitude", lon="longitude")
+    labels.to_dataset(name="band").to_netcdf(tmp_path / "labels.nc")
+    main([
+        "attribute", str(tmp_path / "three.yaml"), str(tmp_path / "labels.nc"),
+        "--labels-variable", "band", "--variables", "s_track",
+    ])
+    result = xr.load_dataset(output_dir(runs["three"]) / "attribution.nc")
+    assert output.s_track.sizes["layer"] == 3
+    north = output.s_track.sum("layer").where(output.lat > 50).sum()
+    np.testing.assert_allclose(result.s_track.sel(label=1)[0], north)
+
+
+def test_probes(tmp_path):
+    config = run_case(
+        make_case(tmp_path), "backtrack", output_frequency="3h", probes=[[50, 4], [45.2, 9.1]]
+    )
+
+    probes = xr.open_dataset(output_dir(config) / "2021-07-15_s_track_probes.nc")
+    daily = xr.open_dataset(output_dir(config) / "2021-07-15_s_track.nc")
+    assert probes.e_track.shape == (2, 96)
+    assert probes.lat.values.tolist() == [50, 46] and probes.lon.values.tolist() == [4, 10]
+    assert (output_dir(config) / "2021-07-15_s_track_subdaily.nc").exists()
+
+    # Same values as the daily output at the probe cells
+    at_probes = daily.isel(lat=xr.DataArray([5, 7], dims="probe"), lon=xr.DataArray([7, 10], dims="probe"))
+    assert probes.e_track.sum("time").values.sum() > 0
+    np.testing.assert_allclose(probes.e_track.sum("time"), at_probes.e_track)
+    np.testing.assert_allclose(probes.s_track_upper.mean("time"), at_probes.s_track_upper)
+    np.testing.assert_allclose(probes.s_track_lower[:, 0], at_probes.s_track_lower_restart)
+
+    with pytest.raises(ValueError):
+        probe_index(daily.lat.values, daily.lon.values, [[30, 0]])
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_bidirectional(tmp_path, spill):
+    config = make_case(tmp_path, event_start_date="20210713")
+    run_case(config, "bidirectional", day_cache_spill=spill)
+
+    # The backward sweep gives the same result as the backtrack command
+    single = run_case(config, "backtrack", output_folder=str(tmp_path / "single"))
+    assert_same_output(output_dir(config), output_dir(single), summary=False)
+
+    # The forward sweep conserves the evaporation from the region
+    region = xr.open_dataset(config["region"]).region_flood.values
+    evaporated, precipitated, losses = 0, 0, 0
+    for date in ["2021-07-13", "2021-07-14", "2021-07-15"]:
+        ds = xr.open_dataset(tmp_path / f"{date}_fluxes_storages.nc")
+        fluxes, states = resample(ds, config["target_frequency"])
+        prepare_fluxes(fluxes, states, config["target_frequency"], config["kvf"])
+        evaporated += (region * fluxes.evap.values)[:, 1:-1, 1:-1].sum()
+
+        output = xr.open_dataset(output_dir(config, "forwardtrack") / f"{date}_s_track.nc")
+        precipitated += float(output.p_track.sum())
+        losses += sum(float(output[f"{side}_loss"].sum()) for side in ["north", "south", "east", "west"])
+    remaining = float(output.s_track_upper_restart.sum() + output.s_track_lower_restart.sum())
+    assert precipitated > 0
+    np.testing.assert_allclose(remaining + precipitated + losses, evaporated)
+
+    with pytest.raises(ValueError):
+        run_case(config, "bidirectional", output_frequency="3h")
+
+
+def test_regions(tmp_path):
+    config = run_case(make_case(tmp_path, event_start_date="20210714"), "backtrack")
+
+    # The region of the config, a second one and the two together
+    region = xr.open_dataset(config["region"]).region_flood
+    west = region.where(region.longitude < 4, 0)
+    regions = xr.concat([region, west, region + west], dim="region")
+    regions.to_dataset(name="region").to_netcdf(tmp_path / "regions.nc")
+    run_case(config, "regions", str(tmp_path / "regions.nc"))
+
+    operators = sorted(output_dir(config, "operators").glob("*_operator.npz"))
+    assert len(operators) == 3
+    for date in ["2021-07-13", "2021-07-14", "2021-07-15"]:
+        expected = xr.load_dataset(output_dir(config) / f"{date}_s_track.nc")
+        output = xr.load_dataset(output_dir(config, "regions") / f"{date}_s_track_regions.nc")
+        assert output.e_track.sizes["region"] == 3
+        first = output.isel(region=0)
+        for name in ["e_track", "north_loss", "east_loss"]:
+            np.testing.assert_allclose(first[name], expected[name], rtol=1e-10, atol=1e-6)
+        np.testing.assert_allclose(first.s_track.isel(layer=1), expected.s_track_lower, rtol=1e-10)
+
+    # The saved operators are reused, unless the input of their day changed
+    mtimes = [path.stat().st_mtime_ns for path in operators]
+    updated = tmp_path / "2021-07-14_fluxes_storages.nc"
+    xr.load_dataset(updated).to_netcdf(updated)
+    run_case(config, "regions", str(tmp_path / "regions.nc"))
+    changed = [path.stat().st_mtime_ns != mtime for path, mtime in zip(operators, mtimes)]
+    assert changed == [False, True, False]
+
+
+def test_time_parallel(tmp_path, capsys):
+    # Two segments of eight days, with precipitation in the second one only
+    config = synthetic_case(tmp_path, "2021-07-01", "2021-07-17", grid)
+    config.update(output_folder=str(tmp_path / "output"), event_start_date="20210715")
+    config = run_case(config, "backtrack")
+    serial = xr.load_dataset(output_dir(config) / "summary.nc")
+
+    def e_track(config, day):
+        return xr.load_dataset(output_dir(config) / f"2021-07-{day:02d}_s_track.nc").e_track
+
+    for name, correction_days, stopped in [("tolerance", 10, 4), ("cap", 3, 6)]:
+        parallel = run_case(
+            config,
+            "backtrack-parallel",
+            output_folder=str(tmp_path / name),
+            time_segments=2,
+            time_tolerance=0.05,
+            time_correction_days=correction_days,
+        )
+
+        # The second segment is tracked like in the serial run
+        for day in range(9, 17):
+            file = f"2021-07-{day:02d}_s_track.nc"
+            xr.testing.assert_allclose(
+                xr.load_dataset(output_dir(parallel) / file), xr.load_dataset(output_dir(config) / file)
+            )
+
+        # The correction starts from the exact state at the end of the first
+        # segment and stops early; the earlier days keep their own output
+        np.testing.assert_allclose(e_track(parallel, 8), e_track(config, 8))
+        assert all(e_track(parallel, day).sum() == 0 for day in range(1, stopped))
+        assert e_track(config, 1).sum() > 0
+        summary = xr.load_dataset(output_dir(parallel) / "summary.nc")
+        for variable in ["tracked_moisture", "e_track"]:
+            np.testing.assert_allclose(summary[variable], serial[variable], rtol=0.01)
+
+        # A correction that stops at the cap, before the tolerance, is reported
+        reported = "stopped on 2021-07-06" in capsys.readouterr().out
+        assert reported == (name == "cap")
+
+    for unsupported in [{"stop_threshold": 1}, {"probes": [[50, 4]]}]:
+        with pytest.raises(ValueError):
+            run_case(config, "backtrack-parallel", **unsupported)
@@ -0,0 +1,30 @@
+import numpy as np
+
+from wam2layers.benchmarks.suite import BENCHMARKS, check_engines, run_benchmark
+from wam2layers.benchmarks.synthetic import synthetic_fluxes_storages
+
+# Small grid to keep the tests fast: resolution, (south, north, west, east)
+grid = (2.0, (40, 60, -10, 20))
+
+
+def test_synthetic_fluxes_storages():
+    ds = synthetic_fluxes_storages(grid=grid)
+    assert ds.fx_upper.shape == (25, 11, 16)
+    assert np.all(ds.s_upper > 0) and np.all(ds.s_lower > 0)
+    assert np.all(ds.precip >= 0) and np.all(ds.evap >= 0)
+    assert ds.precip.sum() > 0
+
+    # Fluxes should go in all directions
+    assert ds.fx_lower.min() < 0 < ds.fx_lower.max()
+    assert ds.fy_lower.min() < 0 < ds.fy_lower.max()
+
+
+def test_run_benchmarks():
+    for name in BENCHMARKS:
+        result = run_benchmark(name, grid, repeat=1, memory=False)
+        assert result["best"] > 0
+
+
+def test_check_engines():
+    for name, result in check_engines(grid).items():
+        assert result["ok"], f"{name} deviates from the numpy reference engine"
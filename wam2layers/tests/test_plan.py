@@ -0,0 +1,60 @@
+import xarray as xr
+import yaml
+
+from wam2layers.benchmarks.synthetic import synthetic_case, synthetic_era5_modellevels
+from wam2layers.cli import main
+from wam2layers.plan import plan
+from wam2layers.tracking.backtrack import prepare_fluxes, resample
+
+coefficients = {"preprocess": 1e-8, "prepare": 1e-8, "track": 2e-8}
+
+
+def nbytes(ds):
+    return sum(da.nbytes for da in ds.data_vars.values())
+
+
+def test_plan(tmp_path):
+    config = synthetic_case(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    result = plan(config, memory_budget=8e9, cpus=2, coefficients=coefficients)
+    assert result["shape"]["latitude"] == 11 and result["shape"]["longitude"] == 16
+    assert not result["settings"]["streaming"]
+    assert result["runtime_total"] > 0
+
+    # The sizes are those of the actual data
+    ds = xr.open_dataset(tmp_path / "2021-07-15_fluxes_storages.nc")
+    fluxes, states = resample(ds, config["target_frequency"])
+    prepare_fluxes(fluxes, states, config["target_frequency"], config["kvf"])
+    assert result["memory"]["read"] == nbytes(ds)
+    assert result["memory"]["prepare"] == nbytes(fluxes) + nbytes(states)
+    assert result["memory"]["day_cache"] == 3 * result["memory"]["prepare"]
+
+    # With little memory, the days are streamed
+    small = plan(config, memory_budget=2e6, cpus=2, coefficients=coefficients)
+    assert small["settings"]["streaming"]
+    assert small["settings"]["read_ahead"] >= 1
+    assert small["peak_memory"] < result["peak_memory"]
+
+
+def test_plan_preprocessing(tmp_path):
+    grid = (2.0, (40, 60, -10, 20))
+    config = synthetic_case(tmp_path, "2021-07-14", "2021-07-15", grid)
+    config.update(synthetic_era5_modellevels(tmp_path, grid=grid))
+    config.update(preprocess="era5-modellevels", layer_boundaries=[100, 111, 128])
+    config["events"] = [{"name": "first"}, {"name": "second"}]
+
+    result = plan(config, memory_budget=8e9, cpus=8, coefficients=coefficients)
+    assert result["shape"]["level"] == len(config["modellevels"])
+    assert result["shape"]["layer"] == 4
+    assert result["settings"]["ensemble_workers"] == 2
+    assert result["settings"]["preprocess_ahead"] >= 1
+    assert result["runtime"]["preprocess"] > 0
+
+
+def test_plan_cli(tmp_path, capsys):
+    config = synthetic_case(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    config_file = tmp_path / "case.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+    main(["plan", str(config_file), "--memory", "4"])
+    out = capsys.readouterr().out
+    assert "recommended settings" in out
+    assert "day cache of a bidirectional run" in out
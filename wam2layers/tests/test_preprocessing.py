@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import yaml
+
+from wam2layers.benchmarks.synthetic import (
+    synthetic_era5_modellevels,
+    synthetic_era5_pressurelevels,
+)
+from wam2layers.preprocessing import preprocess_era5, preprocess_era5_modellevels
+from wam2layers.preprocessing.preprocessing import (
+    derive_layers,
+    derive_stacked_layers,
+    get_bounding_box,
+    get_grid_info,
+    interpolate,
+    select_bounding_box,
+    validation_index,
+)
+
+
+def test_modellevels_column_water(tmp_path):
+    grid = (2.0, (40, 60, -10, 20))
+    config = synthetic_era5_modellevels(tmp_path, grid=grid)
+    ds = preprocess_era5_modellevels.preprocess_day(pd.Timestamp("2021-07-14"), config)
+
+    # With the vertical integral, both layers together hold the total column water
+    a_gridcell, _, _ = get_grid_info(ds)
+    tcw = xr.open_dataset(tmp_path / "FloodCase_202107_tcw.nc").tcw
+    s_total = (ds.s_upper + ds.s_lower) / a_gridcell[None, :, None] * 1000
+    np.testing.assert_allclose(s_total, tcw, rtol=1e-6)
+    assert (ds.s_upper > 0).all() and (ds.s_lower > ds.s_upper).all()
+
+
+def test_bounding_box(tmp_path):
+    config = synthetic_era5_modellevels(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    date = pd.Timestamp("2021-07-14")
+    full = preprocess_era5_modellevels.preprocess_day(date, config)
+
+    config["bounding_box"] = [44, 52, 0, 10]
+    subset = preprocess_era5_modellevels.preprocess_day(date, config)
+    assert subset.latitude.values.tolist() == [52, 50, 48, 46, 44]
+    assert subset.longitude.values.tolist() == [0, 2, 4, 6, 8, 10]
+    xr.testing.assert_allclose(subset, full.sel(latitude=subset.latitude, longitude=subset.longitude))
+
+    # Box crossing the edge of the longitude range
+    box = select_bounding_box(full.precip, (44, 52, 16, -6))
+    assert box.longitude.values.tolist() == [16, 18, 20, -10, -8, -6]
+
+    # Longitudes of the data from 0 to 360, of the box from -180 to 180
+    shifted = full.precip.assign_coords(longitude=full.longitude % 360).sortby("longitude")
+    box = select_bounding_box(shifted, (44, 52, -6, 4))
+    assert box.longitude.values.tolist() == [354, 356, 358, 0, 2, 4]
+    with pytest.raises(ValueError):
+        select_bounding_box(full.precip, (44, 52, 100, 120))
+
+    # Extent of a region that crosses the dateline
+    longitude = np.arange(-180, 180, 2.0)
+    region = xr.DataArray(
+        np.isin(longitude, [176, 178, -180, -178])[None].astype(float),
+        coords={"latitude": [50.0], "longitude": longitude},
+    )
+    region.to_dataset(name="region_flood").to_netcdf(tmp_path / "region.nc")
+    config = {"region": str(tmp_path / "region.nc"), "region_buffer": 2}
+    assert get_bounding_box(config) == (48, 52, 174, 184)
+    global_data = region.expand_dims(time=2)
+    box = select_bounding_box(global_data, get_bounding_box(config))
+    assert box.longitude.values.tolist() == [174, 176, 178, -180, -178, -176]
+
+
+def test_cumulative_integrals(tmp_path):
+    grid = (2.0, (40, 60, -10, 20))
+    config = synthetic_era5_modellevels(tmp_path, grid=grid)
+    date = pd.Timestamp("2021-07-14")
+    cumulative = preprocess_era5_modellevels.cumulative_integrals(date, config)
+
+    # The default boundary gives the same result as the preprocessing
+    expected = preprocess_era5_modellevels.preprocess_day(date, config)
+    derived = derive_layers(cumulative, preprocess_era5_modellevels.boundary)
+    xr.testing.assert_allclose(derived, expected)
+
+    # Lower boundaries move moisture to the upper layer, total stays the same
+    lower = derive_layers(cumulative, 128)
+    assert (lower.s_upper > expected.s_upper).all()
+    xr.testing.assert_allclose(lower.s_upper + lower.s_lower, expected.s_upper + expected.s_lower)
+
+    # More layers, stacked from the top down
+    stacked = derive_stacked_layers(cumulative, [100, 111, 128])
+    assert stacked.s.sizes["layer"] == 4
+    upper = stacked.s.isel(layer=slice(0, 2)).sum("layer")
+    xr.testing.assert_allclose(upper, expected.s_upper)
+    xr.testing.assert_allclose(stacked.fx.sum("layer"), expected.fx_upper + expected.fx_lower)
+
+    # Only levels for which the integral is stored can be used
+    sparse = preprocess_era5_modellevels.cumulative_integrals(date, config, [110, 120])
+    xr.testing.assert_allclose(derive_layers(sparse, 111), expected)
+    with pytest.raises(ValueError):
+        derive_layers(sparse, 128)
+
+    # Every layer holds at least one model level
+    for boundaries in [[137], [10], [110, 112], [111, 111]]:
+        with pytest.raises(ValueError, match="without model levels"):
+            derive_stacked_layers(cumulative, boundaries)
+
+
+def test_incremental_preprocessing(tmp_path):
+    config = synthetic_era5_modellevels(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    config.update(
+        preprocessed_data_folder=str(tmp_path / "preprocessed"),
+        preprocess_start_date="20210714",
+        preprocess_end_date="20210715",
+    )
+    config_file = tmp_path / "case.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+    output = tmp_path / "preprocessed" / "2021-07-14_fluxes_storages.nc"
+
+    preprocess_era5_modellevels.run_preprocessing(config_file)
+    first = output.stat().st_mtime_ns
+
+    # Nothing changed: the day is not preprocessed again
+    preprocess_era5_modellevels.run_preprocessing(config_file)
+    assert output.stat().st_mtime_ns == first
+
+    # A changed input file or setting makes the day stale
+    os.utime(tmp_path / "FloodCase_202107_sp.nc", ns=(0, 0))
+    preprocess_era5_modellevels.run_preprocessing(config_file)
+    second = output.stat().st_mtime_ns
+    assert second != first
+
+    config["bounding_box"] = [44, 52, 0, 10]
+    config_file.write_text(yaml.safe_dump(config))
+    preprocess_era5_modellevels.run_preprocessing(config_file)
+    assert output.stat().st_mtime_ns != second
+    assert xr.open_dataset(output).latitude.size == 5
+
+
+def test_validation():
+    assert validation_index((4, 5), "off") is None
+    assert validation_index((4, 5), "sampled", samples=6)[0].size == 6
+    first, second = (validation_index((10, 10), "sampled", seed=(0, 20210714)) for _ in range(2))
+    np.testing.assert_array_equal(first, second)
+    assert not np.array_equal(first, validation_index((10, 10), "sampled", seed=(1, 20210714)))
+    with pytest.raises(ValueError):
+        validation_index((4, 5), "some")
+
+    xp = np.broadcast_to(np.arange(5.0)[:, None, None], (5, 3, 4))
+    x = np.full((3, 4), 2.5)
+    for validation in ["off", "sampled", "full"]:
+        np.testing.assert_allclose(interpolate(x, xp, 2 * xp, axis=0, validation=validation), 5)
+
+    # Values outside the range of xp are found by the checks
+    x[1, 2] = 6
+    with pytest.raises(ValueError):
+        interpolate(x, xp, xp, axis=0)
+    with pytest.raises(ValueError):
+        interpolate(np.full((3, 4), 6.0), xp, xp, axis=0, validation="sampled")
+
+
+def test_concurrent_reads(tmp_path):
+    config = synthetic_era5_pressurelevels(tmp_path, grid=(2.0, (40, 60, -10, 20)))
+    date = pd.Timestamp("2013-05-31")
+    assert not any("tcw" in path.name for path in preprocess_era5.input_files(date, config))
+
+    # The result doesn't depend on the number of threads that read the input
+    config["read_workers"] = 1
+    sequential = preprocess_era5.preprocess_day(date, config)
+    config["read_workers"] = 4
+    xr.testing.assert_identical(preprocess_era5.preprocess_day(date, config), sequential)
@@ -1,3 +1,5 @@
+import sys
+from collections import namedtuple
 from pathlib import Path
 
 import numpy as np
@@ -5,63 +7,116 @@ import pandas as pd
 import xarray as xr
 import yaml
 
-from analysis.visualization import make_diagnostic_figures
-from preprocessing import get_grid_info
+from wam2layers.preprocessing import PREPROCESSORS
+from wam2layers.preprocessing.preprocessing import (
+    derive_layers,
+    get_grid_info,
+    preprocessed_days,
+    resolve_bounding_box,
+)
+from wam2layers.tracking.io import (
+    FILE_LOCK,
+    Outputs,
+    ProbeOutput,
+    SubdailyOutput,
+    probe_index,
+)
 
-# Read case configuration
-with open("cases/era5_2021.yaml") as f:
-    config = yaml.safe_load(f)
 
+def time_in_range(start, end, current):
+    """Returns whether current is in the range [start, end]"""
+    return start <= current <= end
 
-datelist = pd.date_range(
-    start=config["track_start_date"],
-    end=config["track_end_date"],
-    freq="d",
-    inclusive="left",
-)
 
-input_dir = Path(config["preprocessed_data_folder"]).expanduser()
-output_dir = Path(config["output_folder"]).expanduser() / "backtrack"
+def figures_due(setting, i, ndays):
+    """Returns whether to make diagnostic figures for the i-th tracked day.
 
-# Check if input dir exists
-if not input_dir.exists():
-    raise ValueError(
-        "Please create the preprocessed_data_folder before running the script"
-    )
+    Setting can be False (never), "end" (only for the last day), or N (every N days).
+    """
+    if not setting:
+        return False
+    if setting == "end":
+        return i == ndays - 1
+    return i % int(setting) == 0
 
-# Create output dir if it doesn't exist yet
-if not output_dir.exists():
-    output_dir.mkdir(parents=True)
 
+def input_path(date, input_dir):
+    return f"{input_dir}/{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"
 
-def time_in_range(start, end, current):
-    """Returns whether current is in the range [start, end]"""
-    return start <= current <= end
 
+def cumulative_path(date, input_dir):
+    return f"{input_dir}/{date.strftime('%Y-%m-%d')}_cumulative.nc"
 
-def input_path(date):
-    return f"{input_dir}/{date.strftime('%Y-%m-%d')}_fluxes_storages.nc"
 
+def load_input(date, input_dir, config):
+    """Open the preprocessed data of a day.
+
+    If `layer_boundary` is set in the config, the two layers are derived for
+    that boundary from the cumulative integrals written by the preprocessing.
+    """
+    boundary = config.get("layer_boundary")
+    if boundary is None:
+        return xr.open_dataset(input_path(date, input_dir))
+    cumulative = xr.open_dataset(cumulative_path(date, input_dir))
+    layers = derive_layers(cumulative, boundary)
+    layers.set_close(cumulative.close)
+    return layers
+
+
+def input_days(dates, input_dir, config):
+    """Yield the preprocessed data of each date, in the given order.
+
+    The data is read from the files written by the preprocessing, or, if
+    `preprocess` is set in the config (e.g. "era5-modellevels"), preprocessed
+    in memory on the fly. Then, the preprocessed files are only written if
+    `spill` is set as well.
+
+    Files are opened, and days are preprocessed (in a background thread),
+    holding FILE_LOCK; callers that use files in the meantime hold it as well.
+    """
+    source = config.get("preprocess")
+    if source is None:
+        for date in dates:
+            with FILE_LOCK:
+                preprocessed_data = load_input(date, input_dir, config)
+            yield preprocessed_data
+        return
+
+    from importlib import import_module
+
+    preprocess_day = import_module(PREPROCESSORS[source]).preprocess_day
+    yield from preprocessed_days(
+        preprocess_day,
+        dates,
+        resolve_bounding_box(config),
+        read_ahead=config.get("preprocess_ahead", 1),
+        spill_dir=input_dir if config.get("spill", False) else None,
+        lock=FILE_LOCK,
+    )
 
-def output_path(date):
+
+def output_path(date, output_dir):
     return f"{output_dir}/{date.strftime('%Y-%m-%d')}_s_track.nc"
 
 
+def subdaily_output_path(date, output_dir):
+    return f"{output_dir}/{date.strftime('%Y-%m-%d')}_s_track_subdaily.nc"
+
+
+def probes_output_path(date, output_dir):
+    return f"{output_dir}/{date.strftime('%Y-%m-%d')}_s_track_probes.nc"
+
+
 def to_edges_zonal(fx, periodic_boundary=False):
     """Define the horizontal fluxes over the east/west boundaries."""
     fe = np.zeros_like(fx)
-    fe[:, :-1] = 0.5 * (fx[:, :-1] + fx[:, 1:])
+    fe[..., :-1] = 0.5 * (fx[..., :-1] + fx[..., 1:])
     if periodic_boundary:
-        fe[:, -1] = 0.5 * (fx[:, -1] + fx[:, 0])
-
-    # find out where the positive and negative fluxes are
-    f_pos = np.ones_like(fx)
-    f_pos[fe < 0] = 0
-    f_neg = f_pos - 1
+        fe[..., -1] = 0.5 * (fx[..., -1] + fx[..., 0])
 
     # separate directions west-east (all positive numbers)
-    fe_we = fe * f_pos
-    fe_ew = fe * f_neg
+    fe_we = np.maximum(fe, 0)
+    fe_ew = np.maximum(-fe, 0)
 
     # fluxes over the western boundary
     fw_we = look_west(fe_we)
@@ -73,16 +128,11 @@ def to_edges_zonal(fx, periodic_boundary=False):
 def to_edges_meridional(fy):
     """Define the horizontal fluxes over the north/south boundaries."""
     fn = np.zeros_like(fy)
-    fn[1:, :] = 0.5 * (fy[:-1, :] + fy[1:, :])
-
-    # find out where the positive and negative fluxes are
-    fn_pos = np.ones_like(fn)
-    fn_pos[fn < 0] = 0  # invalid value encountered in less
-    fn_neg = fn_pos - 1
+    fn[..., 1:, :] = 0.5 * (fy[..., :-1, :] + fy[..., 1:, :])
 
     # separate directions south-north (all positive numbers)
-    fn_sn = fn * fn_pos
-    fn_ns = fn * fn_neg
+    fn_sn = np.maximum(fn, 0)
+    fn_ns = np.maximum(-fn, 0)
 
     # fluxes over the southern boundary
     fs_sn = look_south(fn_sn)
@@ -112,18 +162,14 @@ def look_west(array):
 
 
 def split_vertical_flux(Kvf, fv):
-    f_downward = np.zeros_like(fv)
-    f_upward = np.zeros_like(fv)
-    f_downward[fv >= 0] = fv[fv >= 0]
-    f_upward[fv <= 0] = fv[fv <= 0]
-    f_upward = np.abs(f_upward)
+    f_downward = np.maximum(fv, 0)
+    f_upward = np.maximum(-fv, 0)
 
-    # include the vertical dispersion
+    # include the vertical dispersion: Kvf * |fv| in both directions
     if Kvf != 0:
-        f_upward = (1.0 + Kvf) * f_upward
-        f_upward[fv >= 0] = fv[fv >= 0] * Kvf
-        f_downward = (1.0 + Kvf) * f_downward
-        f_downward[fv <= 0] = np.abs(fv[fv <= 0]) * Kvf
+        dispersion = Kvf * np.abs(fv)
+        f_downward += dispersion
+        f_upward += dispersion
 
     return f_downward, f_upward
 
@@ -138,313 +184,921 @@ def resample(ds, target_freq):
     newtime_states = pd.date_range(time[0], time[-1], freq=target_freq)
     newtime_fluxes = newtime_states[:-1] + pd.Timedelta(target_freq) / 2
 
-    states = ds[['s_upper', 's_lower']].interp(time=newtime_states)
-    fluxes = ds[['fx_upper', 'fx_lower', 'fy_upper', 'fy_lower']].interp(time=newtime_fluxes)
+    # Data with more than two layers has them stacked on a layer axis
+    if "layer" in ds.dims:
+        state_names, flux_names = ["s"], ["fx", "fy"]
+    else:
+        state_names = ['s_upper', 's_lower']
+        flux_names = ['fx_upper', 'fx_lower', 'fy_upper', 'fy_lower']
+    states = ds[state_names].interp(time=newtime_states)
+    fluxes = ds[flux_names].interp(time=newtime_fluxes)
     surface = ds[['precip', 'evap']].reindex(time=newtime_fluxes, method="bfill") / resample_ratio
     return fluxes.merge(surface), states
 
 
-def change_units(fluxes, target_freq):
-    """Change units to m3.
-    Multiply by edge length to get flux in m3
-    Multiply by time to get accumulation instead of flux
-    Divide by density of water to go from kg to m3
-    """
-    density = 1000  # [kg/m3]
-    a, ly, lx = get_grid_info(fluxes)
-
-    total_seconds = pd.Timedelta(target_freq).total_seconds()
-    fluxes["fx_upper"] *= total_seconds / density * ly
-    fluxes["fx_lower"] *= total_seconds / density * ly
-    fluxes["fy_upper"] *= total_seconds / density * lx[None, :, None]
-    fluxes["fy_lower"] *= total_seconds / density * lx[None, :, None]
-    fluxes["evap"] *= a[None, :, None]
-    fluxes["precip"] *= a[None, :, None]
-
-    for variable in fluxes.data_vars:
-        fluxes[variable] = fluxes[variable].assign_attrs(units="m**3")
+def convergence(fx, fy):
+    # Note: latitude decreasing, hence positive fy gradient is convergence
+    return np.gradient(fy, axis=-2) - np.gradient(fx, axis=-1)
 
 
-def stabilize_fluxes(fluxes, states):
-    """Stabilize the outfluxes / influxes.
+def volume_factors(ds, target_freq):
+    """Return the factors to convert fluxes to m3 per time step.
 
-    During the reduced timestep the water cannot move further than 1/x * the
-    gridcell, In other words at least x * the reduced timestep is needed to
-    cross a gridcell.
+    Multiply fx by the edge length and time, fy by the edge length (per
+    latitude) and time, and evaporation and precipitation by the area.
     """
-    for level in ["upper", "lower"]:
-        fx = fluxes["fx_" + level]
-        fy = fluxes["fy_" + level]
-        s = states["s_" + level]
+    density = 1000  # [kg/m3]
+    a, ly, lx = get_grid_info(ds)
+    total_seconds = pd.Timedelta(target_freq).total_seconds()
+    fx_to_volume = total_seconds / density * ly
+    fy_to_volume = (total_seconds / density * lx)[:, None]
+    return fx_to_volume, fy_to_volume, a[:, None]
 
-        fx_abs = np.abs(fx)
-        fy_abs = np.abs(fy)
-        ft_abs = fx_abs + fy_abs
 
-        fx_corrected = 1/2 * fx_abs / ft_abs * s[:-1, :, :].values
-        fx_stable = np.minimum(fx_abs, fx_corrected)
+def prepare_timestep(step, factors, kvf, stabilize=True):
+    """Change units and stabilize the fluxes of a single time step, in place.
 
-        fy_corrected = 1/2 * fy_abs / ft_abs * s[:-1, :, :].values
-        fy_stable = np.minimum(fy_abs, fy_corrected)
+    Step is a Timestep without f_vert; the vertical flux is returned. The
+    implicit scheme is stable for any time step, so it doesn't need the
+    stabilization (stabilize=False).
+    """
+    fx_to_volume, fy_to_volume, area = factors
+    np.multiply(step.evap, area, out=step.evap)
+    np.multiply(step.precip, area, out=step.precip)
+
+    for fx, fy, s in [
+        (step.fx_upper, step.fy_upper, step.s_upper),
+        (step.fx_lower, step.fy_lower, step.s_lower),
+    ]:
+        fx *= fx_to_volume
+        fy *= fy_to_volume
+        if not stabilize:
+            continue
+
+        # During the reduced timestep the water cannot move further than
+        # 1/2 * the gridcell: scale both components by the same factor
+        ft_abs = np.abs(fx)
+        ft_abs += np.abs(fy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stable = 0.5 * s / ft_abs
+        np.minimum(stable, 1, out=stable)
+        stable[ft_abs == 0] = 0
+        fx *= stable
+        fy *= stable
+
+    # Relative storages and flux limit at the temporal midpoint
+    s_rel_upper = 0.5 * (
+        step.s_upper / (step.s_upper + step.s_lower)
+        + step.s_upper_next / (step.s_upper_next + step.s_lower_next)
+    )
+    s_rel_lower = 1 - s_rel_upper
 
-        # Get rid of any nan values
-        fx_stable.fillna(0)
-        fy_stable.fillna(0)
+    # Water balance of each layer, with the convergence of its own fluxes
+    residual_upper = step.s_upper_next - step.s_upper - (
+        convergence(step.fx_upper, step.fy_upper) - step.precip * s_rel_upper
+    )
+    residual_lower = step.s_lower_next - step.s_lower - (
+        convergence(step.fx_lower, step.fy_lower) - step.precip * s_rel_lower + step.evap
+    )
 
-        # Re-instate the sign
-        fluxes["fx_"+ level] = np.sign(fx) * fx_stable
-        fluxes["fy_"+ level] = np.sign(fy) * fy_stable
+    # compute the resulting vertical moisture flux; the vertical velocity so
+    # that the new residual_lower/s_lower = residual_upper/s_upper (positive downward)
+    fv = s_rel_lower * (residual_upper + residual_lower) - residual_lower
+    if not stabilize:
+        return fv
 
+    # stabilize the outfluxes / influxes; during the reduced timestep the
+    # vertical flux can maximally empty/fill 1/x of the top or down storage
+    stab = 1.0 / (kvf + 1.0)
+    flux_limit = stab * 0.5 * (
+        np.minimum(step.s_upper, step.s_lower)
+        + np.minimum(step.s_upper_next, step.s_lower_next)
+    )
+    return np.clip(fv, -flux_limit, flux_limit, out=fv)
 
-def convergence(fx, fy):
-    # Note: latitude decreasing, hence positive fy gradient is convergence
-    return np.gradient(fy, axis=-2) - np.gradient(fx, axis=-1)
 
+def prepare_fluxes(fluxes, states, target_freq, kvf, stabilize=True):
+    """Change units, stabilize the fluxes and calculate the vertical flux.
 
-def calculate_fv(fluxes, states, kvf, periodic):
-    """Calculate the vertical fluxes.
+    Does the same as change_units, stabilize_fluxes and calculate_fv (see
+    wam2layers.benchmarks.reference), but modifies the numpy arrays in fluxes
+    in place and processes one time step at a time, so only a few 2d
+    temporaries are needed. The vertical flux is added to fluxes as f_vert.
 
     Note: fluxes are given at temporal midpoints between states.
     """
-    s_total = states.s_upper + states.s_lower
-    s_rel_upper = (states.s_upper / s_total).interp(time=fluxes.time)
-    s_rel_lower = (states.s_lower / s_total).interp(time=fluxes.time)
+    factors = volume_factors(fluxes, target_freq)
+    f_vert = np.empty(fluxes["fx_upper"].shape)
+    for t, step in timesteps(fluxes, states, reverse=False):
+        f_vert[t] = prepare_timestep(step, factors, kvf, stabilize)
 
-    tendency_upper = convergence(fluxes.fx_upper, fluxes.fy_upper) - fluxes.precip.values * s_rel_upper
-    tendency_lower = convergence(fluxes.fx_upper, fluxes.fy_upper) - fluxes.precip.values * s_rel_lower + fluxes.evap
+    for variable in ["fx_upper", "fx_lower", "fy_upper", "fy_lower", "evap", "precip"]:
+        fluxes[variable] = fluxes[variable].assign_attrs(units="m**3")
+    fluxes["f_vert"] = (fluxes["fx_upper"].dims, f_vert)
 
-    residual_upper = states.s_upper.diff("time").values - tendency_upper
-    residual_lower = states.s_lower.diff("time").values - tendency_lower
 
-    # compute the resulting vertical moisture flux; the vertical velocity so
-    # that the new residual_lower/s_lower = residual_upper/s_upper (positive downward)
-    fv = s_rel_lower * (residual_upper + residual_lower) - residual_lower
+def prepare_layer_timestep(step, factors, kvf, stabilize=True):
+    """Change units and stabilize the fluxes of a LayerTimestep, in place.
+
+    Like prepare_timestep, for any number of layers. The vertical fluxes over
+    the interfaces between the layers are returned.
+    """
+    fx_to_volume, fy_to_volume, area = factors
+    np.multiply(step.evap, area, out=step.evap)
+    np.multiply(step.precip, area, out=step.precip)
+    fx, fy = step.fx, step.fy
+    fx *= fx_to_volume
+    fy *= fy_to_volume
+
+    if stabilize:
+        # During the reduced timestep the water cannot move further than
+        # 1/2 * the gridcell: scale both components by the same factor
+        ft_abs = np.abs(fx)
+        ft_abs += np.abs(fy)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stable = 0.5 * step.s / ft_abs
+        np.minimum(stable, 1, out=stable)
+        stable[ft_abs == 0] = 0
+        fx *= stable
+        fy *= stable
+
+    # Relative storages at the temporal midpoint
+    s_rel = 0.5 * (step.s / step.s.sum(axis=0) + step.s_next / step.s_next.sum(axis=0))
+
+    residual = step.s_next - step.s - (convergence(fx, fy) - step.precip * s_rel)
+    residual[-1] -= step.evap
+
+    # compute the resulting vertical moisture fluxes (positive downward), so
+    # that the new residual of each layer is proportional to its storage
+    fv = (
+        np.cumsum(residual, axis=0)[:-1]
+        - np.cumsum(s_rel, axis=0)[:-1] * residual.sum(axis=0)
+    )
+    if not stabilize:
+        return fv
 
     # stabilize the outfluxes / influxes; during the reduced timestep the
-    # vertical flux can maximally empty/fill 1/x of the top or down storage
+    # vertical flux can maximally empty/fill 1/x of the adjacent storages
     stab = 1.0 / (kvf + 1.0)
-    flux_limit = np.minimum(states.s_upper, states.s_lower).interp(time=fluxes.time)
-    fv_stable = np.minimum(np.abs(fv), stab * flux_limit)
+    flux_limit = stab * 0.5 * (
+        np.minimum(step.s[:-1], step.s[1:])
+        + np.minimum(step.s_next[:-1], step.s_next[1:])
+    )
+    return np.clip(fv, -flux_limit, flux_limit, out=fv)
 
-    # Reinstate the sign
-    return np.sign(fv) * fv_stable
 
+def prepare_layers(fluxes, states, target_freq, kvf, stabilize=True):
+    """Change units, stabilize the fluxes and calculate the vertical fluxes.
 
-def backtrack(
-    date,
-    fluxes,
-    states,
-    s_track_upper,
-    s_track_lower,
-    region,
-    kvf,
-):
+    Like prepare_fluxes, for data with the layers stacked on a layer axis.
+    The vertical fluxes are added to fluxes as f_vert, on an interface axis.
+    """
+    factors = volume_factors(fluxes, target_freq)
+    ntime, nlayer, nlat, nlon = fluxes["fx"].shape
+    f_vert = np.empty((ntime, nlayer - 1, nlat, nlon))
+    for t, step in layer_timesteps(fluxes, states, reverse=False):
+        f_vert[t] = prepare_layer_timestep(step, factors, kvf, stabilize)
+
+    for variable in ["fx", "fy", "evap", "precip"]:
+        fluxes[variable] = fluxes[variable].assign_attrs(units="m**3")
+    fluxes["f_vert"] = (["time", "interface", "latitude", "longitude"], f_vert)
+
+
+def layer_timesteps(fluxes, states, reverse=True):
+    """Yield (t, LayerTimestep) for data with stacked layers held in memory.
+
+    By default backward in time. The arrays in each LayerTimestep are views on
+    the data in fluxes and states.
+    """
+    fx = fluxes["fx"].values
+    fy = fluxes["fy"].values
+    evap = fluxes["evap"].values
+    precip = fluxes["precip"].values
+    f_vert = fluxes["f_vert"].values if "f_vert" in fluxes else None
+    s = states["s"].values
+
+    ntime = fx.shape[0]
+    for t in reversed(range(ntime)) if reverse else range(ntime):
+        yield t, LayerTimestep(
+            fx[t],
+            fy[t],
+            evap[t],
+            precip[t],
+            f_vert[t] if f_vert is not None else None,
+            s[t],
+            s[t + 1],
+        )
+
+
+# Input of a single time step: fluxes between the states at t and t+1 ("next")
+Timestep = namedtuple(
+    "Timestep",
+    [
+        "fx_upper",
+        "fy_upper",
+        "fx_lower",
+        "fy_lower",
+        "evap",
+        "precip",
+        "f_vert",
+        "s_upper",
+        "s_lower",
+        "s_upper_next",
+        "s_lower_next",
+    ],
+)
 
-    # Unpack preprocessed data
+
+# Input of a single time step with the layers stacked on the first axis, from
+# the top down; f_vert is the flux from each layer to the one below it
+LayerTimestep = namedtuple(
+    "LayerTimestep", ["fx", "fy", "evap", "precip", "f_vert", "s", "s_next"]
+)
+
+
+def stack_layers(step):
+    """Return a (two-layer) Timestep as a LayerTimestep."""
+    return LayerTimestep(
+        np.stack([step.fx_upper, step.fx_lower]),
+        np.stack([step.fy_upper, step.fy_lower]),
+        step.evap,
+        step.precip,
+        step.f_vert[None] if step.f_vert is not None else None,
+        np.stack([step.s_upper, step.s_lower]),
+        np.stack([step.s_upper_next, step.s_lower_next]),
+    )
+
+
+def timesteps(fluxes, states, reverse=True):
+    """Yield (t, Timestep) for data held in memory, by default backward in time.
+
+    The arrays in each Timestep are views on the data in fluxes and states.
+    """
     fx_upper = fluxes["fx_upper"].values
     fy_upper = fluxes["fy_upper"].values
     fx_lower = fluxes["fx_lower"].values
     fy_lower = fluxes["fy_lower"].values
     evap = fluxes["evap"].values
     precip = fluxes["precip"].values
-    f_vert = fluxes["f_vert"].values
+    f_vert = fluxes["f_vert"].values if "f_vert" in fluxes else None
     s_upper = states["s_upper"].values
     s_lower = states["s_lower"].values
 
+    ntime = fx_upper.shape[0]
+    for t in reversed(range(ntime)) if reverse else range(ntime):
+        yield t, Timestep(
+            fx_upper[t],
+            fy_upper[t],
+            fx_lower[t],
+            fy_lower[t],
+            evap[t],
+            precip[t],
+            f_vert[t] if f_vert is not None else None,
+            s_upper[t],
+            s_lower[t],
+            s_upper[t + 1],
+            s_lower[t + 1],
+        )
+
+
+def backtrack(
+    fluxes,
+    states,
+    s_track_upper,
+    s_track_lower,
+    region,
+    kvf,
+    subdaily=None,
+):
+    """Track moisture backward in time over one day, for data held in memory."""
+    ntime = fluxes["fx_upper"].shape[0]
+    return backtrack_timesteps(
+        timesteps(fluxes, states),
+        ntime,
+        s_track_upper,
+        s_track_lower,
+        region,
+        kvf,
+        subdaily,
+    )
+
+
+def backtrack_timesteps(
+    timesteps,
+    ntime,
+    s_track_upper,
+    s_track_lower,
+    region,
+    kvf,
+    subdaily=None,
+):
+    """Track moisture backward in time over one day.
+
+    Timesteps yields (t, Timestep) backward in time, for t in range(ntime).
+    If subdaily is given (see wam2layers.tracking.io.SubdailyOutput), it is
+    updated after every time step, so it can write sub-daily output.
+
+    The two layers are stacked and tracked with backtrack_layers.
+    """
+    s_track = np.stack([s_track_upper, s_track_lower])
+    steps = ((t, stack_layers(step)) for t, step in timesteps)
+    s_track, output = backtrack_layers(steps, ntime, s_track, region, kvf, subdaily)
+    return (s_track[0], s_track[1], two_layer_output(output))
+
+
+def two_layer_output(output):
+    """Return the output of two stacked layers with the variable names of two layers."""
+    return xr.Dataset(
+        {
+            # Keep last state for a restart
+            "s_track_upper_restart": (["lat", "lon"], output.s_track_restart.values[0]),
+            "s_track_lower_restart": (["lat", "lon"], output.s_track_restart.values[1]),
+            "s_track_upper": (["lat", "lon"], output.s_track.values[0]),
+            "s_track_lower": (["lat", "lon"], output.s_track.values[1]),
+            "e_track": output.e_track,
+            "north_loss": output.north_loss,
+            "south_loss": output.south_loss,
+            "east_loss": output.east_loss,
+            "west_loss": output.west_loss,
+        }
+    )
+
+
+def redistribute_excess(s_track, s):
+    """Redistribute tracked moisture that exceeds the storage of its layer, in place.
+
+    The excess of each layer moves to the layer below it, the excess of the
+    lowest layer to the layer above it; the boundary cells are kept fixed.
+    """
+    excess = np.maximum(0, s_track - s)
+    change = -excess
+    change[1:] += excess[:-1]
+    change[-2] += excess[-1]
+    s_track[:, 1:-1, 1:-1] += change[:, 1:-1, 1:-1]
+
+
+def boundary_losses(edges, s_track_relative):
+    """Return the tracked moisture that leaves the domain in one time step.
+
+    Edges are the outgoing fluxes of each layer over the eastern, western,
+    northern and southern cell faces. Returns the losses over the north,
+    south, east and west boundary, summed over the layers.
+    """
+    f_e_ew, f_w_we, fy_n_ns, fy_s_sn = edges
+    return (
+        (fy_n_ns[:, 1, :] * s_track_relative[:, 1, :]).sum(axis=0),
+        (fy_s_sn[:, -2, :] * s_track_relative[:, -2, :]).sum(axis=0),
+        (f_e_ew[:, :, -2] * s_track_relative[:, :, -2]).sum(axis=0),
+        (f_w_we[:, :, 1] * s_track_relative[:, :, 1]).sum(axis=0),
+    )
+
+
+def layer_output(s_track, s_track_mean, e_track, losses):
+    """Pack the output of a day of tracking stacked layers into a dataset."""
+    north_loss, south_loss, east_loss, west_loss = losses
+    return xr.Dataset(
+        {
+            # Keep last state for a restart (s_track is updated by the next day)
+            "s_track_restart": (["layer", "lat", "lon"], s_track.copy()),
+            "s_track": (["layer", "lat", "lon"], s_track_mean),
+            "e_track": (["lat", "lon"], e_track),
+            "north_loss": (["lon"], north_loss),
+            "south_loss": (["lon"], south_loss),
+            "east_loss": (["lat"], east_loss),
+            "west_loss": (["lat"], west_loss),
+        }
+    )
+
+
+def backtrack_layers(timesteps, ntime, s_track, region, kvf, subdaily=None):
+    """Track moisture backward in time over one day, for any number of layers.
+
+    Timesteps yields (t, LayerTimestep) backward in time, for t in
+    range(ntime). S_track holds the tracked moisture of the layers, from the
+    top down, and is updated in place. Each transport term is computed once
+    for all layers. Moisture is exchanged between adjacent layers, evaporation
+    is taken from the lowest layer and precipitation from all layers, in
+    proportion to their moisture.
+
+    If subdaily is given, it is updated after every time step (see
+    wam2layers.tracking.io; SubdailyOutput only works with two layers).
+    """
     # Allocate arrays for daily accumulations
-    ntime, nlat, nlon = fx_upper.shape
+    _, nlat, nlon = s_track.shape
 
-    s_track_upper_mean = np.zeros((nlat, nlon))
-    s_track_lower_mean = np.zeros((nlat, nlon))
+    s_track_mean = np.zeros_like(s_track)
     e_track = np.zeros((nlat, nlon))
+    losses = [np.zeros(nlon), np.zeros(nlon), np.zeros(nlat), np.zeros(nlat)]
 
-    north_loss = np.zeros(nlon)
-    south_loss = np.zeros(nlon)
-    east_loss = np.zeros(nlat)
-    west_loss = np.zeros(nlat)
-
-    # Only track the precipitation at certain dates
-    if (
-        time_in_range(
-            config["event_start_date"],
-            config["event_end_date"],
-            date.strftime("%Y%m%d"),
-        )
-        == False
-    ):
-        precip = precip * 0
+    inner = np.s_[:, 1:-1, 1:-1]
 
     # Sa calculation backward in time
-    for t in reversed(range(ntime)):
-        P_region = region * precip[t]
-        s_total = s_upper[t+1] + s_lower[t+1]
+    for t, step in timesteps:
+        P_region = region * step.precip
+        s_total = step.s_next.sum(axis=0)
 
         # separate the direction of the vertical flux and make it absolute
-        f_downward, f_upward = split_vertical_flux(kvf, f_vert[t])
+        f_downward, f_upward = split_vertical_flux(kvf, step.f_vert)
 
         # Determine horizontal fluxes over the grid-cell boundaries
-        f_e_lower_we, f_e_lower_ew, f_w_lower_we, f_w_lower_ew = to_edges_zonal(
-            fx_lower[t]
-        )
-        f_e_upper_we, f_e_upper_ew, f_w_upper_we, f_w_upper_ew = to_edges_zonal(
-            fx_upper[t]
-        )
+        f_e_we, f_e_ew, f_w_we, f_w_ew = to_edges_zonal(step.fx)
+        fy_n_sn, fy_n_ns, fy_s_sn, fy_s_ns = to_edges_meridional(step.fy)
 
-        (
-            fy_n_lower_sn,
-            fy_n_lower_ns,
-            fy_s_lower_sn,
-            fy_s_lower_ns,
-        ) = to_edges_meridional(fy_lower[t])
-        (
-            fy_n_upper_sn,
-            fy_n_upper_ns,
-            fy_s_upper_sn,
-            fy_s_upper_ns,
-        ) = to_edges_meridional(fy_upper[t])
-
-        # Short name for often used expressions
-        s_track_relative_lower = (
-            s_track_lower / s_lower[t+1]
-        )  # fraction of tracked relative to total moisture
-        s_track_relative_upper = s_track_upper / s_upper[t+1]
-        inner = np.s_[1:-1, 1:-1]
+        # fraction of tracked relative to total moisture
+        s_track_relative = s_track / step.s_next
 
         # Actual tracking (note: backtracking, all terms have been negated)
-        s_track_lower[inner] += (
-            + f_e_lower_we * look_east(s_track_relative_lower)
-            + f_w_lower_ew * look_west(s_track_relative_lower)
-            + fy_n_lower_sn * look_north(s_track_relative_lower)
-            + fy_s_lower_ns * look_south(s_track_relative_lower)
-            + f_upward * s_track_relative_upper
-            - f_downward * s_track_relative_lower
-            - fy_s_lower_sn * s_track_relative_lower
-            - fy_n_lower_ns * s_track_relative_lower
-            - f_e_lower_ew * s_track_relative_lower
-            - f_w_lower_we * s_track_relative_lower
-            + P_region * (s_lower[t+1] / s_total)
-            - evap[t] * s_track_relative_lower
-        )[inner]
-
-        s_track_upper[inner] += (
-            + f_e_upper_we * look_east(s_track_relative_upper)
-            + f_w_upper_ew * look_west(s_track_relative_upper)
-            + fy_n_upper_sn * look_north(s_track_relative_upper)
-            + fy_s_upper_ns * look_south(s_track_relative_upper)
-            + f_downward * s_track_relative_lower
-            - f_upward * s_track_relative_upper
-            - fy_s_upper_sn * s_track_relative_upper
-            - fy_n_upper_ns * s_track_relative_upper
-            - f_w_upper_we * s_track_relative_upper
-            - f_e_upper_ew * s_track_relative_upper
-            + P_region * (s_upper[t+1] / s_total)
-        )[inner]
-
-        # down and top: redistribute unaccounted water that is otherwise lost from the sytem
-        lower_to_upper = np.maximum(0, s_track_lower - s_lower[t])
-        upper_to_lower = np.maximum(0, s_track_upper - s_upper[t])
-        s_track_lower[inner] = (s_track_lower - lower_to_upper + upper_to_lower)[inner]
-        s_track_upper[inner] = (s_track_upper - upper_to_lower + lower_to_upper)[inner]
+        # Accumulated in place, to avoid a temporary array for every term
+        tendency = f_e_we * look_east(s_track_relative)
+        tendency += f_w_ew * look_west(s_track_relative)
+        tendency += fy_n_sn * look_north(s_track_relative)
+        tendency += fy_s_ns * look_south(s_track_relative)
+        tendency -= (fy_s_sn + fy_n_ns + f_e_ew + f_w_we) * s_track_relative
+        tendency += P_region * (step.s_next / s_total)
+
+        # Vertical exchange, as seen from the upper of two adjacent layers
+        exchange = f_downward * s_track_relative[1:] - f_upward * s_track_relative[:-1]
+        tendency[:-1] += exchange
+        tendency[1:] -= exchange
+        tendency[-1] -= step.evap * s_track_relative[-1]
+        s_track[inner] += tendency[inner]
+
+        # redistribute unaccounted water that is otherwise lost from the sytem
+        redistribute_excess(s_track, step.s)
 
         # compute tracked evaporation
-        e_track += evap[t] * (s_track_lower / s_lower[t+1])
+        e_step = step.evap * (s_track[-1] / step.s_next[-1])
+        e_track += e_step
 
-        # losses to the north and south
-        north_loss += (
-            fy_n_upper_ns * s_track_relative_upper
-            + fy_n_lower_ns * s_track_relative_lower
-        )[1, :]
+        # losses to the north, south, east and west
+        loss_steps = boundary_losses((f_e_ew, f_w_we, fy_n_ns, fy_s_sn), s_track_relative)
+        for loss, loss_step in zip(losses, loss_steps):
+            loss += loss_step
 
-        south_loss += (
-            fy_s_upper_sn * s_track_relative_upper
-            + fy_s_lower_sn * s_track_relative_lower
-        )[-2, :]
+        # Aggregate daily accumulations for calculating the daily means
+        s_track_mean += s_track / ntime
 
-        east_loss += (
-            f_e_upper_ew * s_track_relative_upper
-            + f_e_lower_ew * s_track_relative_lower
-        )[:, -2]
+        if subdaily is not None:
+            subdaily.update(t, *s_track, e_step, *loss_steps)
 
-        west_loss += (
-            f_w_upper_we * s_track_relative_upper
-            + f_w_lower_we * s_track_relative_lower
-        )[:, 1]
+    return (s_track, layer_output(s_track, s_track_mean, e_track, losses))
 
-        # Aggregate daily accumulations for calculating the daily means
-        s_track_lower_mean += s_track_lower / ntime
-        s_track_upper_mean += s_track_upper / ntime
 
-    make_diagnostic_figures(
-        date,
-        region,
-        fx_upper,
-        fy_upper,
-        fx_lower,
-        fy_lower,
-        precip,
-        s_track_upper_mean,
-        s_track_lower_mean,
-        e_track,
+def implicit_operator(step, kvf):
+    """Return the matrix of the implicit tracking step and the outgoing fluxes.
+
+    The unknowns are the tracked fractions of the layers at the end (i.e.
+    the earlier time) of the backward step, stacked from the top down and
+    flattened. Each row is the moisture budget of a grid cell: its storage
+    plus everything that leaves it (backward in time), minus what enters from
+    its neighbours and the adjacent layers. The boundary cells are kept fixed.
+    """
+    import scipy.sparse as sparse
+
+    nlayer, nlat, nlon = step.s.shape
+    n = nlat * nlon
+    inner = np.zeros((nlayer, nlat, nlon), dtype=bool)
+    inner[:, 1:-1, 1:-1] = True
+
+    f_downward, f_upward = split_vertical_flux(kvf, step.f_vert)
+    f_e_we, f_e_ew, f_w_we, f_w_ew = to_edges_zonal(step.fx)
+    fy_n_sn, fy_n_ns, fy_s_sn, fy_s_ns = to_edges_meridional(step.fy)
+
+    # Exchange with the layers below and above, and evaporation from the lowest layer
+    out = fy_s_sn + fy_n_ns + f_e_ew + f_w_we
+    out[:-1] += f_upward
+    out[1:] += f_downward
+    out[-1] += step.evap
+
+    def coefficients(values, layers=np.s_[:]):
+        return np.where(inner[layers], -values, 0).ravel()
+
+    matrix = sparse.diags(
+        [
+            np.where(inner, step.s + out, step.s).ravel(),
+            coefficients(f_e_we)[:-1],
+            coefficients(f_w_ew)[1:],
+            coefficients(fy_s_ns)[:-nlon],
+            coefficients(fy_n_sn)[nlon:],
+            coefficients(f_downward, np.s_[:-1]),
+            coefficients(f_upward, np.s_[1:]),
+        ],
+        [0, 1, -1, nlon, -nlon, n, -n],
+        format="csr",
+    )
+    return matrix, (f_e_ew, f_w_we, fy_n_ns, fy_s_sn)
+
+
+def backtrack_layers_implicit(timesteps, ntime, s_track, region, kvf, subdaily=None):
+    """Track moisture backward in time over one day, with an implicit scheme.
+
+    Same input and output as backtrack_layers, but the tracked fractions that
+    are used for the fluxes are those at the end of the (backward) time step
+    instead of at the start. This gives a linear system for each time step,
+    which is solved iteratively. The scheme conserves the tracked moisture
+    and keeps it positive for any time step, so it can run at the (hourly)
+    frequency of the input, without stabilizing the fluxes (use
+    stabilize=False in prepare_fluxes). The price is more numerical diffusion
+    than the explicit scheme at short time steps.
+    """
+    import scipy.sparse as sparse
+    from scipy.sparse.linalg import bicgstab
+
+    _, nlat, nlon = s_track.shape
+    inner = np.s_[:, 1:-1, 1:-1]
+
+    s_track_mean = np.zeros_like(s_track)
+    e_track = np.zeros((nlat, nlon))
+    losses = [np.zeros(nlon), np.zeros(nlon), np.zeros(nlat), np.zeros(nlat)]
+
+    for t, step in timesteps:
+        P_region = region * step.precip
+        s_total = step.s_next.sum(axis=0)
+
+        matrix, edges = implicit_operator(step, kvf)
+        rhs = s_track.copy()
+        rhs[inner] += (P_region * (step.s_next / s_total))[inner]
+        rhs = rhs.ravel()
+
+        # Solve for the tracked fractions, starting from the explicit estimate
+        preconditioner = sparse.diags(1 / matrix.diagonal())
+        fraction, info = bicgstab(
+            matrix, rhs, x0=rhs / step.s.ravel(), M=preconditioner, rtol=1e-8, atol=0
+        )
+        if info != 0:
+            raise RuntimeError(f"Implicit tracking step {t} did not converge")
+        s_track_relative = fraction.reshape(s_track.shape)
+        s_track[inner] = (s_track_relative * step.s)[inner]
+
+        # redistribute unaccounted water that is otherwise lost from the sytem
+        redistribute_excess(s_track, step.s)
+
+        # compute tracked evaporation
+        e_step = step.evap * s_track_relative[-1]
+        e_track += e_step
+
+        # losses to the north, south, east and west
+        loss_steps = boundary_losses(edges, s_track_relative)
+        for loss, loss_step in zip(losses, loss_steps):
+            loss += loss_step
+
+        s_track_mean += s_track / ntime
+
+        if subdaily is not None:
+            subdaily.update(t, *s_track, e_step, *loss_steps)
+
+    return (s_track, layer_output(s_track, s_track_mean, e_track, losses))
+
+
+def backtrack_timesteps_implicit(
+    timesteps,
+    ntime,
+    s_track_upper,
+    s_track_lower,
+    region,
+    kvf,
+    subdaily=None,
+):
+    """Track moisture backward in time over one day, with an implicit scheme.
+
+    Same input and output as backtrack_timesteps; the two layers are stacked
+    and tracked with backtrack_layers_implicit.
+    """
+    s_track = np.stack([s_track_upper, s_track_lower])
+    steps = ((t, stack_layers(step)) for t, step in timesteps)
+    s_track, output = backtrack_layers_implicit(
+        steps, ntime, s_track, region, kvf, subdaily
     )
+    return (s_track[0], s_track[1], two_layer_output(output))
+
+
+# Tracking schemes that can be selected with `tracking_scheme` in the config,
+# for two layers and for stacked layers
+SCHEMES = {
+    "explicit": backtrack_timesteps,
+    "implicit": backtrack_timesteps_implicit,
+}
+LAYER_SCHEMES = {
+    "explicit": backtrack_layers,
+    "implicit": backtrack_layers_implicit,
+}
+
+
+def summary_path(output_dir):
+    return f"{output_dir}/summary.nc"
+
 
-    # Pack processed data into new dataset
-    ds = xr.Dataset(
+def tracking_summary(dates, remaining, e_track, losses, stopped):
+    """Return a dataset with the moisture budget of a tracking run.
+
+    The tracked moisture (all in m3) is the moisture that was tracked
+    (remaining storage plus tracked evaporation plus losses over the domain
+    boundaries), i.e. the tracked precipitation plus the initial storage of
+    a restart.
+    """
+    return xr.Dataset(
         {
-            # Keep last state for a restart
-            "s_track_upper_restart": (["lat", "lon"],s_track_upper),
-            "s_track_lower_restart": (["lat", "lon"], s_track_lower),
-            "s_track_upper": (["lat", "lon"], s_track_upper_mean),
-            "s_track_lower": (["lat", "lon"], s_track_lower_mean),
-            "e_track": (["lat", "lon"], e_track),
-            "north_loss": (["lon"], north_loss),
-            "south_loss": (["lon"], south_loss),
-            "east_loss": (["lat"], east_loss),
-            "west_loss": (["lat"],west_loss),
-        }
+            "tracked_moisture": remaining + e_track + losses,
+            "e_track": e_track,
+            "losses": losses,
+            "remaining": remaining,
+        },
+        attrs={
+            "first_date": dates[0].strftime("%Y-%m-%d"),
+            "last_date": dates[-1].strftime("%Y-%m-%d"),
+            "days": len(dates),
+            "stopped_early": int(stopped),
+        },
     )
-    return (s_track_upper, s_track_lower, ds)
 
 
-region = xr.open_dataset(config["region"]).region_flood.values
+def tracked_dates(config, output_dir):
+    """Return the dates for which a run has written daily output.
 
-for i, date in enumerate(reversed(datelist[:])):
-    print(date)
-    preprocessed_data = xr.open_dataset(input_path(date))
+    This is the tracking period in the config, unless the run stopped early
+    (see `stop_threshold`); then it starts at the first date in its summary.
+    """
+    dates = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+    if Path(summary_path(output_dir)).exists():
+        with xr.open_dataset(summary_path(output_dir)) as summary:
+            dates = dates[dates >= pd.Timestamp(summary.attrs["first_date"])]
+    return dates
 
-    # Resample to (higher) target frequency
-    # After this, the fluxes will be "in between" the states
-    fluxes, states = resample(preprocessed_data, config['target_frequency'])
 
-    # Convert flux data to volumes
-    change_units(fluxes, config["target_frequency"])
+def load_region(region_file, grid):
+    """Load the region on the grid of the preprocessed data.
 
-    # Apply a stability correction if needed
-    stabilize_fluxes(fluxes, states)
+    Grid is a preprocessed data file or dataset. The region file may cover a
+    larger domain than the preprocessed data.
+    """
+    region = xr.load_dataset(region_file).region_flood
+    if not isinstance(grid, xr.Dataset):
+        with xr.open_dataset(grid) as grid:
+            return region.sel(latitude=grid.latitude, longitude=grid.longitude)
+    return region.sel(latitude=grid.latitude, longitude=grid.longitude)
+
+
+def run_experiment(config_file):
+    """Run a backtracking experiment from start to finish."""
+    # Read case configuration
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    datelist = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+
+    # Optionally track on a coarser grid, for a quick first look
+    screening = config.get("screening")
+    if screening:
+        from wam2layers.tracking import screening as coarse
 
-    # Determine the vertical moisture flux
-    fluxes["f_vert"] = calculate_fv(fluxes, states, config["periodic_boundary"], config["kvf"])
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_dir = Path(config["output_folder"]).expanduser() / (
+        "screening" if screening else "backtrack"
+    )
 
-    if i == 0:
-        if config["restart"]:
-            # Reload last state from existing output
-            ds = xr.open_dataset(output_path(date + pd.Timedelta(days=1)))
-            s_track_upper = ds.s_track_upper_restart.values
-            s_track_lower = ds.s_track_lower_restart.values
+    # Check if input dir exists
+    preprocess = config.get("preprocess")
+    if preprocess and config.get("spill", False):
+        input_dir.mkdir(parents=True, exist_ok=True)
+    if not input_dir.exists() and not preprocess:
+        raise ValueError(
+            "Please create the preprocessed_data_folder before running the script"
+        )
+
+    # Create output dir if it doesn't exist yet
+    if not output_dir.exists():
+        output_dir.mkdir(parents=True)
+
+    # Figures are rendered in a separate process, so they don't slow down the tracking
+    figure_setting = config.get("diagnostic_figures", False)
+    figure_worker = None
+
+    # Optionally read the input just in time, one time step at a time
+    # The implicit scheme doesn't need stabilized fluxes
+    scheme = config.get("tracking_scheme", "explicit")
+    track = SCHEMES[scheme]
+    stabilize = scheme == "explicit"
+
+    streaming = config.get("streaming", False)
+    if streaming and screening:
+        raise ValueError("Streaming is not available for screening runs")
+    if streaming and config.get("layer_boundary") is not None:
+        raise ValueError("Streaming is not available with a layer_boundary")
+    if streaming and preprocess:
+        raise ValueError("Streaming reads preprocessed files, it can't preprocess on the fly")
+    if preprocess and config.get("layer_boundary") is not None:
+        raise ValueError("A layer_boundary needs the cumulative integrals on disk")
+    if streaming:
+        from wam2layers.tracking.streaming import TimestepStream
+
+    # Optionally stop once (almost) all tracked moisture has been attributed,
+    # i.e. when the remaining tracked storage is below stop_threshold percent
+    # of the tracked moisture, after the whole event has been tracked
+    stop_threshold = config.get("stop_threshold")
+    event_start = pd.Timestamp(config["event_start_date"])
+    e_track_total = 0.0
+    losses_total = 0.0
+    stop = False
+
+    # The preprocessed data of each day, backward in time
+    dates = datelist[::-1]
+    days = None if streaming else input_days(dates, input_dir, config)
+
+    for i, date in enumerate(dates):
+        print(date)
+
+        # Only track the precipitation at certain dates
+        track_precip = time_in_range(
+            config["event_start_date"],
+            config["event_end_date"],
+            date.strftime("%Y%m%d"),
+        )
+
+        if streaming:
+            stream = TimestepStream(
+                input_path(date, input_dir),
+                config["target_frequency"],
+                config["kvf"],
+                read_ahead=config.get("read_ahead", 2),
+                zero_precip=not track_precip,
+                stabilize=stabilize,
+            )
+            steps, ntime = stream, stream.ntime
+            times, shape = stream.times, stream.shape
+            latitude, longitude = stream.latitude, stream.longitude
+            layered = False
         else:
-            # Allocate empty arrays based on shape of input data
-            s_track_upper = np.zeros_like(states.s_upper[0])
-            s_track_lower = np.zeros_like(states.s_upper[0])
-
-    (s_track_upper, s_track_lower, processed_data) = backtrack(
-        date,
-        fluxes,
-        states,
-        s_track_upper,
-        s_track_lower,
-        region,
-        config["kvf"],
+            preprocessed_data = next(days)
+
+            # Data with more than two layers has them stacked on a layer axis
+            layered = "layer" in preprocessed_data.dims
+            if layered and (
+                screening or config.get("output_frequency") or figure_setting
+            ):
+                raise ValueError(
+                    "Data with stacked layers can only be tracked without "
+                    "screening, sub-daily output or figures"
+                )
+            if screening:
+                fine_data = preprocessed_data
+                preprocessed_data = coarse.coarsen(fine_data, screening)
+
+            # Resample to (higher) target frequency
+            # After this, the fluxes will be "in between" the states
+            fluxes, states = resample(preprocessed_data, config['target_frequency'])
+
+            # Convert flux data to volumes, apply a stability correction and
+            # determine the vertical moisture flux
+            prepare = prepare_layers if layered else prepare_fluxes
+            prepare(fluxes, states, config["target_frequency"], config["kvf"], stabilize)
+
+            if not track_precip:
+                fluxes["precip"] = fluxes["precip"] * 0
+
+            if layered:
+                steps = layer_timesteps(fluxes, states)
+            else:
+                steps = timesteps(fluxes, states)
+            ntime = fluxes.time.size
+            times, shape = states.time.values, fluxes.precip.shape[1:]
+            latitude = preprocessed_data.latitude.values
+            longitude = preprocessed_data.longitude.values
+
+        if i == 0:
+            # Load the region on the grid of the preprocessed data
+            if streaming:
+                grid = input_path(date, input_dir)
+            else:
+                grid = fine_data if screening else preprocessed_data
+            with FILE_LOCK:
+                region = load_region(config["region"], grid)
+            if screening:
+                region = coarse.coarsen_region(region.values, region, screening)
+            else:
+                region = region.values
+
+            # Tracked moisture of each layer, from the top down
+            if config["restart"]:
+                # Reload last state from existing output
+                with FILE_LOCK:
+                    ds = xr.open_dataset(output_path(date + pd.Timedelta(days=1), output_dir))
+                    if layered:
+                        s_track = ds.s_track_restart.values
+                    else:
+                        s_track = np.stack(
+                            [ds.s_track_upper_restart.values, ds.s_track_lower_restart.values]
+                        )
+            else:
+                # Allocate empty arrays based on shape of input data
+                nlayer = preprocessed_data.layer.size if layered else 2
+                s_track = np.zeros((nlayer, *shape))
+
+        # Optionally stream sub-daily output while tracking
+        subdaily = None
+        if config.get("output_frequency"):
+            subdaily = SubdailyOutput(
+                subdaily_output_path(date, output_dir),
+                times,
+                shape,
+                config["output_frequency"],
+                snapshots=config.get("output_snapshots", False),
+            )
+
+        # Optionally keep time series at a few grid cells, found on the first day
+        probes = None
+        if config.get("probes"):
+            if i == 0:
+                probe_cells = probe_index(latitude, longitude, config["probes"])
+            probes = ProbeOutput(probe_cells, times)
+
+        step_output = None
+        if subdaily is not None or probes is not None:
+            step_output = Outputs(subdaily, probes)
+
+        if layered:
+            s_track, processed_data = LAYER_SCHEMES[scheme](
+                steps, ntime, s_track, region, config["kvf"], step_output
+            )
+        else:
+            *s_track, processed_data = track(
+                steps, ntime, *s_track, region, config["kvf"], step_output
+            )
+
+        if subdaily is not None:
+            subdaily.close()
+        if probes is not None:
+            probes.write(
+                probes_output_path(date, output_dir), latitude, longitude, stacked=layered
+            )
+
+        if streaming:
+            fluxes = stream.summary()
+            stream.close()
+
+        if screening and config.get("screening_refine", False):
+            processed_data["e_track_fine"] = (
+                ["lat_fine", "lon_fine"],
+                coarse.refine(processed_data.e_track.values, fine_data, screening),
+            )
+            processed_data.coords["lat_fine"] = fine_data.latitude.values
+            processed_data.coords["lon_fine"] = fine_data.longitude.values
+
+        # Moisture budget of the run so far
+        e_track_total += float(processed_data.e_track.sum())
+        losses_total += sum(
+            float(processed_data[f"{side}_loss"].sum())
+            for side in ["north", "south", "east", "west"]
+        )
+        remaining = float(sum(layer.sum() for layer in s_track))
+        tracked = remaining + e_track_total + losses_total
+        if stop_threshold is not None and date <= event_start and tracked > 0:
+            stop = remaining < stop_threshold / 100 * tracked
+
+        if figures_due(figure_setting, i, len(datelist)) or (stop and figure_setting == "end"):
+            if figure_worker is None:
+                from wam2layers.analysis.visualization import FigureWorker
+
+                figure_worker = FigureWorker(
+                    latitude,
+                    longitude,
+                    region,
+                    Path(config["output_folder"]).expanduser() / "figures",
+                )
+            figure_worker.submit(date, fluxes, processed_data)
+
+        # Write output to file, with the coordinates of the tracking grid
+        # TODO: add units
+        processed_data.coords["lat"] = latitude
+        processed_data.coords["lon"] = longitude
+        with FILE_LOCK:
+            processed_data.to_netcdf(output_path(date, output_dir))
+
+        if stop:
+            print(
+                f"Stopping: remaining tracked moisture is {remaining / tracked:.2%} "
+                "of the tracked moisture"
+            )
+            break
+
+    if figure_worker is not None:
+        figure_worker.close()
+
+    summary = tracking_summary(
+        datelist[-(i + 1) :], remaining, e_track_total, losses_total, stop
     )
+    with FILE_LOCK:
+        summary.to_netcdf(summary_path(output_dir))
+
 
-    # Write output to file
-    # TODO: add (and cleanup) coordinates and units
-    processed_data.to_netcdf(output_path(date))
+if __name__ == "__main__":
+    run_experiment(sys.argv[1])
@@ -0,0 +1,321 @@
+"""Track moisture forward and backward in time over the same period.
+
+Source-sink studies need both directions: where does the precipitation of a
+region come from (backtracking), and where does the evaporation of a region
+end up (forward tracking). Instead of two separate runs that each read and
+prepare the same days, each day is read and prepared only once:
+
+1. The forward sweep reads the days in order, tracks the evaporation from
+   `forward_region` (by default the region) during the event, and keeps each
+   prepared day in a day cache.
+2. The backward sweep then takes the days from the cache in reverse order and
+   tracks the precipitation over the region during the event, like the
+   backtrack command. A day is dropped from the cache once it has been
+   tracked.
+
+The cache holds all prepared days of the period, resampled to the
+target_frequency, so its memory use grows with the length of the period: it
+is the number of days times the size of a prepared day, several times that of
+a preprocessed day. `wam2layers plan` reports it. If `day_cache_spill` is
+set, the prepared days are written to a temporary folder on disk instead and
+read back in the backward sweep; the input is then still read and prepared
+only once, but each prepared day is written and read once more.
+
+The output is written to output_folder/forwardtrack and output_folder/backtrack.
+
+Example:
+
+    wam2layers bidirectional cases/era5_2021.yaml
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.tracking.backtrack import (
+    backtrack_layers,
+    input_days,
+    layer_timesteps,
+    load_region,
+    look_east,
+    look_north,
+    look_south,
+    look_west,
+    output_path,
+    prepare_fluxes,
+    prepare_layers,
+    resample,
+    split_vertical_flux,
+    stack_layers,
+    time_in_range,
+    timesteps,
+    to_edges_meridional,
+    to_edges_zonal,
+)
+from wam2layers.tracking.io import FILE_LOCK
+
+
+def forwardtrack_layers(timesteps, ntime, s_track, region, kvf):
+    """Track moisture forward in time over one day, for any number of layers.
+
+    Timesteps yields (t, LayerTimestep) forward in time, for t in
+    range(ntime). S_track holds the tracked moisture of the layers, from the
+    top down, and is updated in place. Evaporation from the region is added to
+    the lowest layer; precipitation takes tracked moisture from all layers, in
+    proportion to their moisture. This is the mirror image of backtrack_layers.
+    """
+    # Allocate arrays for daily accumulations
+    _, nlat, nlon = s_track.shape
+
+    s_track_mean = np.zeros_like(s_track)
+    p_track = np.zeros((nlat, nlon))
+
+    north_loss = np.zeros(nlon)
+    south_loss = np.zeros(nlon)
+    east_loss = np.zeros(nlat)
+    west_loss = np.zeros(nlat)
+
+    inner = np.s_[:, 1:-1, 1:-1]
+
+    for t, step in timesteps:
+        E_region = region * step.evap
+        s_total = step.s.sum(axis=0)
+
+        # separate the direction of the vertical flux and make it absolute
+        f_downward, f_upward = split_vertical_flux(kvf, step.f_vert)
+
+        # Determine horizontal fluxes over the grid-cell boundaries
+        f_e_we, f_e_ew, f_w_we, f_w_ew = to_edges_zonal(step.fx)
+        fy_n_sn, fy_n_ns, fy_s_sn, fy_s_ns = to_edges_meridional(step.fy)
+
+        # fraction of tracked relative to total moisture
+        s_track_relative = s_track / step.s
+
+        # tracked precipitation of each layer
+        p_layers = step.precip * (s_track / s_total)
+
+        # Actual tracking, accumulated in place
+        tendency = f_e_ew * look_east(s_track_relative)
+        tendency += f_w_we * look_west(s_track_relative)
+        tendency += fy_n_ns * look_north(s_track_relative)
+        tendency += fy_s_sn * look_south(s_track_relative)
+        tendency -= (fy_s_ns + fy_n_sn + f_e_we + f_w_ew) * s_track_relative
+        tendency -= p_layers
+
+        # Vertical exchange, as seen from the upper of two adjacent layers
+        exchange = f_upward * s_track_relative[1:] - f_downward * s_track_relative[:-1]
+        tendency[:-1] += exchange
+        tendency[1:] -= exchange
+        tendency[-1] += E_region
+        s_track[inner] += tendency[inner]
+
+        # redistribute unaccounted water that is otherwise lost from the
+        # sytem: the excess of each layer moves to the layer below it, the
+        # excess of the lowest layer to the layer above it
+        excess = np.maximum(0, s_track - step.s_next)
+        change = -excess
+        change[1:] += excess[:-1]
+        change[-2] += excess[-1]
+        s_track[inner] += change[inner]
+
+        # compute tracked precipitation
+        p_track += p_layers.sum(axis=0)
+
+        # losses to the north, south, east and west
+        north_loss += (fy_n_sn[:, 1, :] * s_track_relative[:, 1, :]).sum(axis=0)
+        south_loss += (fy_s_ns[:, -2, :] * s_track_relative[:, -2, :]).sum(axis=0)
+        east_loss += (f_e_we[:, :, -2] * s_track_relative[:, :, -2]).sum(axis=0)
+        west_loss += (f_w_ew[:, :, 1] * s_track_relative[:, :, 1]).sum(axis=0)
+
+        # Aggregate daily accumulations for calculating the daily means
+        s_track_mean += s_track / ntime
+
+    # Pack processed data into new dataset
+    ds = xr.Dataset(
+        {
+            # Keep last state for a restart
+            "s_track_restart": (["layer", "lat", "lon"], s_track.copy()),
+            "s_track": (["layer", "lat", "lon"], s_track_mean),
+            "p_track": (["lat", "lon"], p_track),
+            "north_loss": (["lon"], north_loss),
+            "south_loss": (["lon"], south_loss),
+            "east_loss": (["lat"], east_loss),
+            "west_loss": (["lat"], west_loss),
+        }
+    )
+    return (s_track, ds)
+
+
+def two_layer_output(ds):
+    """Return output of two stacked layers with the variable names of backtrack."""
+    restart, mean = ds.s_track_restart.values, ds.s_track.values
+    ds = ds.drop_vars(["s_track_restart", "s_track"])
+    ds["s_track_upper_restart"] = (["lat", "lon"], restart[0])
+    ds["s_track_lower_restart"] = (["lat", "lon"], restart[1])
+    ds["s_track_upper"] = (["lat", "lon"], mean[0])
+    ds["s_track_lower"] = (["lat", "lon"], mean[1])
+    return ds
+
+
+class DayCache:
+    """Prepared days, held in memory or spilled to a temporary folder.
+
+    The spilled days are written and read holding FILE_LOCK, as the next day
+    may be preprocessed in the meantime (see input_days).
+    """
+
+    def __init__(self, spill=False):
+        self.days = {}
+        self.tmpdir = TemporaryDirectory() if spill else None
+
+    def put(self, date, fluxes, states):
+        if self.tmpdir is None:
+            self.days[date] = (fluxes, states)
+            return
+        paths = [
+            Path(self.tmpdir.name) / f"{date.strftime('%Y-%m-%d')}_{name}.nc"
+            for name in ["fluxes", "states"]
+        ]
+        with FILE_LOCK:
+            fluxes.to_netcdf(paths[0])
+            states.to_netcdf(paths[1])
+        self.days[date] = paths
+
+    def pop(self, date):
+        """Return the prepared fluxes and states of a day and drop them."""
+        day = self.days.pop(date)
+        if self.tmpdir is None:
+            return day
+        with FILE_LOCK:
+            fluxes, states = (xr.load_dataset(path) for path in day)
+        for path in day:
+            path.unlink()
+        return fluxes, states
+
+    def close(self):
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+
+
+def day_timesteps(fluxes, states, reverse, zero=None):
+    """Yield (t, LayerTimestep) of a prepared day, with or without stacked layers.
+
+    The prepared data may be shared, so it is not modified: if zero is given
+    ("evap" or "precip"), that variable is replaced by zeros instead.
+    """
+    if "layer" in states.dims:
+        steps = layer_timesteps(fluxes, states, reverse)
+    else:
+        steps = ((t, stack_layers(step)) for t, step in timesteps(fluxes, states, reverse))
+    if zero is None:
+        return steps
+    zeros = np.zeros(fluxes[zero].shape[1:])
+    return ((t, step._replace(**{zero: zeros})) for t, step in steps)
+
+
+def run_bidirectional(config_file):
+    """Track forward and backward in time, reading each day only once."""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    if (
+        config.get("tracking_scheme", "explicit") != "explicit"
+        or config.get("streaming", False)
+        or config.get("screening")
+        or config.get("layer_boundary") is not None
+        or config.get("restart", False)
+        or config.get("stop_threshold") is not None
+        or config.get("output_frequency")
+        or config.get("output_snapshots", False)
+        or config.get("probes")
+        or config.get("diagnostic_figures", False)
+    ):
+        raise ValueError(
+            "Bidirectional runs use the explicit scheme and track the whole period "
+            "from zero, without streaming, screening, a layer_boundary, a "
+            "stop_threshold, sub-daily output, probes or figures"
+        )
+
+    datelist = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_root = Path(config["output_folder"]).expanduser()
+    output_dirs = {}
+    for direction in ["forwardtrack", "backtrack"]:
+        output_dirs[direction] = output_root / direction
+        output_dirs[direction].mkdir(parents=True, exist_ok=True)
+    if config.get("preprocess") and config.get("spill", False):
+        input_dir.mkdir(parents=True, exist_ok=True)
+
+    def event(date):
+        return time_in_range(
+            config["event_start_date"], config["event_end_date"], date.strftime("%Y%m%d")
+        )
+
+    cache = DayCache(config.get("day_cache_spill", False))
+    try:
+        # Forward sweep: read and prepare each day, and keep it in the cache
+        for i, (date, preprocessed_data) in enumerate(
+            zip(datelist, input_days(datelist, input_dir, config))
+        ):
+            print("forward", date)
+            layered = "layer" in preprocessed_data.dims
+            fluxes, states = resample(preprocessed_data, config["target_frequency"])
+            fluxes, states = fluxes.load(), states.load()
+            prepare = prepare_layers if layered else prepare_fluxes
+            prepare(fluxes, states, config["target_frequency"], config["kvf"])
+
+            if i == 0:
+                regions = {
+                    "forwardtrack": config.get("forward_region") or config["region"],
+                    "backtrack": config["region"],
+                }
+                with FILE_LOCK:
+                    regions = {
+                        direction: load_region(path, preprocessed_data).values
+                        for direction, path in regions.items()
+                    }
+                nlayer = preprocessed_data.layer.size if layered else 2
+                s_track = np.zeros((nlayer, *fluxes.precip.shape[1:]))
+
+            steps = day_timesteps(
+                fluxes, states, reverse=False, zero=None if event(date) else "evap"
+            )
+            s_track, output = forwardtrack_layers(
+                steps, fluxes.time.size, s_track, regions["forwardtrack"], config["kvf"]
+            )
+            if not layered:
+                output = two_layer_output(output)
+            output.coords["lat"] = preprocessed_data.latitude.values
+            output.coords["lon"] = preprocessed_data.longitude.values
+            with FILE_LOCK:
+                output.to_netcdf(output_path(date, output_dirs["forwardtrack"]))
+            cache.put(date, fluxes, states)
+
+        # Backward sweep, from the cache
+        s_track = np.zeros_like(s_track)
+        for date in datelist[::-1]:
+            print("backward", date)
+            fluxes, states = cache.pop(date)
+            steps = day_timesteps(
+                fluxes, states, reverse=True, zero=None if event(date) else "precip"
+            )
+            s_track, output = backtrack_layers(
+                steps, fluxes.time.size, s_track, regions["backtrack"], config["kvf"]
+            )
+            if "layer" not in states.dims:
+                output = two_layer_output(output)
+            output.coords["lat"] = states.latitude.values
+            output.coords["lon"] = states.longitude.values
+            with FILE_LOCK:
+                output.to_netcdf(output_path(date, output_dirs["backtrack"]))
+    finally:
+        cache.close()
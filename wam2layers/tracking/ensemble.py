@@ -0,0 +1,243 @@
+"""Backtrack several events that share the same preprocessed days.
+
+Each event has its own region, event dates and (optionally) tracking period,
+given in the `events` list of the config file. Instead of running a separate
+experiment for each event, all events are tracked together, backward in time:
+each day is read and prepared only once and then tracked for every event
+that needs it, in parallel threads that share the (read-only) prepared data.
+The next day is prepared in the background in the meantime, and a day is
+dropped as soon as all events that need it have been tracked.
+
+The output of each event is written to output_folder/<name>/backtrack,
+including its summary.nc. The settings `restart`, `stop_threshold` and
+`preprocess` (on the fly) apply to all events; each event stops on its own.
+
+Example:
+
+    wam2layers ensemble cases/era5_2021.yaml
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.tracking.backtrack import (
+    LAYER_SCHEMES,
+    SCHEMES,
+    input_days,
+    layer_timesteps,
+    load_region,
+    output_path,
+    prepare_fluxes,
+    prepare_layers,
+    resample,
+    subdaily_output_path,
+    summary_path,
+    time_in_range,
+    timesteps,
+    tracking_summary,
+)
+from wam2layers.tracking.io import FILE_LOCK, SubdailyOutput
+
+
+class Event:
+    """Settings and tracking state of a single event."""
+
+    def __init__(self, settings, config):
+        self.name = settings["name"]
+        self.event_start_date = settings["event_start_date"]
+        self.event_end_date = settings["event_end_date"]
+        self.dates = pd.date_range(
+            start=settings.get("track_start_date", config["track_start_date"]),
+            end=settings.get("track_end_date", config["track_end_date"]),
+            freq="d",
+            inclusive="left",
+        )
+        self.region_file = settings["region"]
+        self.stop_threshold = config.get("stop_threshold")
+
+        self.output_dir = Path(config["output_folder"]).expanduser() / self.name / "backtrack"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Region and tracked moisture of each layer, set on the last day (see start)
+        self.region = None
+        self.s_track = None
+
+        # Moisture budget of the days tracked so far
+        self.first_date = None
+        self.e_track_total = 0.0
+        self.losses_total = 0.0
+        self.stopped = False
+
+    def start(self, date, states, config):
+        """Load the region on the grid of the data and the initial tracked moisture."""
+        with FILE_LOCK:
+            self.region = load_region(self.region_file, states).values
+        layered = "layer" in states.dims
+        if config.get("restart", False):
+            # Reload last state from existing output
+            restart = output_path(date + pd.Timedelta(days=1), self.output_dir)
+            with FILE_LOCK, xr.open_dataset(restart) as ds:
+                if layered:
+                    self.s_track = ds.s_track_restart.values
+                else:
+                    self.s_track = np.stack(
+                        [ds.s_track_upper_restart.values, ds.s_track_lower_restart.values]
+                    )
+        else:
+            nlayer = states.layer.size if layered else 2
+            self.s_track = np.zeros((nlayer, *self.region.shape))
+
+    def track_day(self, date, fluxes, states, config):
+        """Track one (prepared) day and write the output."""
+        # The prepared data is shared between events, so it is not modified;
+        # outside the event, precipitation is replaced by zeros instead
+        layered = "layer" in states.dims
+        steps = layer_timesteps(fluxes, states) if layered else timesteps(fluxes, states)
+        if not time_in_range(
+            self.event_start_date, self.event_end_date, date.strftime("%Y%m%d")
+        ):
+            no_precip = np.zeros(self.region.shape)
+            steps = ((t, step._replace(precip=no_precip)) for t, step in steps)
+
+        subdaily = None
+        if config.get("output_frequency"):
+            subdaily = SubdailyOutput(
+                subdaily_output_path(date, self.output_dir),
+                states.time.values,
+                self.region.shape,
+                config["output_frequency"],
+                snapshots=config.get("output_snapshots", False),
+            )
+
+        if layered:
+            track = LAYER_SCHEMES[config.get("tracking_scheme", "explicit")]
+            self.s_track, output = track(
+                steps, fluxes.time.size, self.s_track, self.region, config["kvf"]
+            )
+        else:
+            track = SCHEMES[config.get("tracking_scheme", "explicit")]
+            s_track_upper, s_track_lower, output = track(
+                steps,
+                fluxes.time.size,
+                self.s_track[0],
+                self.s_track[1],
+                self.region,
+                config["kvf"],
+                subdaily,
+            )
+            self.s_track = np.stack([s_track_upper, s_track_lower])
+        if subdaily is not None:
+            subdaily.close()
+        output.coords["lat"] = states.latitude.values
+        output.coords["lon"] = states.longitude.values
+        with FILE_LOCK:
+            output.to_netcdf(output_path(date, self.output_dir))
+
+        # Stop once (almost) all tracked moisture has been attributed, like
+        # run_experiment
+        self.first_date = date
+        self.e_track_total += float(output.e_track.sum())
+        self.losses_total += sum(
+            float(output[f"{side}_loss"].sum()) for side in ["north", "south", "east", "west"]
+        )
+        remaining = self.remaining()
+        tracked = remaining + self.e_track_total + self.losses_total
+        if (
+            self.stop_threshold is not None
+            and date <= pd.Timestamp(self.event_start_date)
+            and tracked > 0
+        ):
+            self.stopped = remaining < self.stop_threshold / 100 * tracked
+
+    def remaining(self):
+        return float(self.s_track.sum())
+
+    def write_summary(self):
+        """Write the moisture budget of the tracked days (see tracking_summary)."""
+        summary = tracking_summary(
+            self.dates[self.dates >= self.first_date],
+            self.remaining(),
+            self.e_track_total,
+            self.losses_total,
+            self.stopped,
+        )
+        summary.to_netcdf(summary_path(self.output_dir))
+
+
+def prepare_day(days, config):
+    """Read, resample and prepare the next day of preprocessed data from days."""
+    # Not holding FILE_LOCK while the next day is preprocessed (see input_days)
+    preprocessed_data = next(days)
+    with FILE_LOCK, preprocessed_data:
+        fluxes, states = resample(preprocessed_data, config["target_frequency"])
+        fluxes, states = fluxes.load(), states.load()
+
+    # Data with more than two layers has them stacked on a layer axis
+    scheme = config.get("tracking_scheme", "explicit")
+    layered = "layer" in states.dims
+    if layered and config.get("output_frequency"):
+        raise ValueError("Data with stacked layers can't be tracked with sub-daily output")
+    prepare = prepare_layers if layered else prepare_fluxes
+    prepare(fluxes, states, config["target_frequency"], config["kvf"], scheme == "explicit")
+    return fluxes, states
+
+
+def run_ensemble(config_file):
+    """Backtrack all events in the config file, sharing the prepared days."""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    if config.get("streaming", False) or config.get("screening"):
+        raise ValueError("Ensemble runs are not available with streaming or screening")
+
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    if config.get("preprocess") and config.get("spill", False):
+        input_dir.mkdir(parents=True, exist_ok=True)
+    events = [Event(settings, config) for settings in config["events"]]
+
+    # For each day, the events that still need it
+    pending = defaultdict(list)
+    for event in events:
+        for date in event.dates:
+            pending[date].append(event)
+    dates = sorted(pending, reverse=True)
+
+    # The preprocessed data of each day, backward in time
+    days = input_days(dates, input_dir, config)
+
+    workers = config.get("ensemble_workers", 4)
+    with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(
+        max_workers=workers
+    ) as pool:
+        next_day = loader.submit(prepare_day, days, config)
+        for i, date in enumerate(dates):
+            print(date)
+            fluxes, states = next_day.result()
+            if i + 1 < len(dates):
+                next_day = loader.submit(prepare_day, days, config)
+
+            tracked = [event for event in pending.pop(date) if not event.stopped]
+            for event in tracked:
+                if event.region is None:
+                    event.start(date, states, config)
+            tracking = [
+                pool.submit(event.track_day, date, fluxes, states, config)
+                for event in tracked
+            ]
+            for future in tracking:
+                future.result()
+
+            # No pending event needs this day anymore
+            del fluxes, states
+            if all(event.stopped for event in events):
+                print("Stopping: all events have been tracked")
+                break
+
+    for event in events:
+        if event.first_date is not None:
+            event.write_summary()
@@ -0,0 +1,201 @@
+"""Input and output of the tracking, other than the daily output files."""
+import threading
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends.locks import HDF5_LOCK
+
+# HDF5 is not thread-safe, and xarray holds HDF5_LOCK only around parts of
+# reading and writing a file. Threads that may use files at the same time (see
+# ensemble) hold FILE_LOCK for the whole operation.
+FILE_LOCK = threading.RLock()
+
+
+class SubdailyOutput:
+    """Stream sub-daily output of the tracking to a netcdf file.
+
+    Every `frequency` (e.g. "1h" or "3h"), the tracked storages, tracked
+    evaporation and losses of the last interval are appended to the file.
+    Only the accumulations of the current interval are kept in memory.
+
+    The storages are interval means, or snapshots at the start of the interval
+    if snapshots=True. Tracked evaporation and losses are interval totals. The
+    time coordinate is the start of the interval. Since the tracking runs
+    backward in time, records are written in reverse chronological order.
+
+    The file is written with netCDF4 directly, while other threads may read
+    input through xarray; HDF5 is not thread-safe, so all access to the file
+    holds the lock that xarray uses for it, and FILE_LOCK.
+    """
+
+    def __init__(self, path, times, shape, frequency, snapshots=False):
+        """Times are the times of the states, shape is (nlat, nlon)."""
+        import netCDF4
+
+        self.times = pd.DatetimeIndex(times)
+        step = self.times[1] - self.times[0]
+        self.nsteps = pd.Timedelta(frequency) / step
+        ntime = len(self.times) - 1
+        if self.nsteps % 1 != 0 or ntime % self.nsteps != 0:
+            raise ValueError(
+                f"Output frequency {frequency} should be a multiple of the "
+                f"time step ({step}) and fit a whole number of times in a day."
+            )
+        self.nsteps = int(self.nsteps)
+        self.snapshots = snapshots
+
+        nlat, nlon = shape
+        self.buffers = {
+            "s_track_upper": np.zeros((nlat, nlon)),
+            "s_track_lower": np.zeros((nlat, nlon)),
+            "e_track": np.zeros((nlat, nlon)),
+            "north_loss": np.zeros(nlon),
+            "south_loss": np.zeros(nlon),
+            "east_loss": np.zeros(nlat),
+            "west_loss": np.zeros(nlat),
+        }
+        dims = {
+            "s_track_upper": ("time", "lat", "lon"),
+            "s_track_lower": ("time", "lat", "lon"),
+            "e_track": ("time", "lat", "lon"),
+            "north_loss": ("time", "lon"),
+            "south_loss": ("time", "lon"),
+            "east_loss": ("time", "lat"),
+            "west_loss": ("time", "lat"),
+        }
+
+        with FILE_LOCK, HDF5_LOCK:
+            self.file = netCDF4.Dataset(path, "w")
+            self.file.createDimension("time", None)
+            self.file.createDimension("lat", nlat)
+            self.file.createDimension("lon", nlon)
+            time = self.file.createVariable("time", "f8", ("time",))
+            time.units = f"seconds since {self.times[0].isoformat()}"
+            time.calendar = "proleptic_gregorian"
+            for name, dim in dims.items():
+                self.file.createVariable(name, "f8", dim, zlib=True)
+            self.file.variables["s_track_upper"].cell_methods = (
+                "time: point" if snapshots else "time: mean"
+            )
+            self.file.variables["s_track_lower"].cell_methods = (
+                "time: point" if snapshots else "time: mean"
+            )
+        self.record = 0
+
+    def update(self, t, s_track_upper, s_track_lower, e_track, north, south, east, west):
+        """Add the results of time step t; write a record if an interval is complete."""
+        buffers = self.buffers
+        if not self.snapshots:
+            buffers["s_track_upper"] += s_track_upper / self.nsteps
+            buffers["s_track_lower"] += s_track_lower / self.nsteps
+        buffers["e_track"] += e_track
+        buffers["north_loss"] += north
+        buffers["south_loss"] += south
+        buffers["east_loss"] += east
+        buffers["west_loss"] += west
+
+        if t % self.nsteps == 0:
+            if self.snapshots:
+                buffers["s_track_upper"][:] = s_track_upper
+                buffers["s_track_lower"][:] = s_track_lower
+            self.write(t)
+
+    def write(self, t):
+        """Write the current interval, starting at time step t, and reset it."""
+        seconds = (self.times[t] - self.times[0]).total_seconds()
+        with FILE_LOCK, HDF5_LOCK:
+            self.file.variables["time"][self.record] = seconds
+            for name, buffer in self.buffers.items():
+                self.file.variables[name][self.record] = buffer
+        for buffer in self.buffers.values():
+            buffer[:] = 0
+        self.record += 1
+
+    def close(self):
+        with FILE_LOCK, HDF5_LOCK:
+            self.file.close()
+
+
+def probe_index(latitude, longitude, points):
+    """Return the (latitude, longitude) indices of the cells nearest to points.
+
+    Points is a list of (lat, lon) pairs. Raises a ValueError for points
+    outside the grid.
+    """
+    latitude, longitude = np.asarray(latitude), np.asarray(longitude)
+    dlat = np.abs(np.diff(latitude)).max()
+    dlon = np.abs(np.diff(longitude)).max()
+
+    ilat, ilon = [], []
+    for lat, lon in points:
+        i = np.abs(latitude - lat).argmin()
+        distance = np.abs((longitude - lon + 180) % 360 - 180)
+        j = distance.argmin()
+        if abs(latitude[i] - lat) > dlat / 2 or distance[j] > dlon / 2:
+            raise ValueError(f"Probe ({lat}, {lon}) is outside the grid")
+        ilat.append(i)
+        ilon.append(j)
+    return np.array(ilat), np.array(ilon)
+
+
+class ProbeOutput:
+    """Collect time series of the tracking at a few grid cells ("probes").
+
+    Index holds the latitude and longitude indices of the probes (see
+    probe_index). After every time step only these cells are copied into a
+    small buffer, which is written as a (probe, time) table at the end of the
+    day. The storages are snapshots at the start of each time step, the
+    tracked evaporation is the total over the time step.
+    """
+
+    def __init__(self, index, times):
+        """Times are the times of the states."""
+        self.index = index
+        self.times = pd.DatetimeIndex(times)[:-1]
+        self.s_track = None
+        self.e_track = np.zeros((len(index[0]), len(self.times)))
+
+    def update(self, t, *args):
+        """Add the results of time step t; same arguments as SubdailyOutput.update.
+
+        With stacked layers, the tracked storage of each layer is passed.
+        """
+        *s_track, e_track, _, _, _, _ = args
+        if self.s_track is None:
+            self.s_track = np.zeros((len(s_track), *self.e_track.shape))
+        for layer, values in enumerate(s_track):
+            self.s_track[layer, :, t] = values[self.index]
+        self.e_track[:, t] = e_track[self.index]
+
+    def write(self, path, latitude, longitude, stacked=False):
+        """Write the table; stacked layers are written as s_track (layer, probe, time)."""
+        ds = xr.Dataset(
+            {"e_track": (["probe", "time"], self.e_track)},
+            coords={
+                "time": self.times,
+                "lat": ("probe", np.asarray(latitude)[self.index[0]]),
+                "lon": ("probe", np.asarray(longitude)[self.index[1]]),
+            },
+        )
+        if stacked:
+            ds["s_track"] = (["layer", "probe", "time"], self.s_track)
+        else:
+            ds["s_track_upper"] = (["probe", "time"], self.s_track[0])
+            ds["s_track_lower"] = (["probe", "time"], self.s_track[1])
+        with FILE_LOCK:
+            ds.to_netcdf(path)
+
+
+class Outputs:
+    """Pass the results of every time step to several outputs at once.
+
+    E.g. a SubdailyOutput and a ProbeOutput; None is ignored.
+    """
+
+    def __init__(self, *outputs):
+        self.outputs = [output for output in outputs if output is not None]
+
+    def update(self, t, *args):
+        for output in self.outputs:
+            output.update(t, *args)
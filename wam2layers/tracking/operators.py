@@ -0,0 +1,413 @@
+"""Track many regions at once with precomputed transport operators.
+
+For given fluxes and states, a time step of the backtracking is linear in the
+tracked moisture and in the region: the tracked moisture after the step is
+A @ s_track + w * region, with a sparse matrix A (the stencil of
+backtrack_layers: each cell exchanges with its four neighbours and the layers
+above and below it) and source weights w (the share of the precipitation in
+each layer). The tracked evaporation and the losses over the boundaries are
+linear in the tracked moisture as well.
+
+The operators of each time step are computed once per day and saved to
+operator_folder (default: output_folder/operators) as {date}_operator.npz.
+All time steps share the same sparsity pattern, so only the values of the
+matrix are stored for every step. Later queries reuse the saved operators
+and track any number of regions at once, with sparse matrix-matrix products.
+
+The redistribution of tracked moisture that exceeds the storage of a layer
+(see backtrack_layers) is not linear. It is applied to each region
+separately after the product, so the result is the same as that of the
+backtrack command; the storages are saved along with the operators for this.
+
+Example:
+
+    wam2layers regions cases/era5_2021.yaml regions.nc --variable region
+"""
+import json
+import os
+from importlib import import_module
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.preprocessing import PREPROCESSORS
+from wam2layers.tracking.backtrack import (
+    input_days,
+    input_path,
+    prepare_fluxes,
+    prepare_layers,
+    resample,
+    split_vertical_flux,
+    time_in_range,
+    to_edges_meridional,
+    to_edges_zonal,
+)
+from wam2layers.tracking.bidirectional import day_timesteps
+
+
+def operator_path(date, operator_dir):
+    return f"{operator_dir}/{date.strftime('%Y-%m-%d')}_operator.npz"
+
+
+def regions_output_path(date, output_dir):
+    return f"{output_dir}/{date.strftime('%Y-%m-%d')}_s_track_regions.nc"
+
+
+# Neighbours in the stencil: offsets in (layer, latitude, longitude)
+NEIGHBOURS = {
+    "east": (0, 0, 1),
+    "west": (0, 0, -1),
+    "north": (0, -1, 0),
+    "south": (0, 1, 0),
+    "above": (-1, 0, 0),
+    "below": (1, 0, 0),
+}
+
+
+def stencil(nlayer, nlat, nlon):
+    """Return the sparsity pattern of the transport matrix of one time step.
+
+    Returns the CSR indices and indptr, and for each entry of the stencil
+    (self first, then the NEIGHBOURS), the mask of the cells it applies to
+    and the position of its values in the CSR data. Boundary cells are kept
+    fixed: their only entry is the diagonal.
+    """
+    shape = (nlayer, nlat, nlon)
+    index = np.arange(nlayer * nlat * nlon).reshape(shape)
+    inner = np.zeros(shape, dtype=bool)
+    inner[:, 1:-1, 1:-1] = True
+
+    masks = {"self": np.ones(shape, dtype=bool)}
+    rows, cols = [index.ravel()], [index.ravel()]
+    for name, (dk, di, dj) in NEIGHBOURS.items():
+        mask = inner.copy()
+        if dk == -1:
+            mask[0] = False
+        if dk == 1:
+            mask[-1] = False
+        masks[name] = mask
+        k, i, j = np.nonzero(mask)
+        rows.append(index[k, i, j])
+        cols.append(index[k + dk, i + di, j + dj])
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=index.size))])
+
+    # Position in the CSR data of the i-th entry in stencil order
+    position = np.empty_like(order)
+    position[order] = np.arange(order.size)
+    return cols[order], indptr, masks, position
+
+
+def step_operator(step, kvf, masks, position):
+    """Return the CSR data, source weights and diagnostic weights of a time step.
+
+    Step is a LayerTimestep. The diagnostic weights give the tracked
+    evaporation (from the lowest layer after the step) and the losses over
+    the northern, southern, eastern and western boundary (from all layers
+    before the step), per unit of tracked moisture.
+    """
+    f_downward, f_upward = split_vertical_flux(kvf, step.f_vert)
+    f_e_we, f_e_ew, f_w_we, f_w_ew = to_edges_zonal(step.fx)
+    fy_n_sn, fy_n_ns, fy_s_sn, fy_s_ns = to_edges_meridional(step.fy)
+
+    # Fluxes that take tracked moisture from each neighbour (backward in time)
+    coefficients = {
+        "east": f_e_we,
+        "west": f_w_ew,
+        "north": fy_n_sn,
+        "south": fy_s_ns,
+        "above": np.zeros_like(step.s),
+        "below": np.zeros_like(step.s),
+    }
+    coefficients["above"][1:] = f_upward
+    coefficients["below"][:-1] = f_downward
+
+    # Fluxes that take tracked moisture from the cell itself
+    out = fy_s_sn + fy_n_ns + f_e_ew + f_w_we
+    out[:-1] += f_upward
+    out[1:] += f_downward
+    out[-1] += step.evap
+
+    # Entries are per unit of tracked moisture of the cell or its neighbour
+    inner = masks["east"]
+    values = [np.where(inner, 1 - out / step.s_next, 1).ravel()]
+    for name, (dk, di, dj) in NEIGHBOURS.items():
+        neighbour = np.roll(step.s_next, (-dk, -di, -dj), axis=(0, 1, 2))
+        values.append((coefficients[name] / neighbour)[masks[name]])
+    data = np.empty(position.size)
+    data[position] = np.concatenate(values)
+
+    source = np.where(inner, step.precip * (step.s_next / step.s_next.sum(axis=0)), 0)
+    diagnostics = {
+        "evap": step.evap / step.s_next[-1],
+        "north": fy_n_ns[:, 1, :] / step.s_next[:, 1, :],
+        "south": fy_s_sn[:, -2, :] / step.s_next[:, -2, :],
+        "east": f_e_ew[:, :, -2] / step.s_next[:, :, -2],
+        "west": f_w_we[:, :, 1] / step.s_next[:, :, 1],
+    }
+    return data, source, diagnostics
+
+
+class DayOperator:
+    """The transport operators of all time steps of a day, in backward order."""
+
+    def __init__(
+        self, indices, indptr, data, source, storage, evap, north, south, east, west,
+        latitude, longitude,
+    ):
+        self.indices = indices
+        self.indptr = indptr
+        self.data = data
+        self.source = source
+        self.storage = storage
+        self.evap = evap
+        self.north = north
+        self.south = south
+        self.east = east
+        self.west = west
+        self.latitude = latitude
+        self.longitude = longitude
+        self.nlayer, self.nlat, self.nlon = source.shape[1:]
+
+    @classmethod
+    def from_timesteps(cls, timesteps, ntime, nlayer, latitude, longitude, kvf):
+        """Build the operators from (t, LayerTimestep), backward in time."""
+        nlat, nlon = latitude.size, longitude.size
+        indices, indptr, masks, position = stencil(nlayer, nlat, nlon)
+        arrays = {
+            "data": np.empty((ntime, position.size)),
+            "source": np.empty((ntime, nlayer, nlat, nlon)),
+            "storage": np.empty((ntime, nlayer, nlat, nlon)),
+            "evap": np.empty((ntime, nlat, nlon)),
+            "north": np.empty((ntime, nlayer, nlon)),
+            "south": np.empty((ntime, nlayer, nlon)),
+            "east": np.empty((ntime, nlayer, nlat)),
+            "west": np.empty((ntime, nlayer, nlat)),
+        }
+        for i, (_, step) in enumerate(timesteps):
+            data, source, diagnostics = step_operator(step, kvf, masks, position)
+            arrays["data"][i] = data
+            arrays["source"][i] = source
+            arrays["storage"][i] = step.s
+            for name, values in diagnostics.items():
+                arrays[name][i] = values
+        return cls(indices, indptr, latitude=latitude, longitude=longitude, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls(**{name: npz[name] for name in npz.files if name != "settings"})
+
+    def save(self, path, settings=""):
+        # Write to a temporary file first, so that an interrupted run leaves no broken file
+        tmp = Path(f"{path}.tmp.npz")
+        np.savez(
+            tmp,
+            settings=settings,
+            indices=self.indices,
+            indptr=self.indptr,
+            data=self.data,
+            source=self.source,
+            storage=self.storage,
+            evap=self.evap,
+            north=self.north,
+            south=self.south,
+            east=self.east,
+            west=self.west,
+            latitude=self.latitude,
+            longitude=self.longitude,
+        )
+        tmp.replace(path)
+
+    def track(self, s_track, regions):
+        """Track several regions backward in time over the day.
+
+        S_track has shape (layer, lat, lon, region); regions has shape (lat, lon, region) and gives the weight of the
+        precipitation of each cell (zero outside the event). Returns the
+        tracked moisture at the start of the day and a dataset with the daily output of each region, like that of
+        backtrack_layers.
+        """
+        import scipy.sparse as sparse
+
+        nlayer, nlat, nlon, nregion = s_track.shape
+        size = nlayer * nlat * nlon
+        ntime = self.data.shape[0]
+        x = s_track.reshape(size, nregion)
+
+        s_track_mean = np.zeros((nlayer, nlat, nlon, nregion))
+        e_track = np.zeros((nlat, nlon, nregion))
+        losses = {
+            "north": np.zeros((nlon, nregion)),
+            "south": np.zeros((nlon, nregion)),
+            "east": np.zeros((nlat, nregion)),
+            "west": np.zeros((nlat, nregion)),
+        }
+
+        for t in range(ntime):
+            s = x.reshape(nlayer, nlat, nlon, nregion)
+            losses["north"] += np.einsum("kj,kjr->jr", self.north[t], s[:, 1])
+            losses["south"] += np.einsum("kj,kjr->jr", self.south[t], s[:, -2])
+            losses["east"] += np.einsum("ki,kir->ir", self.east[t], s[:, :, -2])
+            losses["west"] += np.einsum("ki,kir->ir", self.west[t], s[:, :, 1])
+
+            matrix = sparse.csr_matrix(
+                (self.data[t], self.indices, self.indptr), shape=(size, size)
+            )
+            x = matrix @ x
+            x += (self.source[t][..., None] * regions[None]).reshape(size, nregion)
+
+            # redistribute the excess of each layer, like backtrack_layers
+            s = x.reshape(nlayer, nlat, nlon, nregion)
+            excess = np.maximum(0, s - self.storage[t][..., None])
+            change = -excess
+            change[1:] += excess[:-1]
+            change[-2] += excess[-1]
+            s[:, 1:-1, 1:-1] += change[:, 1:-1, 1:-1]
+
+            e_track += self.evap[t][..., None] * s[-1]
+            s_track_mean += s / ntime
+
+        s_track = x.reshape(nlayer, nlat, nlon, nregion)
+        dims = ["layer", "lat", "lon", "region"]
+        ds = xr.Dataset(
+            {
+                "s_track_restart": (dims, s_track),
+                "s_track": (dims, s_track_mean),
+                "e_track": (dims[1:], e_track),
+                "north_loss": (["lon", "region"], losses["north"]),
+                "south_loss": (["lon", "region"], losses["south"]),
+                "east_loss": (["lat", "region"], losses["east"]),
+                "west_loss": (["lat", "region"], losses["west"]),
+            }
+        )
+        return s_track, ds.transpose("region", ...)
+
+
+# Config settings that the operators depend on
+OPERATOR_KEYS = [
+    "target_frequency",
+    "kvf",
+    "layer_boundary",
+    "layer_boundaries",
+    "bounding_box",
+    "region_buffer",
+    "preprocess",
+]
+
+
+def operator_settings(date, input_dir, config):
+    """Return the settings and input that the operators of a day depend on.
+
+    The input files are the preprocessed data of the day, or, when it is
+    preprocessed on the fly, the input of the preprocessing. They are
+    compared by size and modification time, like in the preprocessing
+    manifest, so that the operators are rebuilt when the input is updated.
+    """
+    source = config.get("preprocess")
+    if source is None:
+        paths = [input_path(date, input_dir)]
+    else:
+        paths = import_module(PREPROCESSORS[source]).input_files(date, config)
+    if config.get("bounding_box") is None and config.get("region_buffer") is not None:
+        paths.append(config["region"])
+
+    inputs = {}
+    for path in paths:
+        stat = os.stat(path)
+        inputs[str(path)] = [stat.st_size, stat.st_mtime_ns]
+    settings = {key: config.get(key) for key in OPERATOR_KEYS}
+    return json.dumps({"settings": settings, "inputs": inputs}, sort_keys=True)
+
+
+def is_current(path, settings):
+    """Whether the operators in path exist and were built with the same settings."""
+    if not Path(path).exists():
+        return False
+    with np.load(path) as npz:
+        return "settings" in npz.files and str(npz["settings"]) == settings
+
+
+def build_operators(dates, input_dir, operator_dir, config):
+    """Build and save the operators of the dates that are not saved or outdated."""
+    settings = {date: operator_settings(date, input_dir, config) for date in dates}
+    missing = [
+        date
+        for date in dates
+        if not is_current(operator_path(date, operator_dir), settings[date])
+    ]
+    for date, preprocessed_data in zip(missing, input_days(missing, input_dir, config)):
+        print("operator", date)
+        layered = "layer" in preprocessed_data.dims
+        fluxes, states = resample(preprocessed_data, config["target_frequency"])
+        fluxes, states = fluxes.load(), states.load()
+        prepare = prepare_layers if layered else prepare_fluxes
+        prepare(fluxes, states, config["target_frequency"], config["kvf"])
+
+        operator = DayOperator.from_timesteps(
+            day_timesteps(fluxes, states, reverse=True),
+            fluxes.time.size,
+            preprocessed_data.layer.size if layered else 2,
+            preprocessed_data.latitude.values,
+            preprocessed_data.longitude.values,
+            config["kvf"],
+        )
+        operator.save(operator_path(date, operator_dir), settings[date])
+
+
+def run_regions(config_file, regions_file, variable="region"):
+    """Backtrack all regions in a file, with the (saved) operators of each day.
+
+    The regions are the variable `variable` in `regions_file`, with dimensions
+    (region, latitude, longitude), or (latitude, longitude) for a single
+    region, on (or around) the grid of the preprocessed data.
+    """
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    if config.get("tracking_scheme", "explicit") != "explicit" or config.get("screening"):
+        raise ValueError("Operators are only available for the explicit scheme, without screening")
+    if config.get("layer_boundary") is not None:
+        raise ValueError("Operators are not available with a layer_boundary")
+
+    dates = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )[::-1]
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_root = Path(config["output_folder"]).expanduser()
+    operator_dir = Path(config.get("operator_folder") or output_root / "operators").expanduser()
+    output_dir = output_root / "regions"
+    operator_dir.mkdir(parents=True, exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if config.get("preprocess") and config.get("spill", False):
+        input_dir.mkdir(parents=True, exist_ok=True)
+
+    build_operators(dates, input_dir, operator_dir, config)
+
+    regions = xr.open_dataset(regions_file)[variable]
+    if "region" not in regions.dims:
+        regions = regions.expand_dims("region")
+
+    s_track = None
+    for date in dates:
+        print(date)
+        operator = DayOperator.load(operator_path(date, operator_dir))
+        if s_track is None:
+            regions = regions.sel(latitude=operator.latitude, longitude=operator.longitude)
+            regions = regions.transpose("latitude", "longitude", "region").values
+            shape = (operator.nlayer, operator.nlat, operator.nlon, regions.shape[-1])
+            s_track = np.zeros(shape)
+
+        event = time_in_range(
+            config["event_start_date"], config["event_end_date"], date.strftime("%Y%m%d")
+        )
+        s_track, output = operator.track(s_track, regions if event else 0 * regions)
+        output.coords["lat"], output.coords["lon"] = operator.latitude, operator.longitude
+        output.to_netcdf(regions_output_path(date, output_dir))
@@ -0,0 +1,95 @@
+"""Fast screening runs on a coarser grid.
+
+For a first look at the source regions of an event, the preprocessed data can
+be aggregated onto a grid that is `factor` times coarser in both directions,
+before it is tracked with the standard backtracking. The aggregation is
+conservative: storages, precipitation and evaporation keep their volume per
+block of grid cells, and the fluxes keep their transport through the faces of
+the coarse grid cells. Rows and columns that do not fill a whole block at the
+southern and eastern edges of the domain are dropped.
+
+The tracked evaporation can be mapped back to the fine grid, in proportion to
+the evaporation of the fine grid cells within each coarse cell. This keeps
+the total tracked evaporation of every coarse cell.
+"""
+import numpy as np
+import xarray as xr
+
+from wam2layers.preprocessing.preprocessing import get_grid_info
+
+
+def block_sum(values, factor):
+    """Sum over blocks of factor x factor cells in the last two dimensions."""
+    *other, nlat, nlon = values.shape
+    nlat_c, nlon_c = nlat // factor, nlon // factor
+    values = values[..., : nlat_c * factor, : nlon_c * factor]
+    values = values.reshape(*other, nlat_c, factor, nlon_c, factor)
+    return values.sum(axis=(-3, -1))
+
+
+def coarse_grid(ds, factor):
+    """Return a dataset with the coordinates of the coarse grid."""
+    nlat, nlon = ds.latitude.size // factor, ds.longitude.size // factor
+    latitude = ds.latitude.values[: nlat * factor].reshape(nlat, factor).mean(axis=1)
+    longitude = ds.longitude.values[: nlon * factor].reshape(nlon, factor).mean(axis=1)
+    return xr.Dataset(
+        coords={"time": ds.time.values, "latitude": latitude, "longitude": longitude}
+    )
+
+
+def coarsen(ds, factor):
+    """Aggregate one day of preprocessed data onto a coarser grid."""
+    a, ly, lx = get_grid_info(ds)
+    coarse = coarse_grid(ds, factor)
+    a_c, ly_c, lx_c = get_grid_info(coarse)
+    dims = ["time", "latitude", "longitude"]
+
+    for layer in ["upper", "lower"]:
+        # Transport through the eastern and northern faces of the coarse cells
+        fx = block_sum(ds[f"fx_{layer}"].values * ly, factor) / factor
+        fy = block_sum(ds[f"fy_{layer}"].values * lx[:, None], factor) / factor
+        coarse[f"fx_{layer}"] = (dims, fx / ly_c)
+        coarse[f"fy_{layer}"] = (dims, fy / lx_c[:, None])
+        coarse[f"s_{layer}"] = (dims, block_sum(ds[f"s_{layer}"].values, factor))
+
+    for name in ["precip", "evap"]:
+        volume = block_sum(ds[name].values * a[:, None], factor)
+        coarse[name] = (dims, volume / a_c[:, None])
+    return coarse
+
+
+def coarsen_region(region, ds, factor):
+    """Return the area-weighted fraction of each coarse cell in the region."""
+    a, _, _ = get_grid_info(ds)
+    area = np.broadcast_to(a[:, None], region.shape)
+    return block_sum(region * area, factor) / block_sum(area, factor)
+
+
+def expand(values, factor):
+    """Repeat each cell of a coarse field over its block of fine cells."""
+    return np.repeat(np.repeat(values, factor, axis=-2), factor, axis=-1)
+
+
+def refine(e_track, ds, factor):
+    """Map tracked evaporation on the coarse grid back to the fine grid.
+
+    Each coarse cell is distributed over its fine cells in proportion to their
+    evaporation during the day (or their area, if there was no evaporation).
+    Fine cells that are not covered by the coarse grid are set to NaN.
+    """
+    a, _, _ = get_grid_info(ds)
+    nlat, nlon = e_track.shape[0] * factor, e_track.shape[1] * factor
+
+    # The evaporation at the first time is not used in the tracking
+    area = np.broadcast_to(a[:, None], (ds.latitude.size, ds.longitude.size))
+    evap = ds["evap"].values[1:].sum(axis=0) * area
+    weight = np.where(
+        expand(block_sum(evap, factor), factor) > 0,
+        evap[:nlat, :nlon],
+        area[:nlat, :nlon],
+    )
+    weight = weight / expand(block_sum(weight, factor), factor)
+
+    fine = np.full(area.shape, np.nan)
+    fine[:nlat, :nlon] = expand(e_track, factor) * weight
+    return fine
@@ -0,0 +1,152 @@
+"""Out-of-core tracking: read the input one time step at a time.
+
+Instead of loading a whole day of preprocessed data and resampling it in
+memory, TimestepStream reads one (native) time slice of each variable at a
+time from the preprocessed file, and interpolates the sub-steps between two
+slices just before the tracking needs them. A background thread reads the
+next slices ahead, so reading overlaps with the tracking. The memory use is
+a few 2d fields per variable, independent of the number of time steps.
+
+Reading a single time slice is cheap for the files written by the
+preprocessing, which are not chunked or chunked per time step.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from wam2layers.tracking.backtrack import Timestep, prepare_timestep, volume_factors
+
+variables = [
+    "fx_upper",
+    "fy_upper",
+    "fx_lower",
+    "fy_lower",
+    "evap",
+    "precip",
+    "s_upper",
+    "s_lower",
+]
+
+
+class TimestepStream:
+    """Yield the prepared input of each time step, backward in time.
+
+    Gives the same result as resample + prepare_fluxes + timesteps, but
+    reads the preprocessed data from `path` just in time. Up to `read_ahead`
+    native time slices are read in advance. If zero_precip is True, the
+    precipitation is set to zero (outside the tracking event). Stabilize is
+    passed on to prepare_timestep.
+    """
+
+    def __init__(
+        self, path, target_freq, kvf, read_ahead=2, zero_precip=False, stabilize=True
+    ):
+        self.ds = xr.open_dataset(path)
+        self.kvf = kvf
+        self.stabilize = stabilize
+        self.read_ahead = read_ahead
+        self.zero_precip = zero_precip
+        self.factors = volume_factors(self.ds, target_freq)
+
+        native_times = pd.DatetimeIndex(self.ds.time.values)
+        ratio = (native_times[1] - native_times[0]) / pd.Timedelta(target_freq)
+        if ratio % 1 != 0:
+            raise ValueError(
+                f"The time step of the input should be a multiple of {target_freq}"
+            )
+        self.nsub = int(ratio)
+        self.nnative = len(native_times)
+        self.ntime = (self.nnative - 1) * self.nsub
+
+        # Same times as the states after resampling
+        self.times = pd.date_range(native_times[0], native_times[-1], freq=target_freq)
+        self.shape = self.ds["s_upper"].shape[1:]
+        self.latitude = self.ds.latitude.values
+        self.longitude = self.ds.longitude.values
+
+        # Daily accumulations of the prepared fluxes, see summary
+        self._sums = {}
+
+    def _read(self, i):
+        """Read the i-th native time slice of all variables."""
+        return {
+            name: np.array(self.ds[name][i].values, dtype="float64")
+            for name in variables
+        }
+
+    def __iter__(self):
+        n = self.nsub
+        self._sums = {name: np.zeros(self.shape) for name in variables[:6]}
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = deque(
+                pool.submit(self._read, i)
+                for i in reversed(range(max(0, self.nnative - 1 - self.read_ahead), self.nnative))
+            )
+            next_read = self.nnative - 2 - self.read_ahead
+            later = pending.popleft().result()
+
+            for i in reversed(range(self.nnative - 1)):
+                earlier = pending.popleft().result()
+                if next_read >= 0:
+                    pending.append(pool.submit(self._read, next_read))
+                    next_read -= 1
+
+                for k in reversed(range(n)):
+                    yield i * n + k, self._substep(earlier, later, k)
+                later = earlier
+
+    def _substep(self, earlier, later, k):
+        """Interpolate the k-th sub-step between two native time slices."""
+        n = self.nsub
+
+        def interp(name, weight):
+            return earlier[name] + weight * (later[name] - earlier[name])
+
+        # Fluxes at the temporal midpoints, states at the edges, precipitation
+        # and evaporation are backward-filled accumulations
+        w_flux = (k + 0.5) / n
+        precip = later["precip"] / n
+        if self.zero_precip:
+            precip = precip * 0
+        step = Timestep(
+            interp("fx_upper", w_flux),
+            interp("fy_upper", w_flux),
+            interp("fx_lower", w_flux),
+            interp("fy_lower", w_flux),
+            later["evap"] / n,
+            precip,
+            None,
+            interp("s_upper", k / n),
+            interp("s_lower", k / n),
+            interp("s_upper", (k + 1) / n),
+            interp("s_lower", (k + 1) / n),
+        )
+        f_vert = prepare_timestep(step, self.factors, self.kvf, self.stabilize)
+        step = step._replace(f_vert=f_vert)
+
+        for name, total in self._sums.items():
+            total += getattr(step, name)
+        return step
+
+    def close(self):
+        self.ds.close()
+
+    def summary(self):
+        """Return daily mean fluxes and total precipitation and evaporation.
+
+        The result has a time dimension of length one, so it can be used in
+        place of the in-memory fluxes for the diagnostic figures.
+        """
+        dims = ["time", "latitude", "longitude"]
+        ds = xr.Dataset(
+            coords={"latitude": self.latitude, "longitude": self.longitude}
+        )
+        for name, total in self._sums.items():
+            if name not in ["evap", "precip"]:
+                total = total / self.ntime
+            ds[name] = (dims, total[None])
+        return ds
@@ -0,0 +1,217 @@
+"""Backtrack the segments of a long period in parallel.
+
+The backtracking of a day starts from the tracked moisture at the end of the
+next day, so days are normally tracked one after another. But the transport
+is linear in the tracked moisture: a segment of the period that is tracked
+from zero differs from the serial run only by the moisture that is carried
+over from the later days, and that moisture evaporates or leaves the domain
+within a few days. The period is therefore split into `time_segments`
+segments:
+
+1. Each segment tracks the precipitation during its own days, starting from
+   zero, in parallel processes (up to `time_workers` at a time).
+2. Each segment, except the latest, is tracked again from the tracked
+   moisture at the start of the later segment, as found in step 1, again in
+   parallel. This correction stops as soon as the tracked moisture differs
+   by less than `time_tolerance` (a fraction of the carried-over moisture)
+   from that of step 1, and after at most `time_correction_days` days; the
+   remaining days keep the output of step 1.
+
+The processes write the output of their days themselves and only return the
+tracked moisture at the start of their segment and the moisture budget of
+each day, so the memory use doesn't grow with the length of the period.
+
+The correction tracks the total moisture, rather than adding the carried-over
+part to it, because the redistribution of tracked moisture that exceeds the
+storage of a layer (see backtrack_layers) is not linear. The result matches
+that of a serial run up to the tolerance, as long as each correction stops
+before it reaches the start of its segment. A correction that doesn't is
+reported; the moisture it carries over to the earlier segments is then left
+out. In the worst case, the wall time is that of the longest segment plus
+`time_correction_days` days.
+
+Example:
+
+    wam2layers backtrack-parallel cases/era5_2021.yaml
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from wam2layers.tracking.backtrack import (
+    backtrack_layers,
+    input_days,
+    load_region,
+    output_path,
+    prepare_fluxes,
+    prepare_layers,
+    resample,
+    summary_path,
+    time_in_range,
+    tracking_summary,
+)
+from wam2layers.tracking.bidirectional import day_timesteps, two_layer_output
+from wam2layers.tracking.io import FILE_LOCK
+
+
+def track_days(config, dates, s_track=None, tolerance=None):
+    """Backtrack a range of days and write the output of each day.
+
+    Dates are tracked backward in time, starting from s_track (default: no
+    tracked moisture). If tolerance is given, the days are tracked again, as
+    a correction of output that was tracked from zero: the tracking stops once
+    the tracked moisture differs by less than tolerance times the initial
+    tracked moisture from that of the earlier output, which it replaces.
+    Returns the tracked evaporation and losses of each tracked day, the
+    tracked moisture at the start of the earliest tracked day and, for a
+    correction, the relative difference there.
+    """
+    input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+    output_dir = Path(config["output_folder"]).expanduser() / "backtrack"
+    initial = None if s_track is None else s_track.sum()
+    budget = {}
+    region = None
+    difference = None
+
+    dates = sorted(dates, reverse=True)
+    for date, preprocessed_data in zip(dates, input_days(dates, input_dir, config)):
+        layered = "layer" in preprocessed_data.dims
+        fluxes, states = resample(preprocessed_data, config["target_frequency"])
+        fluxes, states = fluxes.load(), states.load()
+        prepare = prepare_layers if layered else prepare_fluxes
+        prepare(fluxes, states, config["target_frequency"], config["kvf"])
+
+        if s_track is None:
+            nlayer = preprocessed_data.layer.size if layered else 2
+            s_track = np.zeros((nlayer, *fluxes.precip.shape[1:]))
+        if region is None:
+            with FILE_LOCK:
+                region = load_region(config["region"], preprocessed_data).values
+
+        track_precip = time_in_range(
+            config["event_start_date"], config["event_end_date"], date.strftime("%Y%m%d")
+        )
+        steps = day_timesteps(
+            fluxes, states, reverse=True, zero=None if track_precip else "precip"
+        )
+        s_track, output = backtrack_layers(
+            steps, fluxes.time.size, s_track, region, config["kvf"]
+        )
+        budget[date] = (
+            float(output.e_track.sum()),
+            sum(float(output[f"{side}_loss"].sum()) for side in ["north", "south", "east", "west"]),
+        )
+
+        path = output_path(date, output_dir)
+        if tolerance is not None:
+            with FILE_LOCK:
+                earlier = xr.load_dataset(path)
+            if layered:
+                restart = earlier.s_track_restart.values
+            else:
+                restart = np.stack(
+                    [earlier.s_track_upper_restart.values, earlier.s_track_lower_restart.values]
+                )
+            difference = np.abs(s_track - restart).sum() / initial
+
+        if not layered:
+            output = two_layer_output(output)
+        output.coords["lat"] = preprocessed_data.latitude.values
+        output.coords["lon"] = preprocessed_data.longitude.values
+        with FILE_LOCK:
+            output.to_netcdf(path)
+
+        if difference is not None and difference < tolerance:
+            break
+    return budget, s_track, difference
+
+
+def run_time_parallel(config_file):
+    """Run a backtracking experiment with the segments of the period in parallel."""
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+
+    if (
+        config.get("tracking_scheme", "explicit") != "explicit"
+        or config.get("streaming", False)
+        or config.get("screening")
+        or config.get("layer_boundary") is not None
+        or config.get("restart", False)
+        or config.get("stop_threshold") is not None
+        or config.get("output_frequency")
+        or config.get("output_snapshots", False)
+        or config.get("probes")
+        or config.get("diagnostic_figures", False)
+    ):
+        raise ValueError(
+            "Time-parallel runs use the explicit scheme and track the whole period "
+            "from zero, without streaming, screening, a layer_boundary, a "
+            "stop_threshold, sub-daily output, probes or figures"
+        )
+
+    datelist = pd.date_range(
+        start=config["track_start_date"],
+        end=config["track_end_date"],
+        freq="d",
+        inclusive="left",
+    )
+    output_dir = Path(config["output_folder"]).expanduser() / "backtrack"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if config.get("preprocess") and config.get("spill", False):
+        input_dir = Path(config["preprocessed_data_folder"]).expanduser()
+        input_dir.mkdir(parents=True, exist_ok=True)
+
+    nsegments = min(config.get("time_segments", 4), len(datelist))
+    segments = [list(dates) for dates in np.array_split(datelist, nsegments)]
+    workers = config.get("time_workers", nsegments)
+    tolerance = config.get("time_tolerance", 1e-4)
+    correction_days = config.get("time_correction_days", 10)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Each segment tracks its own precipitation, starting from zero, and
+        # writes its output
+        results = list(pool.map(track_days, [config] * nsegments, segments))
+
+        # Track the last days of each earlier segment again from the moisture
+        # carried over from the later segment, until the difference has
+        # (almost) disappeared, and replace their output
+        indices = [i for i in range(nsegments - 1) if results[i + 1][1].sum() > 0]
+        corrections = pool.map(
+            track_days,
+            [config] * len(indices),
+            [segments[i][-correction_days:] for i in indices],
+            [results[i + 1][1] for i in indices],
+            [tolerance] * len(indices),
+        )
+        corrections = dict(zip(indices, corrections))
+
+    # Tracked evaporation and losses of each day, after the corrections
+    budget = {}
+    for days, _, _ in results:
+        budget.update(days)
+    remaining = results[0][1]
+    for i, (corrected, s_track, difference) in corrections.items():
+        budget.update(corrected)
+
+        # Report the corrections that stopped before reaching the tolerance
+        earliest = min(corrected)
+        if difference >= tolerance:
+            print(
+                f"The correction of the segment that ends on {segments[i][-1]:%Y-%m-%d} "
+                f"stopped on {earliest:%Y-%m-%d} with a difference of "
+                f"{difference:.2g} of the carried-over moisture; consider "
+                "longer segments or a larger time_correction_days"
+            )
+        if i == 0 and earliest == segments[0][0]:
+            remaining = s_track
+
+    e_track_total = sum(e_track for e_track, _ in budget.values())
+    losses_total = sum(losses for _, losses in budget.values())
+    summary = tracking_summary(
+        datelist, float(remaining.sum()), e_track_total, losses_total, False
+    )
+    summary.to_netcdf(summary_path(output_dir))